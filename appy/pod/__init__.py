@@ -84,6 +84,55 @@ class PodError(Exception):
                 buffer.write('</%s>' % subTag.elem)
             buffer.write('</%s>' % withinElement.OD.elem)
 
+# ------------------------------------------------------------------------------
+def compile(template):
+    '''Unzips and parses p_template (the path to an ODT or ODS file, or a
+       file-like object) once for all and returns a CompiledTemplate instance,
+       that can be rendered many times via its method "render".'''
+    from appy.pod.renderer import CompiledTemplate
+    return CompiledTemplate(template)
+
+def renderMany(template, contexts, results, workers=None, **kwargs):
+    '''Renders p_template with every context from p_contexts into the
+       corresponding file from p_results, using a pool of p_workers processes.
+       Returns a generator yielding a tuple (result, error) for every rendering,
+       as soon as it is finished. More info in appy.pod.batch.BatchRenderer.'''
+    from appy.pod.batch import BatchRenderer
+    return BatchRenderer(template, workers, **kwargs).run(contexts, results)
+
+def convertMany(inputs, resultType, **kwargs):
+    '''Converts, with LibreOffice, the documents from p_inputs (paths to
+       documents, folders or "@"-prefixed manifest files) into p_resultType.
+       Returns a generator yielding a tuple (path, error) for every document.
+       More info in appy.pod.converter.BatchConverter.'''
+    from appy.pod.converter import BatchConverter
+    return BatchConverter(inputs, resultType, **kwargs).run()
+
+async def renderAsync(template, context, result, converter=None,
+                      executor=None, **kwargs):
+    '''Renders p_template with p_context into p_result, like a Renderer
+       (whose other parameters can be given in p_kwargs), from asyncio code.
+       The rendering runs in p_executor. The LibreOffice conversion, if any, is
+       performed by p_converter, an AsyncConverter that may be shared by
+       several renderings: it limits the number of simultaneous conversions
+       and times them out. If p_converter is None, a converter is created for
+       this rendering only. More info in appy.pod.async_renderer.
+
+       Several renderings of the same CompiledTemplate can't run in parallel:
+       they are serialised (see appy.pod.renderer.CompiledTemplate). In order
+       to render a template concurrently, give its path (or content) to every
+       rendering, or compile it once per executor thread.'''
+    from appy.pod.async_renderer import AsyncRenderer, AsyncConverter
+    own = converter is None
+    if own:
+        converter = AsyncConverter(kwargs.get('pythonWithUnoPath'),
+                                   kwargs.get('ooPort', 2002))
+    try:
+        await AsyncRenderer(converter, executor, (template, context, result),
+                            kwargs).run()
+    finally:
+        if own: await converter.close()
+
 # XXX To remove, present for backward compatibility only
 convertToXhtml = escapeXhtml
 # ------------------------------------------------------------------------------
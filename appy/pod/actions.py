@@ -15,6 +15,7 @@
 # Appy. If not, see <http://www.gnu.org/licenses/>.
 
 # ------------------------------------------------------------------------------
+import collections
 from appy import Object
 from appy.pod import PodError
 from appy.shared.utils import Traceback
@@ -47,6 +48,9 @@ class BufferAction:
         # content. If 'from', we must dump what comes from the 'from' part of
         # the action (='fromExpr')
         self.fromExpr = fromExpr
+        # The compiled expressions
+        self.codes = expr and self.compile(expr)
+        self.fromCode = fromExpr and getCode(fromExpr)
         # Several actions may co-exist for the same buffer, as a chain of
         # BufferAction instances, defined via the following attribute.
         self.subAction = None
@@ -81,25 +85,34 @@ class BufferAction:
         PodError.dump(tempBuffer, errorMessage, withinElement=self.elem)
         tempBuffer.evaluate(result, context)
 
-    def _evalExpr(self, expr, context):
-        '''Evaluates p_expr with p_context. p_expr can contain an error expr,
-           in the form "someExpr|errorExpr". If it is the case, if the "normal"
-           expr raises an error, the "error" expr is evaluated instead.'''
-        if '|' not in expr:
-            res = eval(expr, context)
+    def compile(self, expr):
+        '''Compiles p_expr, that can contain an error expr, in the form
+           "someExpr|errorExpr". Returns a tuple (code, errorCode), errorCode
+           being None if there is no error expr.'''
+        if '|' not in expr: return getCode(expr), None
+        expr, errorExpr = expr.rsplit('|', 1)
+        return getCode(expr), getCode(errorExpr)
+
+    def _evalExpr(self, codes, context):
+        '''Evaluates p_codes, as returned by m_compile, with p_context. If
+           the "normal" expr raises an error, the "error" expr, if any, is
+           evaluated instead.'''
+        code, errorCode = codes
+        if not errorCode:
+            res = eval(code, context)
         else:
-            expr, errorExpr = expr.rsplit('|', 1)
             try:
-                res = eval(expr, context)
+                res = eval(code, context)
             except Exception:
-                res = eval(errorExpr, context)
+                res = eval(errorCode, context)
         return res
 
-    def evaluateExpression(self, result, context, expr):
-        '''Evaluates expression p_expr with the current p_context. Returns a
-           tuple (result, errorOccurred).'''
+    def evaluateExpression(self, result, context, expr, codes):
+        '''Evaluates expression p_expr, compiled in p_codes (see m_compile),
+           with the current p_context. Returns a tuple (result,
+           errorOccurred).'''
         try:
-            res = self._evalExpr(expr, context)
+            res = self._evalExpr(codes, context)
             error = False
         except Exception as e:
             res = None
@@ -120,7 +133,8 @@ class BufferAction:
             # Evaluate self.expr in eRes
             eRes = None
             if self.expr:
-                eRes,error = self.evaluateExpression(result, context, self.expr)
+                eRes, error = self.evaluateExpression(result, context,
+                                                      self.expr, self.codes)
             if not error:
                 # Trigger action-specific behaviour
                 self.do(result, context, eRes)
@@ -133,7 +147,7 @@ class BufferAction:
             feRes = None
             error = False
             try:
-                feRes = eval(self.fromExpr, context)
+                feRes = eval(self.fromCode, context)
             except Exception as e:
                 msg = FROM_EVAL_ERROR% (self.fromExpr, self.getExceptionLine(e))
                 self.manageError(result, context, msg)
@@ -175,9 +189,57 @@ class ElseAction(IfAction):
     def do(self, result, context, exprRes):
         # This action is executed if the tied "if" action is not executed.
         ifAction = self.ifAction
-        iRes,error = ifAction.evaluateExpression(result, context, ifAction.expr)
+        iRes, error = ifAction.evaluateExpression(result, context,
+                                                  ifAction.expr, ifAction.codes)
         IfAction.do(self, result, context, not iRes)
 
+class Loop(Object):
+    '''Info about a loop being walked by a "for" action: see
+       m_ForAction.initialiseLoop. p_elems may be any iterable, including
+       generators or database cursors: they are walked lazily, with a lookahead
+       of a single element for computing attribute "last". Attribute "length"
+       is computed only when it is requested: if p_elems does not support
+       "len", the remaining elements are then read in advance.'''
+    def __init__(self, elems):
+        Object.__init__(self)
+        self.elems = elems
+        self.total = None
+        self.iterator = iter(elems)
+        # Elements read in advance from self.iterator
+        self.ahead = collections.deque()
+        self.nb = -1
+
+    def getLength(self):
+        if self.total is None:
+            try:
+                self.total = len(self.elems)
+            except Exception:
+                self.ahead.extend(self.iterator)
+                self.total = self.nb + 1 + len(self.ahead)
+        return self.total
+    length = property(getLength)
+
+    def hasNext(self):
+        '''Is there another element to walk ?'''
+        if self.ahead: return True
+        try:
+            self.ahead.append(next(self.iterator))
+            return True
+        except StopIteration:
+            return False
+
+    def walk(self):
+        '''Yields the elements to walk, updating loop attributes for every
+           element.'''
+        while self.hasNext():
+            item = self.ahead.popleft()
+            i = self.nb = self.nb + 1
+            self.first = i == 0
+            self.last = not self.hasNext()
+            self.even = (i%2) == 0
+            self.odd = not self.even
+            yield item
+
 class ForAction(BufferAction):
     '''Actions that will include the content of the buffer as many times as
        specified by the action parameters.'''
@@ -214,11 +276,7 @@ class ForAction(BufferAction):
         #                      myListOfElements.
         if 'loop' not in context:
             context['loop'] = Object()
-        try:
-            total = len(elems)
-        except Exception:
-            total = 0
-        curLoop = Object(length=total)
+        curLoop = Loop(elems)
         # Does this loop overrides an outer loop whose iterator has the same
         # name ?
         outerLoop = None
@@ -256,20 +314,9 @@ class ForAction(BufferAction):
             initialColIndex = self.elem.colIndex
             currentColIndex = initialColIndex
             rowAttributes = self.elem.tableInfo.curRowAttrs
-            # If p_elems is empty, dump an empty cell to avoid having the wrong
-            # number of cells for the current row.
-            if not elems:
-                result.dumpElement(Cell.OD.elem)
         # Enter the "for" loop
         loop, outerLoop = self.initialiseLoop(context, elems)
-        i = -1
-        for item in elems:
-            i += 1
-            loop.nb = i
-            loop.first = i == 0
-            loop.last = i == (loop.length-1)
-            loop.even = (i%2)==0
-            loop.odd = not loop.even
+        for item in loop.walk():
             context[self.iter] = item
             # Cell: add a new row if we are at the end of a row
             if isCell and (currentColIndex == nbOfColumns):
@@ -285,10 +332,16 @@ class ForAction(BufferAction):
             # Cell: increment the current column index
             if isCell:
                 currentColIndex += 1
+        # Were elements walked ?
+        walked = loop.nb > -1
+        # Cell: if no element was walked, dump an empty cell to avoid having the
+        # wrong number of cells for the current row.
+        if isCell and not walked:
+            result.dumpElement(Cell.OD.elem)
         # Cell: leave the last row with the correct number of cells, excepted
         # if the user has specified himself "columnsRepeated": it is his
         # responsibility to produce the correct number of cells.
-        if isCell and elems and not customColumnsRepeated:
+        if isCell and walked and not customColumnsRepeated:
             wrongNbOfCells = (currentColIndex-1) - initialColIndex
             if wrongNbOfCells < 0: # Too few cells for last row
                 for i in range(abs(wrongNbOfCells)):
@@ -322,7 +375,7 @@ class ForAction(BufferAction):
         if hasHiddenVariable:
             context[self.iter] = hiddenVariable
         else:
-            if elems:
+            if walked:
                 if self.iter in context: # May not be the case on error
                     del context[self.iter]
 
@@ -342,6 +395,8 @@ class VariablesAction(BufferAction):
         BufferAction.__init__(self,name, buff, None, elem, minus, src, fromExpr)
         # Definitions of variables: ~[(s_name, s_expr)]~
         self.variables = variables
+        # The compiled expressions of the variables, in the same order
+        self.variablesCodes = [self.compile(expr) for name, expr in variables]
 
     def do(self, result, context, exprRes):
         '''Evaluate the variables' expressions: because there are several
@@ -353,9 +408,9 @@ class VariablesAction(BufferAction):
            values.
         '''
         hidden = None
-        for name, expr in self.variables:
+        for (name, expr), codes in zip(self.variables, self.variablesCodes):
             # Evaluate variable expression in vRes
-            vRes, error = self.evaluateExpression(result, context, expr)
+            vRes, error = self.evaluateExpression(result, context, expr, codes)
             if error: return
             # Replace the value of global variables
             if name.startswith('@'):
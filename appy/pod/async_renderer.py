@@ -0,0 +1,301 @@
+# ------------------------------------------------------------------------------
+# Appy is a framework for building applications in the Python language.
+# Copyright (C) 2007 Gaetan Delannay
+
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,USA.
+
+# ------------------------------------------------------------------------------
+import os.path, json, asyncio, functools
+
+from appy.pod import PodError
+from appy.pod import converter
+from appy.pod.converter import Converter, ConverterError, DEFAULT_PORT, \
+                               WORKER_DIED, WORKER_PROTOCOL
+from appy.pod.lo_pool import LoPool
+from appy.pod.renderer import Renderer, CONVERT_ERROR
+
+# ------------------------------------------------------------------------------
+TIMEOUT_ERROR = 'LibreOffice on port %d did not answer within %d seconds.'
+BAD_PORTS = 'Ports must be an integer, a list of integers or a LoPool.'
+
+# ------------------------------------------------------------------------------
+class AsyncWorker:
+    '''A process running converter.py in "serve" mode (see
+       ConverterScript.serve), driven through asyncio pipes: waiting for a
+       conversion does not block any thread.'''
+
+    def __init__(self, pyPath, port):
+        self.pyPath = pyPath
+        self.port = port
+        self.process = None
+
+    async def start(self):
+        path = os.path.abspath(converter.__file__.replace('.pyc', '.py'))
+        self.process = await asyncio.create_subprocess_exec(self.pyPath, path,
+          '--serve', '-p', str(self.port), stdin=asyncio.subprocess.PIPE,
+          stdout=asyncio.subprocess.PIPE)
+
+    def isAlive(self):
+        return self.process and (self.process.returncode is None)
+
+    async def convert(self, docPath, resultType, templatePath=None):
+        '''Asks the worker process to convert p_docPath to p_resultType (a type
+           or a list of types). Raises a ConverterError if the conversion
+           fails.'''
+        request = {'doc': docPath, 'type': resultType,
+                   'template': templatePath}
+        try:
+            self.process.stdin.write((json.dumps(request) + '\n').encode())
+            await self.process.stdin.drain()
+            response = await self.process.stdout.readline()
+        except (OSError, IOError):
+            response = None
+        if not response:
+            # The process is dead
+            await self.stop()
+            raise ConverterError(WORKER_DIED % (self.pyPath,
+                                                self.process.returncode))
+        try:
+            error = json.loads(response.decode()).get('error')
+        except ValueError:
+            # Stray output: the protocol is desynchronised
+            self.kill()
+            await self.process.wait()
+            raise ConverterError(WORKER_PROTOCOL % (self.pyPath,
+                                 response.decode(errors='replace').strip()))
+        if error: raise ConverterError(error)
+
+    def kill(self):
+        '''Kills the worker process, ie because its conversion was cancelled
+           or timed out.'''
+        if self.isAlive(): self.process.kill()
+
+    async def stop(self):
+        '''Stops the worker process.'''
+        if not self.process: return
+        try:
+            self.process.stdin.close()
+        except (OSError, IOError):
+            pass
+        await self.process.wait()
+
+# ------------------------------------------------------------------------------
+class AsyncConverter:
+    '''Performs LibreOffice conversions from asyncio code.
+
+       At most p_concurrency conversions run at once (by default, one per
+       port): other ones wait in a queue. Conversions are dispatched on
+       LibreOffice instances listening on p_ports (a port or a list of ports).
+       p_ports may also be a LoPool: conversions are then dispatched on its
+       instances, that the pool restarts when they are worn out or stuck.
+
+       A conversion lasting more than p_timeout seconds (by default, the
+       pool's timeout or 120 seconds) fails with a ConverterError. A
+       conversion that times out or is cancelled is interrupted: the process
+       performing it is killed. With a LoPool, the LibreOffice instance whose
+       conversion timed out is killed, too.
+
+       If p_pythonWithUnoPath is given, conversions are performed by
+       converter.py workers run by this UNO-enabled interpreter (see
+       AsyncWorker). Workers are started on demand and reused. Else, the
+       current interpreter must be UNO-enabled: conversions are then performed
+       by Converter instances, in threads from p_executor. Such conversions
+       cannot be interrupted: on timeout or cancellation, they go on in the
+       background.
+
+       Call m_close once the converter is not needed anymore.'''
+
+    def __init__(self, pythonWithUnoPath=None, ports=DEFAULT_PORT,
+                 concurrency=None, timeout=None, executor=None):
+        self.pool = None
+        if isinstance(ports, LoPool):
+            self.pool = ports
+            ports = [instance.port for instance in ports.instances]
+            timeout = timeout or self.pool.timeout
+        if isinstance(ports, int): ports = [ports]
+        if not isinstance(ports, (list, tuple)) or not ports:
+            raise ValueError(BAD_PORTS)
+        self.pyPath = pythonWithUnoPath
+        self.ports = list(ports)
+        self.timeout = timeout or 120
+        self.executor = executor
+        self.slots = asyncio.Semaphore(concurrency or len(self.ports))
+        # Idle workers, and the number of conversions running per port
+        self.idle = []
+        self.running = {port: 0 for port in self.ports}
+
+    def getPort(self):
+        '''Gets the port of the least busy LibreOffice instance.'''
+        port = min(self.ports, key=lambda p: self.running[p])
+        self.running[port] += 1
+        return port
+
+    async def getWorker(self, port):
+        '''Gets an idle worker for this p_port, or starts a new one.'''
+        for worker in self.idle:
+            if worker.port == port:
+                self.idle.remove(worker)
+                if worker.isAlive(): return worker
+        worker = AsyncWorker(self.pyPath, port)
+        await worker.start()
+        return worker
+
+    async def inThread(self, function, *args):
+        '''Calls p_function(*p_args) in the executor. Used for LoPool methods,
+           that may block while an instance is restarted.'''
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor,
+                                          functools.partial(function, *args))
+
+    async def acquire(self):
+        '''Acquires an instance from the LoPool, in the executor.'''
+        loop = asyncio.get_running_loop()
+        future = loop.run_in_executor(self.executor, self.pool.acquire)
+        try:
+            return await asyncio.shield(future)
+        except asyncio.CancelledError:
+            # The instance will be acquired anyway: release it afterwards
+            def release(f):
+                if f.cancelled() or f.exception(): return
+                loop.run_in_executor(self.executor, self.pool.release,
+                                     f.result())
+            future.add_done_callback(release)
+            raise
+
+    async def convert(self, docPath, resultType, templatePath=None):
+        '''Converts p_docPath to p_resultType (a type or a list of types).'''
+        async with self.slots:
+            if self.pool:
+                instance = await self.acquire()
+                port = instance.port
+            else:
+                port = self.getPort()
+            try:
+                if self.pyPath:
+                    await self.convertInWorker(port, docPath, resultType,
+                                               templatePath)
+                else:
+                    await self.convertInThread(port, docPath, resultType,
+                                               templatePath)
+            except asyncio.TimeoutError:
+                # A stuck LibreOffice would make the next conversions time out
+                if self.pool: self.pool.expire(instance)
+                raise ConverterError(TIMEOUT_ERROR % (port, self.timeout))
+            finally:
+                if self.pool:
+                    # Releasing the instance may restart it. Even if this task
+                    # is cancelled meanwhile, the release is performed.
+                    await self.inThread(self.pool.release, instance)
+                else:
+                    self.running[port] -= 1
+
+    async def convertInWorker(self, port, docPath, resultType, templatePath):
+        worker = await self.getWorker(port)
+        try:
+            await asyncio.wait_for(worker.convert(docPath, resultType,
+                                   templatePath), self.timeout)
+        except ConverterError:
+            # The conversion failed, but the worker may be reused, excepted if
+            # it died.
+            if worker.isAlive(): self.idle.append(worker)
+            raise
+        except BaseException:
+            # Timed out or cancelled: the worker is not reused
+            worker.kill()
+            raise
+        if worker.isAlive(): self.idle.append(worker)
+
+    async def convertInThread(self, port, docPath, resultType, templatePath):
+        loop = asyncio.get_running_loop()
+        def job():
+            Converter(docPath, resultType, port, templatePath).run()
+        await asyncio.wait_for(loop.run_in_executor(self.executor, job),
+                               self.timeout)
+
+    async def close(self):
+        '''Stops the idle workers.'''
+        idle = self.idle
+        self.idle = []
+        for worker in idle: await worker.stop()
+
+# ------------------------------------------------------------------------------
+class AsyncRenderer:
+    '''Renders a template from asyncio code (see function
+       appy.pod.renderAsync). The rendering itself, being CPU-bound, runs in
+       p_executor (None being the default executor of the event loop). The
+       LibreOffice conversion, if any, is performed by p_converter, an
+       AsyncConverter, without blocking any thread when the converter uses
+       workers.
+
+       p_args and p_kwargs are passed to the Renderer.'''
+
+    def __init__(self, converter, executor, args, kwargs):
+        self.converter = converter
+        self.executor = executor
+        self.args = args
+        self.kwargs = kwargs
+        self.renderer = None
+        # Must temp files be deleted by the function still running in the
+        # executor, the rendering having been cancelled meanwhile ?
+        self.deferred = False
+
+    async def inExecutor(self, function, *args):
+        '''Calls p_function(*p_args) in the executor. If the rendering is
+           cancelled meanwhile, the call can't be interrupted: temp files are
+           deleted when it ends.'''
+        loop = asyncio.get_running_loop()
+        future = loop.run_in_executor(self.executor,
+                                      functools.partial(function, *args))
+        try:
+            return await asyncio.shield(future)
+        except asyncio.CancelledError:
+            self.deferred = True
+            future.add_done_callback(lambda f: self.cleanup())
+            raise
+
+    def cleanup(self):
+        if self.renderer: self.renderer.deleteTempFolder()
+
+    async def run(self):
+        self.renderer = r = await self.inExecutor(
+            functools.partial(Renderer, *self.args, **self.kwargs))
+        try:
+            resultName, resultTypes, callLo = await self.inExecutor(
+                r.renderResult)
+            if not callLo:
+                if resultName != r.result:
+                    await self.inExecutor(r.dumpResults, resultName)
+                return
+            types = r.getConversionTypes(resultTypes)
+            if types:
+                missing, keys = await self.inExecutor(r.getCached,
+                                                      resultName, types)
+                if missing:
+                    try:
+                        await self.converter.convert(resultName, missing,
+                                                     r.getLoStylesTemplate())
+                    except ConverterError as ce:
+                        r.manageConvertError(PodError(CONVERT_ERROR % ce),
+                                             missing)
+                    await self.inExecutor(r.setCached, resultName, missing,
+                                          keys)
+            await self.inExecutor(r.exportNative, resultName, resultTypes)
+            await self.inExecutor(r.dumpConverted, resultName, resultTypes,
+                                  types)
+        finally:
+            # If a function is still running in the executor, the temp folder
+            # will be deleted when it ends (see m_inExecutor).
+            if not self.deferred: self.cleanup()
+# ------------------------------------------------------------------------------
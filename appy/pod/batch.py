@@ -0,0 +1,138 @@
+# ------------------------------------------------------------------------------
+# Appy is a framework for building applications in the Python language.
+# Copyright (C) 2007 Gaetan Delannay
+
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,USA.
+
+# ------------------------------------------------------------------------------
+import os, multiprocessing
+
+from appy.shared.utils import Traceback
+from appy.pod.renderer import CompiledTemplate
+
+# ------------------------------------------------------------------------------
+BAD_WORKERS = 'Number of workers must be a positive integer, not "%s".'
+LENGTH_MISMATCH = 'There must be as many contexts as results.'
+
+# ------------------------------------------------------------------------------
+class Worker:
+    '''Within a worker process, stores the compiled template and the renderer
+       parameters, so that the template is compiled only once per process.'''
+    compiled = None
+    kwargs = None
+
+    @staticmethod
+    def init(template, kwargs):
+        '''Initializes this worker (process) with the p_template to compile and
+           the p_kwargs to pass to every Renderer.'''
+        Worker.compiled = CompiledTemplate(template)
+        Worker.kwargs = kwargs
+
+    @staticmethod
+    def render(job):
+        '''Renders p_job, a tuple (context, result), and returns a tuple
+           (result, error). p_error is None if the rendering succeeded, or the
+           traceback of the error as a string else.'''
+        context, result = job
+        try:
+            Worker.compiled.render(context, result, **Worker.kwargs)
+            return result, None
+        except Exception:
+            return result, Traceback.get()
+
+# ------------------------------------------------------------------------------
+class BatchRenderer:
+    '''Renders a single POD template many times, with different contexts, by
+       distributing the work over a pool of processes. Every process compiles
+       the template once, then renders as many contexts as it receives.'''
+
+    def __init__(self, template, workers=None, chunkSize=1, **kwargs):
+        # p_template is the path to an ODT or ODS file, the content of such a
+        # file as bytes, or a file-like object. In order to avoid every worker
+        # reading it again from disk, it is transmitted to workers as bytes.
+        if isinstance(template, CompiledTemplate):
+            template = template.data
+        elif isinstance(template, str):
+            f = open(template, 'rb')
+            template = f.read()
+            f.close()
+        elif not isinstance(template, bytes):
+            if hasattr(template, 'seek'): template.seek(0)
+            template = template.read()
+        self.template = template
+        # The number of worker processes. If None, it will be the number of
+        # CPUs on this machine.
+        if workers is None: workers = os.cpu_count() or 1
+        if not isinstance(workers, int) or (workers < 1):
+            raise ValueError(BAD_WORKERS % workers)
+        self.workers = workers
+        # The number of jobs sent at once to a worker. For a large number of
+        # small documents, increasing it reduces inter-process communication.
+        self.chunkSize = chunkSize
+        # Parameters to pass to every Renderer (pythonWithUnoPath, ooPort,
+        # stylesMapping, overwriteExisting...). They must be picklable.
+        self.kwargs = kwargs
+
+    def getJobs(self, contexts, results):
+        '''Yields tuples (context, result) from p_contexts and p_results. If
+           one of them is longer than the other, pairing stops and
+           self.mismatch is set.'''
+        results = iter(results)
+        for context in contexts:
+            try:
+                result = next(results)
+            except StopIteration:
+                self.mismatch = True
+                return
+            yield context, result
+        for result in results:
+            self.mismatch = True
+            return
+
+    def run(self, contexts, results):
+        '''Renders the template with every context from iterable p_contexts,
+           into the corresponding result from iterable p_results (file paths,
+           with the extension determining the output format). This method is a
+           generator yielding, for every rendering, as soon as it is finished,
+           a tuple (result, error): see m_Worker.render. Results are thus not
+           necessarily produced in the order of p_contexts. Contexts must be
+           picklable.
+
+           p_contexts and p_results must have the same length, else a
+           ValueError is raised: before rendering anything if both have a
+           length, after having rendered the jobs that could be paired else.'''
+        if hasattr(contexts, '__len__') and hasattr(results, '__len__') and \
+           (len(contexts) != len(results)):
+            raise ValueError(LENGTH_MISMATCH)
+        self.mismatch = False
+        jobs = self.getJobs(contexts, results)
+        if self.workers == 1:
+            # Render in the current process, without any pool
+            Worker.init(self.template, self.kwargs)
+            for job in jobs:
+                yield Worker.render(job)
+        else:
+            pool = multiprocessing.Pool(self.workers, initializer=Worker.init,
+                                        initargs=(self.template, self.kwargs))
+            try:
+                for res in pool.imap_unordered(Worker.render, jobs,
+                                               self.chunkSize):
+                    yield res
+                pool.close()
+            finally:
+                pool.terminate()
+                pool.join()
+        if self.mismatch: raise ValueError(LENGTH_MISMATCH)
+# ------------------------------------------------------------------------------
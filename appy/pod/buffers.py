@@ -19,7 +19,7 @@ import re
 from xml.sax.saxutils import quoteattr
 from appy.shared.xml_parser import xmlPrologue, escapeXml
 from appy.pod import PodError
-from appy.shared.utils import Traceback
+from appy.shared.utils import Traceback, Rope
 from appy.pod.elements import *
 from appy.pod.actions import IfAction, ElseAction, ForAction, VariablesAction, \
                              NullAction
@@ -78,38 +78,24 @@ NULL_ACTION_ERROR = 'There was a problem with this action. Possible causes: ' \
                     'allowed (ie "do text from ...").'
 # ------------------------------------------------------------------------------
 class BufferIterator:
+    '''Walks, in the order of their indexes, the elements and sub-buffers of
+       a buffer.'''
     def __init__(self, buffer):
         self.buffer = buffer
-        self.remainingSubBufferIndexes = list(self.buffer.subBuffers.keys())
-        self.remainingElemIndexes = list(self.buffer.elements.keys())
-        self.remainingSubBufferIndexes.sort()
-        self.remainingElemIndexes.sort()
+        # At the same index, a sub-buffer comes before an element
+        entries = [(i, 0, b) for i, b in buffer.subBuffers.items()] + \
+                  [(i, 1, e) for i, e in buffer.elements.items()]
+        entries.sort(key=lambda entry: entry[:2])
+        self.entries = entries
+        self.next = 0 # The index, within self.entries, of the next entry
 
     def hasNext(self):
-        return self.remainingSubBufferIndexes or self.remainingElemIndexes
+        return self.next < len(self.entries)
 
     def __next__(self):
-        nextSubBufferIndex = None
-        if self.remainingSubBufferIndexes:
-            nextSubBufferIndex = self.remainingSubBufferIndexes[0]
-        nextExprIndex = None
-        if self.remainingElemIndexes:
-            nextExprIndex = self.remainingElemIndexes[0]
-        # Compute min between nextSubBufferIndex and nextExprIndex
-        if (nextSubBufferIndex != None) and (nextExprIndex != None):
-            res = min(nextSubBufferIndex, nextExprIndex)
-        elif (nextSubBufferIndex == None) and (nextExprIndex != None):
-            res = nextExprIndex
-        elif (nextSubBufferIndex != None) and (nextExprIndex == None):
-            res = nextSubBufferIndex
-        # Update "remaining" lists
-        if res == nextSubBufferIndex:
-            self.remainingSubBufferIndexes = self.remainingSubBufferIndexes[1:]
-            resDict = self.buffer.subBuffers
-        elif res == nextExprIndex:
-            self.remainingElemIndexes = self.remainingElemIndexes[1:]
-            resDict = self.buffer.elements
-        return res, resDict[res]
+        index, kind, entry = self.entries[self.next]
+        self.next += 1
+        return index, entry
 
 # ------------------------------------------------------------------------------
 class Buffer:
@@ -221,8 +207,12 @@ class Buffer:
 class FileBuffer(Buffer):
     def __init__(self, env, result):
         Buffer.__init__(self, env, None)
+        # p_result is a file name or a (text) stream
         self.result = result
-        self.content = open(result, 'w', encoding='utf-8')
+        if isinstance(result, str):
+            self.content = open(result, 'w', encoding='utf-8')
+        else:
+            self.content = result
         self.content.write(xmlPrologue)
 
     # getLength is used to manage insertions into sub-buffers. But in the case
@@ -235,10 +225,16 @@ class FileBuffer(Buffer):
 
     def addExpression(self, expression, tiedHook=None):
         # At 2013-02-06, this method was not called within the whole test suite.
+        expr = Expression(expression, self.pod)
+        if tiedHook: tiedHook.tiedExpression = expr
+        self.dumpExpression(expression, expr, self.env.context)
+
+    def dumpExpression(self, expression, expr, context):
+        '''Evaluates p_expr (an Expression instance built from source
+           p_expression) with this p_context and dumps the result into the
+           file.'''
         try:
-            expr = Expression(expression, self.pod)
-            if tiedHook: tiedHook.tiedExpression = expr
-            res, escape = expr.evaluate(self.env.context)
+            res, escape = expr.evaluate(context)
             if escape: self.dumpContent(res)
             else: self.write(res)
         except Exception as e:
@@ -258,6 +254,75 @@ class FileBuffer(Buffer):
 
     def pushSubBuffer(self, subBuffer): pass
     def getRootBuffer(self): return self
+    def close(self):
+        # Close the file, excepted if it is a stream given by the caller
+        if isinstance(self.result, str): self.content.close()
+
+# ------------------------------------------------------------------------------
+class TemplateBuffer(Buffer):
+    '''Root buffer used while parsing a POD template. Instead of being
+       evaluated as soon as it is complete (like with a FileBuffer), every
+       top-level part of the template (static content, expression or sub-buffer)
+       is recorded, in order, in this buffer. This way, a template is parsed
+       only once and can then be evaluated many times, with different contexts,
+       into a FileBuffer (see m_evaluate).'''
+    def __init__(self, env):
+        Buffer.__init__(self, env, None)
+        # The list of recorded parts. Every part can be:
+        # - a string, representing static content;
+        # - a tuple (s_source, Expression), representing a POD expression;
+        # - a MemoryBuffer, to evaluate or whose action must be executed.
+        self.parts = []
+
+    # Like a FileBuffer, this buffer has only 1 sub-buffer at a time.
+    def getLength(self): return 0
+
+    def write(self, something): self.parts.append(something)
+
+    def addExpression(self, expression, tiedHook=None):
+        expr = Expression(expression, self.pod)
+        if tiedHook: tiedHook.tiedExpression = expr
+        self.parts.append((expression, expr))
+
+    def addBuffer(self, buffer):
+        '''Records p_buffer, a complete top-level buffer.'''
+        if buffer.action or buffer.elements or buffer.subBuffers:
+            self.parts.append(buffer)
+        else:
+            # Static content: there is nothing to evaluate
+            self.write(buffer.content)
+
+    def addAttributes(self): pass # See the similar FileBuffer method
+    def pushSubBuffer(self, subBuffer): pass
+    def getRootBuffer(self): return self
+
+    def close(self):
+        '''Parsing is complete: merge consecutive chunks of static content.'''
+        parts = []
+        static = []
+        for part in self.parts:
+            if isinstance(part, str):
+                static.append(part)
+            else:
+                if static:
+                    parts.append(''.join(static))
+                    static = []
+                parts.append(part)
+        if static: parts.append(''.join(static))
+        self.parts = parts
+
+    def evaluate(self, result, context):
+        '''Evaluates the recorded parts given p_context and dumps the result
+           into p_result, a FileBuffer.'''
+        for part in self.parts:
+            if isinstance(part, str):
+                result.write(part)
+            elif isinstance(part, tuple):
+                result.dumpExpression(part[0], part[1], context)
+            elif part.action:
+                part.action.execute(result, context)
+            else:
+                part.evaluate(result, context)
 
 # ------------------------------------------------------------------------------
 class MemoryBuffer(Buffer):
@@ -268,9 +333,18 @@ class MemoryBuffer(Buffer):
 
     def __init__(self, env, parent):
         Buffer.__init__(self, env, parent)
-        self.content = ''
+        # The buffer content, as a Rope. Use property "content" to get or set it
+        # as a string.
+        self.rope = Rope()
         self.elements = {}
         self.action = None
+        # The operations to perform for evaluating this buffer, computed at its
+        # first evaluation (see m_getOperations), keyed by "removeMainElems".
+        self.operations = {}
+
+    def getContent(self): return str(self.rope)
+    def setContent(self, content): self.rope = Rope(content)
+    content = property(getContent, setContent)
 
     def clone(self):
         '''Produces an empty buffer that is a clone of this one.'''
@@ -278,19 +352,19 @@ class MemoryBuffer(Buffer):
 
     def addSubBuffer(self, subBuffer=None):
         sb = Buffer.addSubBuffer(self, subBuffer)
-        self.content += ' ' # To avoid having several subbuffers referenced at
-                            # the same place within this buffer.
+        self.rope.append(' ') # To avoid having several subbuffers referenced
+                              # at the same place within this buffer.
         return sb
 
     def getRootBuffer(self):
-        '''Returns the root buffer. For POD it is always a FileBuffer. For PX,
-           it is a MemoryBuffer.'''
+        '''Returns the root buffer. For POD it is always a TemplateBuffer. For
+           PX, it is a MemoryBuffer.'''
         if self.parent: return self.parent.getRootBuffer()
         return self
 
-    def getLength(self): return len(self.content)
+    def getLength(self): return len(self.rope)
 
-    def write(self, thing): self.content += thing
+    def write(self, thing): self.rope.append(thing)
 
     def getIndex(self, podElemName):
         res = -1
@@ -353,15 +427,21 @@ class MemoryBuffer(Buffer):
             # in the parent (if it is a temp buffer generated from a cut)
             del self.subBuffers[subIndex]
             self.subBuffers[self.getLength()] = subBuffer
-            self.content += ' '
+            self.rope.append(' ')
 
     def transferAllContent(self):
         '''Transfer all content to parent.'''
-        if isinstance(self.parent, FileBuffer):
+        if isinstance(self.parent, TemplateBuffer):
             # First unreference all elements
             for index in self.getElementIndexes(expressions=False):
                 del self.elements[index]
-            self.evaluate(self.parent, self.env.context)
+            # Record a buffer holding my content: it will be evaluated at
+            # rendering time.
+            buffer = MemoryBuffer(self.env, self.parent)
+            buffer.rope = self.rope
+            buffer.elements = self.elements
+            buffer.subBuffers = self.subBuffers
+            self.parent.addBuffer(buffer)
         else:
             # Transfer content in itself
             oldParentLength = self.parent.getLength()
@@ -388,7 +468,7 @@ class MemoryBuffer(Buffer):
                 elem.colIndex = elem.tableInfo.curColIndex
         if elem == 'x':
             # See comment on similar statement in the method below.
-            self.content += ' '
+            self.rope.append(' ')
 
     def addExpression(self, expression, tiedHook=None):
         # Create the POD expression
@@ -397,20 +477,20 @@ class MemoryBuffer(Buffer):
         self.elements[self.getLength()] = expr
         # To be sure that an expr and an elem can't be found at the same index
         # in the buffer.
-        self.content += ' '
+        self.rope.append(' ')
 
     def addAttributes(self):
         '''pod-only: adds an Attributes instance into this buffer.'''
         attrs = Attributes(self.env)
         self.elements[self.getLength()] = attrs
-        self.content += ' '
+        self.rope.append(' ')
         return attrs
 
     def addAttribute(self, name, expr):
         '''px-only: adds an Attribute instance into this buffer.'''
         attr = Attribute(name, expr)
         self.elements[self.getLength()] = attr
-        self.content += ' '
+        self.rope.append(' ')
         return attr
 
     def _getVariables(self, expr):
@@ -585,12 +665,11 @@ class MemoryBuffer(Buffer):
                 subBuffers[subIndex-index] = buf
             self.subBuffers = subBuffers
         # Manage content
+        first, second = self.rope.split(index)
         if keepFirstPart:
-            res.write(self.content[index:])
-            self.content = self.content[:index]
+            res.rope, self.rope = second, first
         else:
-            res.write(self.content[:index])
-            self.content = self.content[index:]
+            res.rope, self.rope = first, second
         return res
 
     def getElementIndexes(self, expressions=True):
@@ -636,7 +715,8 @@ class MemoryBuffer(Buffer):
         if not removeMainElems: return 0
         # Find the start position of the deepest element to remove
         deepestElem = self.action.elem.DEEPEST_TO_REMOVE
-        pos = self.content.find('<%s' % deepestElem.elem)
+        content = self.content
+        pos = content.find('<%s' % deepestElem.elem)
         pos = pos + len(deepestElem.elem)
         # Now we must find the position of the end of this start tag,
         # skipping potential attributes.
@@ -644,7 +724,7 @@ class MemoryBuffer(Buffer):
         endTagFound = False # Have we found the end of this tag ?
         while not endTagFound:
             pos += 1
-            nextChar = self.content[pos]
+            nextChar = content[pos]
             if (nextChar == '>') and not inAttrValue:
                 # Yes we have it
                 endTagFound = True
@@ -674,6 +754,43 @@ class MemoryBuffer(Buffer):
         for index in list(self.elements.keys()):
             if index < pos: del self.elements[index]
 
+    def getOperations(self, removeMainElems):
+        '''Returns the list of operations to perform for evaluating this
+           buffer: static text chunks (strings) interleaved with the
+           expressions, attributes and sub-buffers (with actions) to evaluate.
+           The list is computed at the first evaluation of this buffer, that
+           must not be modified afterwards.'''
+        res = self.operations.get(removeMainElems)
+        if res is not None: return res
+        if removeMainElems: self.removeAutomaticExpressions()
+        res = []
+        content = self.content
+        iter = BufferIterator(self)
+        currentIndex = self.getStartIndex(removeMainElems)
+        while iter.hasNext():
+            index, entry = next(iter)
+            res.append(content[currentIndex:index])
+            currentIndex = index + 1
+            if isinstance(entry, MemoryBuffer) and not entry.action:
+                # A sub-buffer without action: its content is static
+                res.append(entry.content)
+            else:
+                res.append(entry)
+        stopIndex = self.getStopIndex(removeMainElems)
+        if currentIndex < (stopIndex-1):
+            res.append(content[currentIndex:stopIndex])
+        # Merge consecutive text chunks and remove empty ones
+        operations = []
+        for op in res:
+            if isinstance(op, str):
+                if not op: continue
+                if operations and isinstance(operations[-1], str):
+                    operations[-1] += op
+                    continue
+            operations.append(op)
+        self.operations[removeMainElems] = operations
+        return operations
+
     reTagContent = re.compile('<(?P<p>[\w-]+):(?P<f>[\w-]+)(.*?)>.*</(?P=p):' \
                               '(?P=f)>', re.S)
     def evaluate(self, result, context, subElements=True,
@@ -689,16 +806,12 @@ class MemoryBuffer(Buffer):
                 g = res.group
                 result.write('<%s:%s%s></%s:%s>' % (g(1),g(2),g(3),g(1),g(2)))
         else:
-            if removeMainElems: self.removeAutomaticExpressions()
-            iter = BufferIterator(self)
-            currentIndex = self.getStartIndex(removeMainElems)
-            while iter.hasNext():
-                index, evalEntry = next(iter)
-                result.write(self.content[currentIndex:index])
-                currentIndex = index + 1
-                if isinstance(evalEntry, Expression):
+            for op in self.getOperations(removeMainElems):
+                if isinstance(op, str):
+                    result.write(op)
+                elif isinstance(op, Expression):
                     try:
-                        res, escape = evalEntry.evaluate(context)
+                        res, escape = op.evaluate(context)
                         if escape: result.dumpContent(res)
                         else: result.write(res)
                     except EvaluationError as e:
@@ -708,23 +821,16 @@ class MemoryBuffer(Buffer):
                     except Exception as e:
                         if not self.env.raiseOnError:
                             PodError.dump(result, EVAL_EXPR_ERROR % (
-                                          evalEntry.expr, e))
+                                          op.expr, e))
                         else:
                             raise EvaluationError(EVAL_EXPR_ERROR % \
-                                        (evalEntry.expr, '\n'+Traceback.get(5)))
-                elif isinstance(evalEntry, Attributes) or \
-                     isinstance(evalEntry, Attribute):
-                    result.write(evalEntry.evaluate(context))
-                else: # It is a subBuffer
-                    if evalEntry.action:
-                        evalEntry.action.execute(result, context)
-                    else:
-                        result.write(evalEntry.content)
-            stopIndex = self.getStopIndex(removeMainElems)
-            if currentIndex < (stopIndex-1):
-                result.write(self.content[currentIndex:stopIndex])
+                                        (op.expr, '\n'+Traceback.get(5)))
+                elif isinstance(op, Attributes) or isinstance(op, Attribute):
+                    result.write(op.evaluate(context))
+                else: # A sub-buffer with an action
+                    op.action.execute(result, context)
 
     def clean(self):
         '''Cleans the buffer content.'''
-        self.content = ''
+        self.rope = Rope()
 # ------------------------------------------------------------------------------
@@ -0,0 +1,164 @@
+# ------------------------------------------------------------------------------
+# Appy is a framework for building applications in the Python language.
+# Copyright (C) 2007 Gaetan Delannay
+
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,USA.
+
+# ------------------------------------------------------------------------------
+import os, os.path, shutil, hashlib, zipfile, tempfile, threading
+
+# ------------------------------------------------------------------------------
+class ConversionCache:
+    '''A cache for the results of LibreOffice conversions, stored in a local
+       p_folder. A converted file is stored under a key computed from the
+       content of the file to convert, the result type and the styles template
+       (see m_getKey). When the total size of the cached files exceeds
+       p_maxSize bytes, the least recently used files are removed.
+
+       A cache can be given to the Renderer, as parameter "conversionCache".
+       It can be shared by several processes.'''
+    # The size of the chunks of data read when hashing files
+    chunkSize = 65536
+    # The total size of the cache is tracked in memory. The cache folder is
+    # only scanned when this size exceeds the maximum, and once every
+    # "scanInterval" puts, in order to take into account files added or
+    # removed by other processes.
+    scanInterval = 100
+    # When evicting files, the cache is shrunk to this ratio of its maximum
+    # size, so that the next puts do not trigger a scan each.
+    evictRatio = 0.9
+
+    def __init__(self, folder, maxSize=1073741824):
+        self.folder = folder
+        if not os.path.isdir(folder): os.makedirs(folder)
+        self.maxSize = maxSize
+        self.lock = threading.Lock()
+        # The total size of the cached files (None if unknown yet), and the
+        # number of puts since the last scan of the cache folder.
+        self.size = None
+        self.puts = 0
+
+    def hashFile(self, path, hash):
+        '''Updates p_hash with the content of the file at p_path. For a zip file
+           (ie, an ODT or ODS file), the names and uncompressed content of its
+           entries are hashed instead of the zip file itself, whose bytes vary
+           with the entries dates and the compression.'''
+        if zipfile.is_zipfile(path):
+            zipFile = zipfile.ZipFile(path)
+            for name in sorted(zipFile.namelist()):
+                hash.update(name.encode('utf-8') + b'\0')
+                f = zipFile.open(name)
+                self.hashStream(f, hash)
+                f.close()
+            zipFile.close()
+        else:
+            f = open(path, 'rb')
+            self.hashStream(f, hash)
+            f.close()
+
+    def hashStream(self, f, hash):
+        while True:
+            chunk = f.read(self.chunkSize)
+            if not chunk: break
+            hash.update(chunk)
+
+    def getKeys(self, path, resultTypes, stylesTemplate=None):
+        '''Gets the keys under which the results of converting the file at
+           p_path into every type from p_resultTypes (with some
+           p_stylesTemplate) are cached, as a dict ~{s_resultType: s_key}~. The
+           file is hashed only once.'''
+        hash = hashlib.sha256()
+        self.hashFile(path, hash)
+        if stylesTemplate:
+            hash.update(b'\0')
+            self.hashFile(stylesTemplate, hash)
+        res = {}
+        for resultType in resultTypes:
+            typeHash = hash.copy()
+            typeHash.update(b'\0%s' % resultType.encode('utf-8'))
+            res[resultType] = '%s.%s' % (typeHash.hexdigest(), resultType)
+        return res
+
+    def getKey(self, path, resultType, stylesTemplate=None):
+        '''Gets the key under which the result of converting the file at
+           p_path into p_resultType (with some p_stylesTemplate) is cached.'''
+        return self.getKeys(path, (resultType,), stylesTemplate)[resultType]
+
+    def get(self, key, target):
+        '''If a file is cached at p_key, copies it to p_target and returns
+           True. Returns False else.'''
+        path = os.path.join(self.folder, key)
+        try:
+            shutil.copyfile(path, target)
+        except (OSError, IOError):
+            # Not cached, or evicted by another process in the meanwhile
+            return False
+        # Mark the file as recently used
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return True
+
+    def put(self, key, source):
+        '''Caches the file at p_source at p_key.'''
+        # Copy the file under a temp name first: other processes must not see
+        # a partially written file.
+        fd, temp = tempfile.mkstemp(dir=self.folder, prefix='.')
+        os.close(fd)
+        shutil.copyfile(source, temp)
+        path = os.path.join(self.folder, key)
+        try:
+            replaced = os.path.getsize(path)
+        except OSError:
+            replaced = 0
+        size = os.path.getsize(temp)
+        os.replace(temp, path)
+        with self.lock:
+            self.puts += 1
+            if self.size is not None: self.size += size - replaced
+            scan = (self.size is None) or (self.size > self.maxSize) or \
+                   (self.puts >= self.scanInterval)
+        if scan: self.evict()
+
+    def evict(self):
+        '''Scans the cache folder. If the total size of the cache exceeds
+           self.maxSize, removes the least recently used files until it is
+           below self.maxSize * self.evictRatio.'''
+        with self.lock:
+            files = []
+            total = 0
+            for name in os.listdir(self.folder):
+                if name.startswith('.'): continue
+                path = os.path.join(self.folder, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, path))
+                total += stat.st_size
+            if total > self.maxSize:
+                target = self.maxSize * self.evictRatio
+                files.sort()
+                for mtime, size, path in files:
+                    try:
+                        os.remove(path)
+                    except OSError:
+                        pass
+                    total -= size
+                    if total <= target: break
+            self.size = total
+            self.puts = 0
+# ------------------------------------------------------------------------------
@@ -17,7 +17,8 @@
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,USA.
 
 # ------------------------------------------------------------------------------
-import sys, os, os.path, time, signal
+import sys, os, os.path, time, signal, threading, subprocess, json, atexit
+import traceback, queue
 from optparse import OptionParser
 
 htmlFilters = {'odt': 'HTML (StarWriter)',
@@ -27,6 +28,8 @@ htmlFilters = {'odt': 'HTML (StarWriter)',
 FILE_TYPES = {'odt': 'writer8',
               'ods': 'calc8',
               'odp': 'impress8',
+              'fodt': 'OpenDocument Text Flat XML',
+              'fods': 'OpenDocument Spreadsheet Flat XML',
               'htm': htmlFilters, 'html': htmlFilters,
               'rtf': 'Rich Text Format',
               'txt': 'Text',
@@ -37,7 +40,8 @@ FILE_TYPES = {'odt': 'writer8',
                       'txt': 'writer_pdf_Export', 'csv': 'calc_pdf_Export',
                       'swf': 'draw_pdf_Export', 'doc': 'writer_pdf_Export',
                       'xls': 'calc_pdf_Export', 'ppt': 'impress_pdf_Export',
-                      'docx': 'writer_pdf_Export', 'xlsx': 'calc_pdf_Export'
+                      'docx': 'writer_pdf_Export', 'xlsx': 'calc_pdf_Export',
+                      'fodt': 'writer_pdf_Export', 'fods': 'calc_pdf_Export'
                       },
               'swf': 'impress_flash_Export',
               'doc': 'MS Word 97',
@@ -63,6 +67,69 @@ CONNECT_ERROR = 'Could not connect to LibreOffice on port %d. UNO ' \
 # Some constants ---------------------------------------------------------------
 DEFAULT_PORT = 2002
 
+# ------------------------------------------------------------------------------
+class Connection:
+    '''A connection to LibreOffice running in server mode on some port. Within
+       a process, a single connection is created per port (see m_get) and
+       reused for all conversions: the UNO bridge and the LibreOffice desktop
+       are kept alive between conversions. If the bridge dies (ie, LibreOffice
+       was restarted), the connection is re-established (see m_reset).'''
+    # Connections, per port: ~{i_port: Connection}~
+    connections = {}
+    lock = threading.Lock()
+
+    @staticmethod
+    def get(port):
+        '''Returns the connection to LibreOffice on this p_port, connected.'''
+        with Connection.lock:
+            res = Connection.connections.get(port)
+            if not res:
+                res = Connection(port)
+                res.connect()
+                Connection.connections[port] = res
+        return res
+
+    @staticmethod
+    def reset(port):
+        '''Forgets the connection on this p_port. The next call to m_get will
+           reconnect to LibreOffice.'''
+        with Connection.lock:
+            if port in Connection.connections:
+                del Connection.connections[port]
+
+    def __init__(self, port):
+        self.port = port
+        self.loContext = None
+        self.oo = None # The LibreOffice application object (the desktop)
+
+    def connect(self):
+        '''Connects to LibreOffice'''
+        if os.name == 'nt':
+            import socket
+        import uno
+        from com.sun.star.connection import NoConnectException
+        try:
+            # Get the uno component context from the PyUNO runtime
+            localContext = uno.getComponentContext()
+            # Create the UnoUrlResolver
+            resolver = localContext.ServiceManager.createInstanceWithContext(
+                "com.sun.star.bridge.UnoUrlResolver", localContext)
+            # Connect to the running office
+            self.loContext = resolver.resolve(
+                'uno:socket,host=localhost,port=%d;urp;StarOffice.' \
+                'ComponentContext' % self.port)
+            # Is seems that we can't define a timeout for this method.
+            # I need it because, for example, when a web server already listens
+            # to the given port (thus, not a LibreOffice instance), this method
+            # blocks.
+            smgr = self.loContext.ServiceManager
+            # Get the central desktop object
+            self.oo = smgr.createInstanceWithContext(
+                'com.sun.star.frame.Desktop', self.loContext)
+        except NoConnectException:
+            e = sys.exc_info()[1]
+            raise ConverterError(CONNECT_ERROR % (self.port, e))
+
 # ------------------------------------------------------------------------------
 class Converter:
     '''Converts a document readable by LibreOffice into pdf, doc, txt, rtf...'''
@@ -77,9 +144,15 @@ class Converter:
         # The path to the document to convert
         self.docUrl, self.docPath = self.getFilePath(docPath)
         self.inputType = os.path.splitext(docPath)[1][1:].lower()
-        self.resultType = resultType
-        self.resultFilter = self.getResultFilter()
-        self.resultUrl = self.getResultUrl()
+        # p_resultType may be a list of types: the document will then be
+        # loaded once, and stored in every type.
+        if isinstance(resultType, str): resultType = [resultType]
+        self.resultTypes = resultType
+        self.resultType = resultType[0]
+        self.resultFilters = [self.getResultFilter(t) for t in resultType]
+        self.resultUrls = [self.getResultUrl(t) for t in resultType]
+        self.resultFilter = self.resultFilters[0]
+        self.resultUrl = self.resultUrls[0]
         self.loContext = None
         self.oo = None # The LibreOffice application object
         self.doc = None # The LibreOffice loaded document
@@ -100,19 +173,19 @@ class Converter:
         # Return one path for OO, one path for me
         return unohelper.systemPathToFileUrl(docAbsPath), docAbsPath
 
-    def getResultFilter(self):
-        '''Based on the result type, identifies which OO filter to use for the
+    def getResultFilter(self, resultType):
+        '''Based on the p_resultType, identifies which OO filter to use for the
            document conversion.'''
-        if self.resultType in FILE_TYPES:
-            res = FILE_TYPES[self.resultType]
+        if resultType in FILE_TYPES:
+            res = FILE_TYPES[resultType]
             if isinstance(res, dict):
                 res = res[self.inputType]
         else:
-            raise ConverterError(BAD_RESULT_TYPE % (self.resultType,
+            raise ConverterError(BAD_RESULT_TYPE % (resultType,
                                                     list(FILE_TYPES.keys())))
         return res
 
-    def getResultUrl(self):
+    def getResultUrl(self, resultType):
         '''Returns the path of the result file in the format needed by LO. If
            the result type and the input type are the same (ie the user wants to
            refresh indexes or some other action and not perform a real
@@ -125,10 +198,10 @@ class Converter:
         '''
         import unohelper
         baseName = os.path.splitext(self.docPath)[0]
-        if self.resultType != self.inputType:
-            res = '%s.%s' % (baseName, self.resultType)
+        if resultType != self.inputType:
+            res = '%s.%s' % (baseName, resultType)
         else:
-            res = '%s.res.%s' % (baseName, self.resultType)
+            res = '%s.res.%s' % (baseName, resultType)
         try:
             f = open(res, 'w')
             f.write('Hello')
@@ -152,32 +225,11 @@ class Converter:
         return tuple(res)
 
     def connect(self):
-        '''Connects to LibreOffice'''
-        if os.name == 'nt':
-            import socket
-        import uno
-        from com.sun.star.connection import NoConnectException
-        try:
-            # Get the uno component context from the PyUNO runtime
-            localContext = uno.getComponentContext()
-            # Create the UnoUrlResolver
-            resolver = localContext.ServiceManager.createInstanceWithContext(
-                "com.sun.star.bridge.UnoUrlResolver", localContext)
-            # Connect to the running office
-            self.loContext = resolver.resolve(
-                'uno:socket,host=localhost,port=%d;urp;StarOffice.' \
-                'ComponentContext' % self.port)
-            # Is seems that we can't define a timeout for this method.
-            # I need it because, for example, when a web server already listens
-            # to the given port (thus, not a LibreOffice instance), this method
-            # blocks.
-            smgr = self.loContext.ServiceManager
-            # Get the central desktop object
-            self.oo = smgr.createInstanceWithContext(
-                'com.sun.star.frame.Desktop', self.loContext)
-        except NoConnectException:
-            e = sys.exc_info()[1]
-            raise ConverterError(CONNECT_ERROR % (self.port, e))
+        '''Gets the (possibly already established) connection to
+           LibreOffice.'''
+        connection = Connection.get(self.port)
+        self.loContext = connection.loContext
+        self.oo = connection.oo
 
     def updateOdtDocument(self):
         '''If the input file is an ODT document, we will perform those tasks:
@@ -246,54 +298,370 @@ class Converter:
             raise ConverterError(URL_NOT_FOUND % (self.docPath, e))
 
     def convertDocument(self):
-        '''Calls LO to perform a document conversion. Note that the conversion
-           is not really done if the source and target documents have the same
-           type.'''
-        props = [('FilterName', self.resultFilter)]
-        if self.resultType == 'csv': # Add options for CSV export (separator...)
-            props.append(('FilterOptions', '59,34,76,1'))
-        self.doc.storeToURL(self.resultUrl, self.props(props))
+        '''Calls LO to perform a document conversion, for every result type.
+           Note that the conversion is not really done if the source and target
+           documents have the same type.'''
+        for i in range(len(self.resultTypes)):
+            props = [('FilterName', self.resultFilters[i])]
+            if self.resultTypes[i] == 'csv':
+                # Add options for CSV export (separator...)
+                props.append(('FilterOptions', '59,34,76,1'))
+            self.doc.storeToURL(self.resultUrls[i], self.props(props))
 
     def run(self):
-        '''Connects to LO, does the job and disconnects'''
+        '''Connects to LO (or reuses the current connection) and does the
+           job.'''
+        from com.sun.star.lang import DisposedException
         self.connect()
-        self.loadDocument()
-        self.convertDocument()
-        self.doc.close(True)
+        try:
+            self.loadDocument()
+        except DisposedException:
+            # The UNO bridge died since the last conversion: reconnect
+            Connection.reset(self.port)
+            self.connect()
+            self.loadDocument()
+        try:
+            self.convertDocument()
+        finally:
+            self.doc.close(True)
+
+# ------------------------------------------------------------------------------
+WORKER_DIED = 'The converter worker (%s) died. %s'
+WORKER_TIMEOUT = 'The converter worker (%s) did not answer within %d ' \
+                 'seconds. It was killed.'
+WORKER_PROTOCOL = 'The converter worker (%s) sent an unexpected answer: ' \
+                  '"%s". It was killed.'
+
+class ConverterWorker:
+    '''Allows a Python interpreter without UNO to perform conversions via a
+       UNO-enabled Python interpreter running this script in "serve" mode (see
+       m_ConverterScript.serve). Such worker processes are started on demand
+       and kept alive between conversions: the interpreter startup, the UNO
+       import and the connection to LibreOffice are paid only once per
+       worker. Idle workers are kept in a pool (see m_get and m_release): there
+       are as many workers as conversions having run simultaneously.'''
+    # Idle workers, per UNO-enabled interpreter and LibreOffice port:
+    # ~{(s_pythonPath, i_port): [ConverterWorker]}~
+    workers = {}
+    lock = threading.Lock()
+
+    @staticmethod
+    def get(pyPath, port):
+        '''Gets an idle worker for interpreter p_pyPath and LibreOffice
+           p_port, or starts a new one.'''
+        with ConverterWorker.lock:
+            idle = ConverterWorker.workers.get((pyPath, port))
+            if idle: return idle.pop()
+        return ConverterWorker(pyPath, port)
+
+    @staticmethod
+    def release(worker):
+        '''Puts p_worker back into the pool of idle workers.'''
+        with ConverterWorker.lock:
+            key = (worker.pyPath, worker.port)
+            ConverterWorker.workers.setdefault(key, []).append(worker)
+
+    @staticmethod
+    def stopAll():
+        '''Stops all idle workers. Called at exit.'''
+        with ConverterWorker.lock:
+            for workers in ConverterWorker.workers.values():
+                for worker in workers: worker.stop()
+            ConverterWorker.workers = {}
+
+    # Max number of seconds to wait for the answer to a conversion request
+    timeout = 120
+    # Max number of seconds to wait for a worker to stop, once its stdin is
+    # closed, before killing it.
+    stopTimeout = 10
+
+    def __init__(self, pyPath, port):
+        self.pyPath = pyPath
+        self.port = port
+        self.process = subprocess.Popen(
+            [pyPath, os.path.abspath(__file__.replace('.pyc', '.py')),
+             '--serve', '-p', str(port)], stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE, universal_newlines=True)
+        # The lines written by the process on its stdout are read by a thread
+        # and put in this queue, so that answers can be waited for with a
+        # timeout. None is put at the end of the output.
+        self.lines = queue.Queue()
+        reader = threading.Thread(target=self.read, daemon=True)
+        reader.start()
+
+    def read(self):
+        '''Reads, in a separate thread, the output of the worker process.'''
+        try:
+            for line in self.process.stdout: self.lines.put(line)
+        except (OSError, IOError, ValueError):
+            pass
+        self.lines.put(None)
+
+    def convert(self, docPath, resultType, templatePath=None):
+        '''Asks the worker process to convert p_docPath to p_resultType (that
+           may be a list of types). Raises a ConverterError if the conversion
+           fails. If the worker does not answer within self.timeout seconds, or
+           if its answer can't be understood, it is killed: it can't be reused
+           anymore.'''
+        request = {'doc': docPath, 'type': resultType,
+                   'template': templatePath}
+        try:
+            self.process.stdin.write(json.dumps(request) + '\n')
+            self.process.stdin.flush()
+            response = self.lines.get(timeout=self.timeout)
+        except (OSError, IOError):
+            response = None
+        except queue.Empty:
+            self.kill()
+            raise ConverterError(WORKER_TIMEOUT % (self.pyPath, self.timeout))
+        if not response:
+            # The process is dead
+            self.stop()
+            raise ConverterError(WORKER_DIED % (self.pyPath,
+                                                self.process.returncode))
+        try:
+            error = json.loads(response).get('error')
+        except (ValueError, AttributeError):
+            # Stray output: the protocol is desynchronised
+            self.kill()
+            raise ConverterError(WORKER_PROTOCOL % (self.pyPath,
+                                                    response.strip()))
+        if error: raise ConverterError(error)
+
+    def kill(self):
+        '''Kills the worker process, ie because it is hung.'''
+        if self.process.poll() is None: self.process.kill()
+        self.process.wait()
+
+    def stop(self):
+        '''Stops the worker process.'''
+        try:
+            self.process.stdin.close()
+        except (OSError, IOError):
+            pass
+        try:
+            self.process.wait(self.stopTimeout)
+        except subprocess.TimeoutExpired:
+            self.kill()
+
+atexit.register(ConverterWorker.stopAll)
+
+# ------------------------------------------------------------------------------
+class BatchConverter:
+    '''Converts many documents into p_resultType (a type or a list of types),
+       reusing the connection to LibreOffice between documents.
+
+       p_inputs is a list whose elements can be:
+       - the path to a document to convert;
+       - the path to a folder: all the files found in it (recursively) are
+         converted, excepted hidden files and files whose extension is one of
+         the result types (ie, the results of a previous run);
+       - the path to a manifest file, prefixed with "@": a text file listing
+         one document per line. Empty lines and lines starting with "#" are
+         ignored. Relative paths are relative to the manifest folder.
+
+       p_port may be a single port or a list of ports: in that case, there is
+       one LibreOffice instance running on every port, and as many documents as
+       ports are converted in parallel. p_port may also be a LoPool instance
+       (see appy.pod.lo_pool): documents are then dispatched on the instances of
+       the pool, that restarts them if they crash or hang.
+
+       If the current interpreter is not UNO-enabled, specify, in
+       p_pythonWithUnoPath, the path to an interpreter that is: conversions
+       will be performed by long-running workers (see ConverterWorker).
+
+       An error while converting a document does not stop the batch: m_run
+       yields a tuple (path, error) for every document, error being None if
+       the conversion succeeded.'''
+
+    def __init__(self, inputs, resultType, port=DEFAULT_PORT,
+                 templatePath=None, pythonWithUnoPath=None):
+        if isinstance(inputs, str): inputs = [inputs]
+        self.inputs = inputs
+        if isinstance(resultType, str): resultType = [resultType]
+        self.resultTypes = resultType
+        self.templatePath = templatePath
+        self.pyPath = pythonWithUnoPath
+        self.pool = None
+        if isinstance(port, int):
+            self.ports = [port]
+        elif isinstance(port, (list, tuple)):
+            self.ports = list(port)
+        else:
+            # A LoPool: run one conversion at a time per instance
+            self.pool = port
+            self.ports = [None] * len(port.instances)
+
+    def getPaths(self):
+        '''Yields the paths of the documents to convert, as found in
+           self.inputs.'''
+        for input in self.inputs:
+            if input.startswith('@'):
+                manifest = input[1:]
+                folder = os.path.dirname(os.path.abspath(manifest))
+                f = open(manifest, encoding='utf-8')
+                for line in f:
+                    line = line.strip()
+                    if not line or line.startswith('#'): continue
+                    yield os.path.join(folder, line)
+                f.close()
+            elif os.path.isdir(input):
+                for dir, dirnames, filenames in os.walk(input):
+                    dirnames.sort()
+                    for name in sorted(filenames):
+                        if name.startswith('.'): continue
+                        extension = os.path.splitext(name)[1][1:].lower()
+                        if extension in self.resultTypes: continue
+                        yield os.path.join(dir, name)
+            else:
+                yield input
+
+    def convert(self, path, port):
+        '''Converts the document at p_path with LibreOffice running on this
+           p_port. Returns None if the conversion succeeded, the error message
+           else.'''
+        try:
+            if self.pool:
+                self.pool.run(lambda port: self.convertOnPort(path, port))
+            else:
+                self.convertOnPort(path, port)
+        except ConverterError as ce:
+            return str(ce)
+        except Exception:
+            return traceback.format_exc()
+
+    def convertOnPort(self, path, port):
+        if not self.pyPath:
+            Converter(path, self.resultTypes, port, self.templatePath).run()
+            return
+        worker = ConverterWorker.get(self.pyPath, port)
+        try:
+            worker.convert(path, self.resultTypes, self.templatePath)
+        finally:
+            # A dead worker is not reused
+            if worker.process.returncode is None:
+                ConverterWorker.release(worker)
+
+    def run(self):
+        '''Converts all the documents. Yields a tuple (path, error) for every
+           document, as soon as it is converted.'''
+        if len(self.ports) == 1:
+            port = self.ports[0]
+            for path in self.getPaths():
+                yield path, self.convert(path, port)
+            return
+        # Run one thread per port. Paths are given to the threads via the
+        # "jobs" queue, that is bounded: the paths are not all computed
+        # upfront.
+        jobs = queue.Queue(2 * len(self.ports))
+        results = queue.Queue()
+        def work(port):
+            while True:
+                path = jobs.get()
+                if path is None: break
+                results.put((path, self.convert(path, port)))
+        threads = [threading.Thread(target=work, args=(port,), daemon=True) \
+                   for port in self.ports]
+        for thread in threads: thread.start()
+        pending = 0
+        for path in self.getPaths():
+            jobs.put(path)
+            pending += 1
+            while not results.empty():
+                pending -= 1
+                yield results.get()
+        for thread in threads: jobs.put(None)
+        while pending:
+            pending -= 1
+            yield results.get()
+        for thread in threads: thread.join()
 
 # ConverterScript-related messages ---------------------------------------------
 WRONG_NB_OF_ARGS = 'Wrong number of arguments.'
+BATCH_ERROR = '%s: %s\n'
+BATCH_SUMMARY = '%d/%d file(s) converted, %d error(s).'
 ERROR_CODE = 1
 
 # Class representing the command-line program ----------------------------------
 class ConverterScript:
-    usage = 'usage: python converter.py fileToConvert outputType [options]\n' \
+    usage = 'usage: python converter.py fileToConvert [fileToConvert...] ' \
+            'outputType [options]\n' \
             '   where fileToConvert is the absolute or relative pathname of\n' \
             '         the file you want to convert (or whose content like\n' \
-            '         indexes need to be refreshed);\n'\
+            '         indexes need to be refreshed). It may also be a folder\n' \
+            '         (all the files it contains are converted) or a\n' \
+            '         manifest file listing one file per line, prefixed with\n' \
+            '         "@". Errors are reported per file;\n'\
             '   and   outputType is the output format, that must be one of\n' \
-            '         %s.\n' \
+            '         %s. Several comma-separated formats may be given:\n' \
+            '         the document is then loaded once and saved in every\n' \
+            '         format.\n' \
             ' "python" should be a UNO-enabled Python interpreter (ie the ' \
-            '  one which is included in the LibreOffice distribution).' % \
-            str(list(FILE_TYPES.keys()))
+            '  one which is included in the LibreOffice distribution).\n' \
+            '       python converter.py --serve [options]\n' \
+            '   runs a worker reading conversion requests on stdin (see ' \
+            'ConverterScript.serve).' % str(list(FILE_TYPES.keys()))
+
+    def serve(self, port):
+        '''Runs this script as a worker, that performs conversions as long as
+           its stdin is open. Every request is a line containing a JSON object
+           with keys "doc" (the path to the document to convert), "type" (the
+           output type, or a list of output types) and, optionally, "template"
+           (the path to a LibreOffice template). For every request, a line
+           containing a JSON object is written on stdout once the conversion is
+           done: it is empty, or contains the error message at key "error".'''
+        while True:
+            line = sys.stdin.readline()
+            if not line: break
+            try:
+                request = json.loads(line)
+                Converter(request['doc'], request['type'], port,
+                          request.get('template')).run()
+                response = {}
+            except ConverterError:
+                response = {'error': str(sys.exc_info()[1])}
+            except Exception:
+                response = {'error': traceback.format_exc()}
+            sys.stdout.write(json.dumps(response) + '\n')
+            sys.stdout.flush()
+
     def run(self):
         optParser = OptionParser(usage=ConverterScript.usage)
         optParser.add_option("-p", "--port", dest="port",
                              help="The port on which LibreOffice runs " \
                              "Default is %d." % DEFAULT_PORT,
                              default=DEFAULT_PORT, metavar="PORT", type='int')
+        optParser.add_option("-n", "--instances", dest="instances",
+                             help="The number of LibreOffice instances, " \
+                             "running on ports PORT, PORT+1..., used for " \
+                             "converting several files in parallel. " \
+                             "Default is 1.", default=1, metavar="INSTANCES",
+                             type='int')
         optParser.add_option("-t", "--template", dest="template",
                              default=None, metavar="TEMPLATE", type='string',
                              help="The path to a LibreOffice template from " \
                                   "which you may import styles.")
+        optParser.add_option("-s", "--serve", dest="serve", default=False,
+                             action="store_true",
+                             help="Run as a worker, reading conversion " \
+                                  "requests on stdin.")
         (options, args) = optParser.parse_args()
-        if len(args) != 2:
+        if options.serve:
+            self.serve(options.port)
+            return
+        if len(args) < 2:
             sys.stderr.write(WRONG_NB_OF_ARGS)
             sys.stderr.write('\n')
             optParser.print_help()
             sys.exit(ERROR_CODE)
-        converter = Converter(args[0], args[1], options.port, options.template)
+        inputs = args[:-1]
+        if (len(inputs) > 1) or (options.instances > 1) or \
+           inputs[0].startswith('@') or os.path.isdir(inputs[0]):
+            self.runBatch(inputs, args[-1].split(','), options)
+            return
         try:
+            converter = Converter(args[0], args[1].split(','), options.port,
+                                  options.template)
             converter.run()
         except ConverterError:
             e = sys.exc_info()[1]
@@ -302,6 +670,20 @@ class ConverterScript:
             optParser.print_help()
             sys.exit(ERROR_CODE)
 
+    def runBatch(self, inputs, resultTypes, options):
+        '''Converts several files (see BatchConverter). Errors are written on
+           stderr, one per file.'''
+        ports = list(range(options.port, options.port + options.instances))
+        converter = BatchConverter(inputs, resultTypes, ports, options.template)
+        total = failed = 0
+        for path, error in converter.run():
+            total += 1
+            if error:
+                failed += 1
+                sys.stderr.write(BATCH_ERROR % (path, error.strip()))
+        print(BATCH_SUMMARY % (total - failed, total, failed))
+        if failed: sys.exit(ERROR_CODE)
+
 # ------------------------------------------------------------------------------
 if __name__ == '__main__':
     ConverterScript().run()
@@ -17,9 +17,12 @@
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,USA.
 
 # ------------------------------------------------------------------------------
-import os, os.path, time, shutil, struct, random, urllib.parse
+import os, os.path, io, time, shutil, struct, random, hashlib, urllib.parse
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
 from appy.pod import PodError
 from appy.pod.odf_parser import OdfEnvironment
+from appy.pod.odt_inliner import OdtInliner
 from appy.shared import mimeTypesExts
 from appy.shared.utils import FileWrapper
 from appy.shared.dav import Resource
@@ -57,10 +60,11 @@ class DocImporter:
         self.linkNs = self.ns[OdfEnvironment.NS_XLINK]
         self.drawNs = self.ns[OdfEnvironment.NS_DRAW]
         self.svgNs = self.ns[OdfEnvironment.NS_SVG]
-        self.tempFolder = renderer.tempFolder
+        self.tempFolder = renderer.getTempFolder()
         self.importFolder = self.getImportFolder()
         # Create the import folder if it does not exist.
-        if not os.path.exists(self.importFolder): os.mkdir(self.importFolder)
+        if not os.path.exists(self.importFolder):
+            os.makedirs(self.importFolder)
         self.importPath = self.getImportPath(at, format)
         # A link to the global fileNames dict (explained in renderer.py)
         self.fileNames = renderer.fileNames
@@ -75,11 +79,11 @@ class DocImporter:
             if isinstance(self.content, FileWrapper):
                 self.content.dump(self.importPath)
             else:
-                if isinstance(self.content, file):
+                if hasattr(self.content, 'read'):
                     fileContent = self.content.read()
                 else:
                     fileContent = self.content
-                f = file(self.importPath, 'wb')
+                f = open(self.importPath, 'wb')
                 f.write(fileContent)
                 f.close()
         # Some importers add specific attrs, through method init.
@@ -136,94 +140,294 @@ class OdtImporter(DocImporter):
         # Insert a page break before importing the doc if needed
         if self.pageBreakBefore: self.res += pageBreak
         # Import the external odt document
-        self.res += '<%s:section %s:name="PodImportSection%f">' \
-                    '<%s:section-source %s:href="%s" ' \
-                    '%s:filter-name="writer8"/></%s:section>' % (
-                        self.textNs, self.textNs, time.time(), self.textNs,
-                        self.linkNs, self.importPath, self.textNs, self.textNs)
+        self.res += self.getBody()
         # Insert a page break after importing the doc if needed
         if self.pageBreakAfter: self.res += pageBreak
         return self.res
 
-class PodImporter(DocImporter):
-    '''This class allows to import the result of applying another POD template,
-       into the current POD result.'''
-    def getImportFolder(self): return '%s/docImports' % self.tempFolder
+    def getKey(self):
+        '''Identifies the imported file without reading it: a file imported
+           several times is inlined with the same prefix (see OdtInliner).'''
+        stat = os.stat(self.importPath)
+        return (os.path.abspath(self.importPath), stat.st_mtime_ns,
+                stat.st_size)
+
+    def getBody(self):
+        '''Inlines the imported document when possible. Else, inserts a section
+           linking to it: LibreOffice will be called to resolve the link.'''
+        inliner = OdtInliner(self.renderer, self.importPath, self.getKey())
+        if inliner.canInline(): return inliner.run()
+        self.renderer.forceOoCall = True
+        return self.getSection()
 
+    def getSection(self):
+        '''Returns a section linking to the imported document'''
+        return '<%s:section %s:name="PodImportSection%f">' \
+               '<%s:section-source %s:href="%s" ' \
+               '%s:filter-name="writer8"/></%s:section>' % (
+                   self.textNs, self.textNs, time.time(), self.textNs,
+                   self.linkNs, self.importPath, self.textNs, self.textNs)
+
+class PodImporter(OdtImporter):
+    '''This class allows to import the result of applying another POD template,
+       into the current POD result. The sub-template is compiled once per main
+       rendering, and its content is rendered in memory and inlined into the
+       result, like an ODT document (see OdtImporter).'''
     def init(self, context, pageBreakBefore, pageBreakAfter):
         '''PodImporter-specific constructor.'''
         self.context = context
         self.pageBreakBefore = pageBreakBefore
         self.pageBreakAfter = pageBreakAfter
 
-    def run(self):
-        # Define where to store the pod result in the temp folder
+    def getRenderer(self, compiled, result):
+        '''Creates the renderer for rendering the sub-template'''
+        r = self.renderer
+        res = r.__class__(compiled, self.context, result,
+                          pythonWithUnoPath=r.pyPath, ooPort=r.ooPort,
+                          forceOoCall=r.forceOoCall,
+                          raiseOnError=r.raiseOnError,
+                          imageResolver=r.imageResolver,
+                          conversionCache=r.conversionCache)
+        res.stylesManager.stylesMapping = r.stylesManager.stylesMapping
+        res.compiledImports = r.compiledImports
+        return res
+
+    def getBody(self):
+        r = self.renderer
+        # Get the compiled sub-template (the POD template is in
+        # self.importPath). While being rendered, it is removed from the cache:
+        # a sub-template including itself gets its own compiled template.
+        key = self.getKey()
+        compiled = r.compiledImports.pop(key, None)
+        if not compiled:
+            from appy.pod.renderer import CompiledTemplate
+            compiled = CompiledTemplate(self.importPath)
+        try:
+            inliner = OdtInliner(r, io.BytesIO(compiled.data), key)
+            if inliner.canInline():
+                return self.inline(compiled, inliner)
+            # Render the sub-template as an ODT file, and link it
+            self.importPath = os.path.join(self.getImportFolder(),
+                                           '%s.odt' % self.getUuid())
+            self.getRenderer(compiled, self.importPath).run()
+            return OdtImporter.getBody(self)
+        finally:
+            r.compiledImports[key] = compiled
+
+    def inline(self, compiled, inliner):
+        '''Renders the content of the sub-template in memory and inlines it via
+           p_inliner.'''
         r = self.renderer
-        # Define where to store the ODT result.
-        op = os.path
-        resOdt = op.join(self.getImportFolder(), '%s.odt' % self.getUuid())
-        # The POD template is in self.importPath
-        renderer = r.__class__(self.importPath, self.context, resOdt,
-                               pythonWithUnoPath=r.pyPath,
-                               ooPort=r.ooPort, forceOoCall=r.forceOoCall,
-                               imageResolver=r.imageResolver)
-        renderer.stylesManager.stylesMapping = r.stylesManager.stylesMapping
-        renderer.run()
-        # The POD result is in "resOdt". Import it into the main POD result
-        # using an OdtImporter.
-        odtImporter = OdtImporter(None, resOdt, 'odt', self.renderer)
-        odtImporter.init(self.pageBreakBefore, self.pageBreakAfter)
-        return odtImporter.run()
+        renderer = self.getRenderer(compiled, None)
+        # The sub-renderer dumps files, and styles from documents it imports,
+        # directly into the main result.
+        renderer.tempFolder = r.getTempFolder()
+        renderer.fileNames = r.fileNames
+        renderer.imageHashes = r.imageHashes
+        renderer.importedStyles = r.importedStyles
+        renderer.importedStyleNames = inliner.getExistingStyles()
+        # Documents it inlines must get names being unique in the main result
+        renderer.inlinedDocs = r.inlinedDocs
+        renderer.inlinedKeys = r.inlinedKeys
+        content = io.StringIO()
+        renderer.renderFile(renderer.contentParser, renderer.contentContext,
+                            content)
+        r.inlinedDocs = renderer.inlinedDocs
+        content = content.getvalue().replace('<!DYNAMIC_STYLES!>',
+                                             ''.join(renderer.dynamicStyles))
+        # The sub-template may have linked documents that LibreOffice must
+        # merge.
+        if renderer.forceOoCall: r.forceOoCall = True
+        inliner.setContent(content.encode('utf-8'))
+        return inliner.run()
 
 class PdfImporter(DocImporter):
     '''This class allows to import the content of a PDF file into a pod
        template. It calls gs to split the PDF into images and calls the
-       ImageImporter for importing it into the result.'''
+       ImageImporter for importing it into the result.
+
+       Pages are rasterised at self.dpi dots per inch. If self.pages is given,
+       only these pages (numbered from 1) are imported. Pages are split into
+       ranges of pages, rasterised in parallel by at most self.maxWorkers
+       Ghostscript processes. If the renderer has a conversion cache, images
+       are cached, under a key computed from the PDF content, the dpi and the
+       page number: importing again the same PDF does not call gs.'''
+    dpi = 125
+    pages = None
+    # The cache keys of the images of the pages (see m_getKeys)
+    keys = None
+    # The maximum number of Ghostscript processes rasterising a PDF at once
+    maxWorkers = min(4, os.cpu_count() or 1)
+
     def getImportFolder(self): return '%s/docImports' % self.tempFolder
+
+    def init(self, dpi, pages):
+        '''PdfImporter-specific constructor.'''
+        self.dpi = dpi
+        self.pages = pages
+
+    def getPageCount(self):
+        '''Asks gs the number of pages of the PDF file. Returns None if it can
+           not be computed. gs runs in safe mode: the PostScript code can only
+           read the PDF file (this requires gs >= 9.50).'''
+        path = os.path.abspath(self.importPath)
+        escaped = path.replace('\\', '\\\\').replace('(', '\\(').\
+                  replace(')', '\\)')
+        cmd = ['gs', '-q', '-dNODISPLAY', '-dSAFER', '-dNOPAUSE', '-dBATCH',
+               '--permit-file-read=%s' % path, '-c',
+               '(%s) (r) file runpdfbegin pdfpagecount = quit' % escaped]
+        try:
+            output = subprocess.run(cmd, stdout=subprocess.PIPE,
+                                    stderr=subprocess.DEVNULL).stdout
+            return int(output.strip().split()[-1])
+        except (OSError, ValueError, IndexError):
+            return None
+
+    def getPages(self):
+        '''Gets the sorted list of the pages to import, or None if all pages
+           must be imported but their number is unknown.'''
+        if self.pages is not None: return sorted(set(self.pages))
+        count = self.getPageCount()
+        if count is None: return
+        return list(range(1, count+1))
+
+    def getRanges(self, pages):
+        '''Splits the list of p_pages into ranges of consecutive pages, as
+           (first, last) tuples. Ranges hold at most 1/self.maxWorkers of the
+           pages, so that up to self.maxWorkers ranges can be rasterised in
+           parallel. Non consecutive pages are in distinct ranges: importing
+           sparse pages produces one range per page, and thus one gs process
+           per page, but never more than self.maxWorkers at once (see
+           m_getImages).'''
+        size = max(1, -(-len(pages) // self.maxWorkers))
+        res = []
+        for page in pages:
+            if res and (page == res[-1][1] + 1) and \
+               (res[-1][1] - res[-1][0] + 1 < size):
+                res[-1][1] = page
+            else:
+                res.append([page, page])
+        return [tuple(r) for r in res]
+
+    def rasterise(self, first, last=None):
+        '''Calls gs for converting pages p_first to p_last (or to the last
+           page if p_last is None) into images. Returns a dict
+           ~{i_page: s_imagePath}~.'''
+        prefix = '%s.%d-' % (os.path.splitext(self.importPath)[0], first)
+        cmd = ['gs', '-q', '-dNOPAUSE', '-dBATCH', '-sDEVICE=jpeg',
+               '-r%dx%d' % (self.dpi, self.dpi), '-dFirstPage=%d' % first]
+        if last is not None: cmd.append('-dLastPage=%d' % last)
+        cmd += ['-sOutputFile=%s%%d.jpg' % prefix, self.importPath]
+        try:
+            subprocess.run(cmd, stdout=subprocess.DEVNULL,
+                           stderr=subprocess.DEVNULL)
+        except OSError:
+            return {}
+        res = {}
+        i = 1
+        while True:
+            path = '%s%d.jpg' % (prefix, i)
+            if not os.path.exists(path): break
+            res[first + i - 1] = path
+            i += 1
+        return res
+
+    def getCacheType(self, page):
+        return 'p%d.%ddpi.jpg' % (page, self.dpi)
+
+    def getKeys(self, pages):
+        '''Gets the keys under which the images of p_pages are cached. The PDF
+           file is hashed only once.'''
+        if self.keys is None:
+            cache = self.renderer.conversionCache
+            self.keys = cache.getKeys(self.importPath,
+                                      [self.getCacheType(p) for p in pages])
+        return self.keys
+
+    def getCached(self, pages, images):
+        '''Adds, to dict p_images, the cached images of p_pages. Returns the
+           pages that are not cached.'''
+        cache = self.renderer.conversionCache
+        keys = self.getKeys(pages)
+        prefix = os.path.splitext(self.importPath)[0]
+        res = []
+        for page in pages:
+            path = '%s.p%d.jpg' % (prefix, page)
+            if cache.get(keys[self.getCacheType(page)], path):
+                images[page] = path
+            else:
+                res.append(page)
+        return res
+
+    def setCached(self, pages, images):
+        '''Caches the p_images of p_pages'''
+        cache = self.renderer.conversionCache
+        pages = [p for p in pages if p in images]
+        if not pages: return
+        keys = self.getKeys(pages)
+        for page in pages:
+            cache.put(keys[self.getCacheType(page)], images[page])
+
+    def getImages(self):
+        '''Gets the images of the pages to import, from the cache or by
+           calling gs, as a dict ~{i_page: s_imagePath}~.'''
+        res = {}
+        pages = self.getPages()
+        cache = self.renderer.conversionCache
+        if pages is None:
+            # The number of pages is unknown: rasterise all pages with a
+            # single gs process.
+            res = self.rasterise(1)
+            missing = sorted(res.keys())
+        else:
+            missing = pages
+            if cache: missing = self.getCached(pages, res)
+            ranges = self.getRanges(missing)
+            if len(ranges) > 1:
+                workers = min(len(ranges), self.maxWorkers)
+                with ThreadPoolExecutor(workers) as executor:
+                    for images in executor.map(lambda r: self.rasterise(*r),
+                                               ranges):
+                        res.update(images)
+            elif ranges:
+                res.update(self.rasterise(*ranges[0]))
+        if cache: self.setCached(missing, res)
+        return res
+
     def run(self):
-        imagePrefix = os.path.splitext(os.path.basename(self.importPath))[0]
-        # Split the PDF into images with Ghostscript
-        imagesFolder = os.path.dirname(self.importPath)
-        cmd = 'gs -dNOPAUSE -dBATCH -sDEVICE=jpeg -r125x125 ' \
-              '-sOutputFile=%s/%s%%d.jpg %s' % \
-              (imagesFolder, imagePrefix, self.importPath)
-        os.system(cmd)
+        images = self.getImages()
         # Check that at least one image was generated
-        succeeded = False
-        firstImage = '%s1.jpg' % imagePrefix
-        for fileName in os.listdir(imagesFolder):
-            if fileName == firstImage:
-                succeeded = True
-                break
-        if not succeeded: raise PodError(PDF_TO_IMG_ERROR)
+        if not images: raise PodError(PDF_TO_IMG_ERROR)
         # Insert images into the result.
-        noMoreImages = False
-        i = 0
-        while not noMoreImages:
-            i += 1
-            nextImage = '%s/%s%d.jpg' % (imagesFolder, imagePrefix, i)
-            if os.path.exists(nextImage):
-                # Use internally an Image importer for doing this job.
-                imgImporter= ImageImporter(None, nextImage, 'jpg',self.renderer)
-                imgImporter.init('paragraph', True, None, None, None)
-                self.res += imgImporter.run()
-                os.remove(nextImage)
-            else:
-                noMoreImages = True
+        for page in sorted(images.keys()):
+            # Use internally an Image importer for doing this job.
+            imgImporter = ImageImporter(None, images[page], 'jpg',
+                                        self.renderer)
+            imgImporter.init('paragraph', True, None, None, None)
+            self.res += imgImporter.run()
+            os.remove(images[page])
         return self.res
 
 class ConvertImporter(DocImporter):
     '''This class allows to import the content of any file that LibreOffice (LO)
        can convert into PDF: doc, rtf, xls. It first calls LO to convert the
        document into PDF, then calls a PdfImporter.'''
+    dpi = PdfImporter.dpi
+    pages = None
     def getImportFolder(self): return '%s/docImports' % self.tempFolder
+    def init(self, dpi, pages):
+        '''ConvertImporter-specific constructor: p_dpi and p_pages are passed
+           to the PdfImporter.'''
+        self.dpi = dpi
+        self.pages = pages
     def run(self):
         # Convert the document into PDF with LibreOffice
         output = self.renderer.callLibreOffice(self.importPath, 'pdf')
         if output: raise PodError(TO_PDF_ERROR % output)
-        pdfFile = '%s.pdf' % os.path.splitext(self.importPath)[0]
+        pdfFile = self.renderer.getConvertedName(self.importPath, 'pdf')
         # Launch a PdfImporter to import this PDF into the POD result.
         pdfImporter = PdfImporter(None, pdfFile, 'pdf', self.renderer)
+        pdfImporter.init(self.dpi, self.pages)
         return pdfImporter.run()
 
 # Compute size of images -------------------------------------------------------
@@ -234,7 +438,7 @@ def getSize(filePath, fileType):
     x, y = (None, None)
     # Get fileType from filePath if not given.
     if not fileType: fileType = os.path.splitext(filePath)[1][1:]
-    f = file(filePath, 'rb')
+    f = open(filePath, 'rb')
     if fileType in jpgTypes:
         # Dummy read to skip header ID
         f.read(2)
@@ -255,7 +459,7 @@ def getSize(filePath, fileType):
     elif fileType == 'png':
         # Dummy read to skip header data
         f.read(12)
-        if f.read(4) == "IHDR":
+        if f.read(4) == b'IHDR':
             x, y = struct.unpack("!LL", f.read(8))
     elif fileType == 'gif':
         imgType = f.read(6)
@@ -275,19 +479,53 @@ class ImageImporter(DocImporter):
     anchorTypes = ('page', 'paragraph', 'char', 'as-char')
     WRONG_ANCHOR = 'Wrong anchor. Valid values for anchors are: %s.'
     pictFolder = '%sPictures%s' % (os.sep, os.sep)
+    # The SHA-1 hash of the image content
+    hash = None
+    # The size of the chunks read when hashing an image
+    chunkSize = 65536
+
+    def __init__(self, content, at, format, renderer):
+        DocImporter.__init__(self, content, at, format, renderer)
+        self.store()
+
     def getImportFolder(self):
         return os.path.join(self.tempFolder, 'unzip', 'Pictures')
 
+    def getHash(self, path):
+        '''Returns the SHA-1 hash of the content of the file at p_path'''
+        res = hashlib.sha1()
+        f = open(path, 'rb')
+        while True:
+            chunk = f.read(self.chunkSize)
+            if not chunk: break
+            res.update(chunk)
+        f.close()
+        return res.hexdigest()
+
+    def store(self):
+        '''Images are stored in the result under a name based on the hash of
+           their content. If an image with the same content was already
+           imported, the file dumped for this import is removed and the
+           existing one is used instead.'''
+        hashes = self.renderer.imageHashes
+        if self.hash is None:
+            self.hash = self.getHash(self.importPath)
+            if self.hash in hashes: os.remove(self.importPath)
+        if self.hash in hashes:
+            self.importPath = hashes[self.hash]
+            return
+        ext = os.path.splitext(self.importPath)[1]
+        path = os.path.join(self.importFolder, self.hash + ext)
+        os.replace(self.importPath, path)
+        self.importPath = hashes[self.hash] = path
+
     def moveFile(self, at, importPath):
         '''Copies file at p_at into the ODT file at p_importPath.'''
-        # Has this image already been imported ?
-        for imagePath, imageAt in self.fileNames.items():
-            if imageAt == at:
-                # Yes!
-                i = importPath.rfind(self.pictFolder) + 1
-                return importPath[:i] + imagePath
-        # The image has not already been imported: copy it.
         if not at.startswith('http'):
+            # Has this image already been imported ?
+            self.hash = self.getHash(at)
+            res = self.renderer.imageHashes.get(self.hash)
+            if res: return res
             shutil.copy(at, importPath)
             return importPath
         # The image must be retrieved via a URL. Try to perform a HTTP GET.
@@ -296,7 +534,7 @@ class ImageImporter(DocImporter):
             # At last, I can get the file format.
             self.format = mimeTypesExts[response.headers['Content-Type']]
             importPath += self.format
-            f = file(importPath, 'wb')
+            f = open(importPath, 'wb')
             f.write(response.body)
             f.close()
             return importPath
@@ -313,10 +551,10 @@ class ImageImporter(DocImporter):
             img = os.path.join(podFolder, 'imageNotFound.jpg')
             self.format = 'jpg'
             importPath += self.format
-            f = file(img)
+            f = open(img, 'rb')
             imageContent = f.read()
             f.close()
-            f = file(importPath, 'wb')
+            f = open(importPath, 'wb')
             f.write(imageContent)
             f.close()
         else:
@@ -366,7 +604,6 @@ class ImageImporter(DocImporter):
         # Compute path to image
         i = self.importPath.rfind(self.pictFolder)
         imagePath = self.importPath[i+1:].replace('\\', '/')
-        self.fileNames[imagePath] = self.at
         # In the case of SVG files, perform an image conversion to PNG
         if imagePath.endswith('.svg'):
             newImportPath = os.path.splitext(self.importPath)[0] + '.png'
@@ -375,8 +612,10 @@ class ImageImporter(DocImporter):
                 raise Exception(CONVERT_ERROR)
             os.remove(self.importPath)
             self.importPath = newImportPath
+            self.renderer.imageHashes[self.hash] = newImportPath
             imagePath = os.path.splitext(imagePath)[0] + '.png'
             self.format = 'png'
+        self.fileNames[imagePath] = self.at
         # Retrieve image size from self.size
         width = height = None
         if self.size and (self.sizeUnit != 'pc'):
@@ -20,6 +20,30 @@ from appy.shared.xml_parser import XmlElement
 from appy.pod.odf_parser import OdfEnvironment as ns
 from appy.pod import PodError
 
+# ------------------------------------------------------------------------------
+# Process-wide cache of compiled Python expressions: ~{s_source: code}~. It
+# allows expressions having the same source to share their code object.
+codeCache = {}
+# When this number of compiled expressions is reached, the cache is emptied
+MAX_CACHED_CODES = 10000
+
+def getCode(expr):
+    '''Returns the code object corresponding to Python expression p_expr.
+       Expressions are compiled when the template is parsed: their code object
+       is stored on the element or action using it. If p_expr can't be
+       compiled, p_expr itself is returned: eval will raise the SyntaxError
+       when the expression is evaluated, like any other evaluation error.'''
+    res = codeCache.get(expr)
+    if res is None:
+        try:
+            # Like eval, ignore leading blanks
+            res = compile(expr.lstrip(' \t'), '<string>', 'eval')
+        except (SyntaxError, ValueError):
+            return expr
+        if len(codeCache) >= MAX_CACHED_CODES: codeCache.clear()
+        codeCache[expr] = res
+    return res
+
 # ------------------------------------------------------------------------------
 class PodElement:
     OD_TO_POD = {'p': 'Text', 'h': 'Title', 'section': 'Section',
@@ -99,6 +123,9 @@ class Expression(PodElement):
     def __init__(self, py, pod):
         # Extract parts from expression p_py.
         self.escapeXml, self.expr, self.errorExpr = self.extractInfo(py.strip())
+        # The compiled expressions
+        self.code = getCode(self.expr)
+        self.errorCode = self.errorExpr and getCode(self.errorExpr)
         self.pod = pod # True if I work for pod, False if I work for px.
         if self.pod:
             # pod-only: store here the expression's true result (before being
@@ -118,11 +145,11 @@ class Expression(PodElement):
            evaluate it if self.expr raises an error.'''
         if self.errorExpr:
             try:
-                res = eval(self.expr, context)
+                res = eval(self.code, context)
             except Exception:
-                res = eval(self.errorExpr, context)
+                res = eval(self.errorCode, context)
         else:
-            res = eval(self.expr, context)
+            res = eval(self.code, context)
         return res
 
     def evaluate(self, context):
@@ -146,14 +173,11 @@ class Expression(PodElement):
             if self.pod: self.result = res
         # Converts the expr result to a string that can be inserted in the
         # pod/px result.
-        resultType = res.__class__.__name__
-        if resultType == 'NoneType':
+        if res is None:
             res = ''
-        elif resultType == 'str':
+        elif isinstance(res, str):
             pass
-        elif resultType == 'unicode':
-            pass # Don't perform any conversion, unicode is the target type.
-        elif resultType == 'Px':
+        elif res.__class__.__name__ == 'Px':
             # A PX that must be called within the current PX. Call it with the
             # current context.
             res = res(context, applyTemplate=False)
@@ -167,7 +191,7 @@ class Attributes(PodElement):
     '''Represents a bunch of XML attributes that will be dumped for a given tag
        in the result. pod-only.'''
     OD = None
-    floatTypes = ('int', 'long', 'float')
+    floatTypes = (int, float)
     dateTypes = ('DateTime',)
 
     def __init__(self, env):
@@ -182,15 +206,15 @@ class Attributes(PodElement):
         '''p_expr has been evaluated: its result is in expr.result. Depending
            on its type, we will dump the corresponding attributes in
            self.attrs.'''
-        exprType = expr.result.__class__.__name__
+        res = expr.result
         tags = self.env.tags
         attrs = self.attrs
-        if exprType in self.floatTypes:
+        if type(res) in self.floatTypes:
             attrs[tags['value-type']] = 'float'
-            attrs[tags['value']] = str(expr.result)
-        elif exprType in self.dateTypes:
+            attrs[tags['value']] = str(res)
+        elif res.__class__.__name__ in self.dateTypes:
             attrs[tags['value-type']] = 'date'
-            attrs[tags['value']] = expr.result.strftime('%Y-%m-%d')
+            attrs[tags['value']] = res.strftime('%Y-%m-%d')
         else:
             attrs[tags['value-type']] = 'string'
 
@@ -222,9 +246,11 @@ class Attribute(PodElement):
         self.name = name
         # The expression that will compute the attribute value
         self.expr = expr.strip()
+        self.code = getCode(self.expr)
 
     def evaluate(self, context):
         # If the expr evaluates to False, we do not dump the attribute at all.
-        if eval(self.expr, context): return ' %s="%s"' % (self.name, self.name)
+        if eval(self.code, context):
+            return ' %s="%s"' % (self.name, self.name)
         return ''
 # ------------------------------------------------------------------------------
@@ -0,0 +1,590 @@
+# ------------------------------------------------------------------------------
+# Appy is a framework for building applications in the Python language.
+# Copyright (C) 2007 Gaetan Delannay
+
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,USA.
+
+# ------------------------------------------------------------------------------
+import csv, base64, mimetypes, zipfile, xml.sax, xml.parsers.expat
+from xml.sax.handler import ContentHandler, feature_namespaces
+from xml.sax.saxutils import escape
+
+from appy.pod.odf_parser import OdfEnvironment
+from appy.pod.odt_inliner import OdfCopier, NamesCollector
+
+# ------------------------------------------------------------------------------
+NS_OFFICE = OdfEnvironment.NS_OFFICE
+NS_STYLE = OdfEnvironment.NS_STYLE
+NS_TEXT = OdfEnvironment.NS_TEXT
+NS_TABLE = OdfEnvironment.NS_TABLE
+NS_DRAW = OdfEnvironment.NS_DRAW
+NS_FO = OdfEnvironment.NS_FO
+NS_XLINK = OdfEnvironment.NS_XLINK
+NS_SVG = OdfEnvironment.NS_SVG
+
+# Elements whose content is never exported
+ignoredElements = ((NS_OFFICE, 'annotation'), (NS_TEXT, 'note'),
+                   (NS_TEXT, 'tracked-changes'), (NS_TEXT, 'sequence-decls'),
+                   (NS_TEXT, 'variable-decls'), (NS_TEXT, 'user-field-decls'),
+                   (NS_OFFICE, 'forms'), (NS_SVG, 'title'), (NS_SVG, 'desc'),
+                   (NS_TABLE, 'shapes'))
+# Elements containing text. Elsewhere, character data is whitespace between
+# elements, that is not part of the document content.
+textElements = ((NS_TEXT, 'p'), (NS_TEXT, 'h'))
+
+# ------------------------------------------------------------------------------
+class OdfExporter(ContentHandler):
+    '''Exports the content.xml of an ODF document (the result of a rendering)
+       to another format, without LibreOffice. The document is parsed by a SAX
+       parser: the result is written while being produced.'''
+    # The type of ODF documents this exporter can export
+    inputType = None
+    # The types this exporter can produce
+    resultTypes = ()
+
+    def __init__(self, document):
+        # p_document is the path to the ODF document
+        self.document = document
+        # The path to the current element, as a list of (uri, name) tuples
+        self.path = []
+        # Depth of the ignored element being currently walked, if any
+        self.ignoreDepth = None
+        # Are we in the body of the document ?
+        self.inBody = False
+        # The number of paragraphs or headings being currently walked
+        self.inText = 0
+
+    def parse(self):
+        zipFile = zipfile.ZipFile(self.document)
+        self.zipFile = zipFile
+        f = zipFile.open('content.xml')
+        parser = xml.sax.make_parser()
+        parser.setFeature(feature_namespaces, True)
+        parser.setContentHandler(self)
+        try:
+            parser.parse(f)
+        finally:
+            f.close()
+            zipFile.close()
+
+    def startElementNS(self, name, qname, attrs):
+        self.path.append(name)
+        if name in textElements: self.inText += 1
+        if self.ignoreDepth is not None: return
+        if name in ignoredElements:
+            self.ignoreDepth = len(self.path)
+        elif name == (NS_OFFICE, 'body'):
+            self.inBody = True
+        elif self.inBody:
+            self.start(name, attrs)
+        else:
+            self.startHead(name, attrs)
+
+    def endElementNS(self, name, qname):
+        depth = len(self.path)
+        self.path.pop()
+        if name in textElements: self.inText -= 1
+        if self.ignoreDepth is not None:
+            if self.ignoreDepth == depth: self.ignoreDepth = None
+        elif name == (NS_OFFICE, 'body'):
+            self.inBody = False
+        elif self.inBody:
+            self.end(name)
+
+    def characters(self, content):
+        if (self.ignoreDepth is None) and self.inBody and self.inText:
+            self.text(content)
+
+    # To be overridden
+    def startHead(self, name, attrs):
+        '''Called for elements before the body (ie, automatic styles)'''
+    def start(self, name, attrs): pass
+    def end(self, name): pass
+    def text(self, content): pass
+
+    def getSpaces(self, attrs):
+        '''Gets the number of spaces represented by a text:s tag'''
+        return int(attrs.get((NS_TEXT, 'c'), 1))
+
+# ------------------------------------------------------------------------------
+class OdtToText(OdfExporter):
+    '''Exports an ODT document to plain text. Every paragraph or heading
+       produces a line.'''
+    inputType = 'odt'
+    resultTypes = ('txt',)
+
+    def run(self, f):
+        '''Writes the text into p_f, a text file'''
+        self.f = f
+        self.parse()
+
+    def start(self, name, attrs):
+        if name[0] != NS_TEXT: return
+        if name[1] == 's':
+            self.f.write(' ' * self.getSpaces(attrs))
+        elif name[1] == 'tab':
+            self.f.write('\t')
+        elif name[1] == 'line-break':
+            self.f.write('\n')
+
+    def end(self, name):
+        if name in ((NS_TEXT, 'p'), (NS_TEXT, 'h')): self.f.write('\n')
+
+    def text(self, content):
+        self.f.write(content)
+
+# ------------------------------------------------------------------------------
+class OdtToHtml(OdfExporter):
+    '''Exports an ODT document to simple HTML: headings, paragraphs, lists,
+       tables, links and images (embedded as data URIs). Bold, italic and
+       underlined text is rendered when it comes from the automatic styles of
+       paragraphs, headings or spans.'''
+    inputType = 'odt'
+    resultTypes = ('html', 'htm')
+    # ODF elements converted to HTML elements
+    tags = {(NS_TEXT, 'p'): 'p', (NS_TEXT, 'list'): 'ul',
+            (NS_TEXT, 'list-item'): 'li', (NS_TEXT, 'list-header'): 'li',
+            (NS_TABLE, 'table'): 'table', (NS_TABLE, 'table-row'): 'tr',
+            (NS_TABLE, 'table-header-rows'): 'thead'}
+    # HTML elements rendering text properties
+    properties = (((NS_FO, 'font-weight'), 'bold', 'b'),
+                  ((NS_FO, 'font-style'), 'italic', 'i'),
+                  ((NS_STYLE, 'text-underline-style'), None, 'u'))
+
+    def __init__(self, document):
+        OdfExporter.__init__(self, document)
+        # The HTML tags to apply to the text of every automatic style
+        self.textStyles = {}
+        self.currentStyle = None
+        # The HTML end tags to dump when reaching the end of the current ODF
+        # elements.
+        self.ends = []
+
+    def run(self, f, title=''):
+        '''Writes the HTML page into p_f, a text file'''
+        self.f = f
+        f.write('<!DOCTYPE html>\n<html><head><meta charset="utf-8"/>'
+                '<title>%s</title></head><body>' % escape(title))
+        self.parse()
+        f.write('</body></html>\n')
+
+    def startHead(self, name, attrs):
+        if len(self.path) == 3:
+            # A direct child of office:automatic-styles
+            self.currentStyle = (name == (NS_STYLE, 'style')) and \
+                                attrs.get((NS_STYLE, 'name')) or None
+        elif (name == (NS_STYLE, 'text-properties')) and self.currentStyle:
+            tags = []
+            for attr, value, tag in self.properties:
+                actual = attrs.get(attr)
+                if not actual: continue
+                if (value and (actual == value)) or \
+                   (not value and (actual != 'none')):
+                    tags.append(tag)
+            if tags: self.textStyles[self.currentStyle] = tags
+
+    def start(self, name, attrs):
+        f = self.f
+        end = ''
+        if name in self.tags:
+            tag = self.tags[name]
+            f.write('<%s>' % tag)
+            end = '</%s>' % tag
+            if name == (NS_TEXT, 'p'): end = self.startStyle(attrs) + end
+        elif name == (NS_TEXT, 'h'):
+            level = int(attrs.get((NS_TEXT, 'outline-level'), 1))
+            level = min(max(level, 1), 6)
+            f.write('<h%d>' % level)
+            end = self.startStyle(attrs) + '</h%d>' % level
+        elif name == (NS_TABLE, 'table-cell'):
+            f.write('<td%s>' % self.getSpans(attrs))
+            end = '</td>'
+        elif name == (NS_TEXT, 'span'):
+            end = self.startStyle(attrs)
+        elif name == (NS_TEXT, 'a'):
+            f.write('<a href="%s">' % \
+                    escape(attrs.get((NS_XLINK, 'href'), ''), {'"': '&quot;'}))
+            end = '</a>'
+        elif name == (NS_TEXT, 's'):
+            f.write('&#160;' * self.getSpaces(attrs))
+        elif name == (NS_TEXT, 'tab'):
+            f.write('\t')
+        elif name == (NS_TEXT, 'line-break'):
+            f.write('<br/>')
+        elif name == (NS_DRAW, 'image'):
+            f.write(self.getImage(attrs.get((NS_XLINK, 'href'), '')))
+        self.ends.append(end)
+
+    def startStyle(self, attrs):
+        '''Writes the HTML tags rendering the automatic style of the current
+           element, whose p_attrs are given, and returns the end tags.'''
+        tags = self.textStyles.get(attrs.get((NS_TEXT, 'style-name')), ())
+        self.f.write(''.join(['<%s>' % tag for tag in tags]))
+        return ''.join(['</%s>' % tag for tag in reversed(tags)])
+
+    def getSpans(self, attrs):
+        res = ''
+        for attr, html in (('columns', 'colspan'), ('rows', 'rowspan')):
+            span = attrs.get((NS_TABLE, 'number-%s-spanned' % attr))
+            if span and (span != '1'): res += ' %s="%s"' % (html, span)
+        return res
+
+    def getImage(self, href):
+        '''Gets the "img" tag for the image at p_href. An image stored in the
+           document is embedded as a data URI.'''
+        if href.startswith('./'): href = href[2:]
+        if href in self.zipFile.namelist():
+            mimeType = mimetypes.guess_type(href)[0] or \
+                       'application/octet-stream'
+            data = base64.b64encode(self.zipFile.read(href)).decode('ascii')
+            href = 'data:%s;base64,%s' % (mimeType, data)
+        return '<img src="%s"/>' % escape(href, {'"': '&quot;'})
+
+    def end(self, name):
+        self.f.write(self.ends.pop())
+
+    def text(self, content):
+        self.f.write(escape(content))
+
+# ------------------------------------------------------------------------------
+class OdsToCsv(OdfExporter):
+    '''Exports the sheets of an ODS document to CSV, one file per sheet. Cells
+       hold their text, as displayed. Trailing empty cells and rows, and empty
+       sheets, are not exported. Like when LibreOffice exports a sheet (see
+       converter.py), cells are separated by semicolons.'''
+    inputType = 'ods'
+    resultTypes = ('csv',)
+    # The CSV dialect
+    delimiter = ';'
+    quotechar = '"'
+
+    def __init__(self, document):
+        OdfExporter.__init__(self, document)
+        # The writer for the current sheet, None if it was not created yet (the
+        # sheet being empty so far), or False if the sheet is not exported.
+        self.writer = False
+        # The current row and its repetition count, the current cell and its
+        # repetition count, and the text of the current cell.
+        self.row = self.rowRepeat = None
+        self.cellRepeat = None
+        self.cell = None
+        # The number of pending empty rows: they are written only if a non
+        # empty row follows.
+        self.emptyRows = 0
+        # The index and name of the current sheet
+        self.sheet = -1
+        self.sheetName = None
+
+    def run(self, getFile):
+        '''Exports every sheet into the text file returned by
+           p_getFile(i_index, s_sheetName). This function is called when the
+           first row of the sheet must be written: it is not called for empty
+           sheets. If it returns None, the sheet is not exported. Returns the
+           number of sheets.'''
+        self.getFile = getFile
+        self.parse()
+        return self.sheet + 1
+
+    def start(self, name, attrs):
+        if name[0] == NS_TABLE:
+            if name[1] == 'table':
+                if len(self.path) != 4: return
+                # A new sheet
+                self.sheet += 1
+                self.sheetName = attrs.get((NS_TABLE, 'name'))
+                self.writer = None
+                self.emptyRows = 0
+            elif self.writer is False:
+                return
+            elif name[1] == 'table-row':
+                self.row = []
+                self.rowRepeat = int(attrs.get((NS_TABLE,
+                                               'number-rows-repeated'), 1))
+            elif name[1] in ('table-cell', 'covered-table-cell'):
+                self.cell = []
+                self.cellRepeat = int(attrs.get((NS_TABLE,
+                                                'number-columns-repeated'), 1))
+        elif (self.cell is not None) and (name[0] == NS_TEXT):
+            if (name[1] == 'p') and (len(self.cell) > 0):
+                # Paragraphs within a cell are separated by a carriage return
+                self.cell.append('\n')
+            elif name[1] == 's':
+                self.cell.append(' ' * self.getSpaces(attrs))
+            elif name[1] == 'tab':
+                self.cell.append('\t')
+            elif name[1] == 'line-break':
+                self.cell.append('\n')
+
+    def end(self, name):
+        if (name[0] != NS_TABLE) or (self.writer is False): return
+        if name[1] in ('table-cell', 'covered-table-cell'):
+            self.row.extend([''.join(self.cell)] * self.cellRepeat)
+            self.cell = None
+        elif name[1] == 'table-row':
+            self.endRow()
+        elif (name[1] == 'table') and (len(self.path) == 3):
+            self.writer = False
+
+    def endRow(self):
+        row = self.row
+        self.row = None
+        # Remove trailing empty cells
+        while row and not row[-1]: row.pop()
+        if not row:
+            self.emptyRows += self.rowRepeat
+            return
+        if self.writer is None:
+            f = self.getFile(self.sheet, self.sheetName)
+            self.writer = f and csv.writer(f, delimiter=self.delimiter,
+                            quotechar=self.quotechar, lineterminator='\n')
+            if not self.writer:
+                self.writer = False
+                return
+        for i in range(self.emptyRows): self.writer.writerow(())
+        self.emptyRows = 0
+        for i in range(self.rowRepeat): self.writer.writerow(row)
+
+    def text(self, content):
+        if self.cell is not None: self.cell.append(content)
+
+# ------------------------------------------------------------------------------
+class StopParsing(Exception): pass
+
+class FlatCopier(OdfCopier):
+    '''Copies, from a file of an ODF document, the children of its root
+       element whose names are in p_parts, into p_f, a text file.
+       ~{s_name: b_whole}~: if "whole" is False, the children of the element
+       are copied, but not the element itself. Pictures stored in the document
+       are embedded as base64-encoded binary data. Styles are renamed
+       according to p_styleNames (see OdfCopier).'''
+    # Elements that may embed binary data instead of linking to a file
+    binaryElements = ((NS_DRAW, 'image'), (NS_DRAW, 'fill-image'),
+                      (NS_STYLE, 'background-image'))
+
+    def __init__(self, exporter, parts, stopAt=None, styleNames=None):
+        OdfCopier.__init__(self, exporter.namespaces, styleNames or {},
+                           lambda href: href)
+        self.exporter = exporter
+        self.parts = parts
+        # Parsing stops at the start of the child of the root element named
+        # p_stopAt.
+        self.stopAt = stopAt
+
+    def getTarget(self):
+        path = self.path
+        if (len(path) < 2) or (path[1][0] != NS_OFFICE): return
+        whole = self.parts.get(path[1][1])
+        if whole is None: return
+        if whole or (len(path) > 2): return self.exporter
+
+    def startElementNS(self, name, qname, attrs):
+        if (len(self.path) == 1) and (name == (NS_OFFICE, self.stopAt)):
+            raise StopParsing()
+        if (len(self.path) == 2) and (self.path[1] == (NS_OFFICE,
+                                                       'font-face-decls')):
+            # Font faces defined in several files are copied only once
+            fontName = attrs.get((NS_STYLE, 'name'))
+            if fontName in self.exporter.fonts:
+                self.path.append(name)
+                if self.skipDepth is None: self.skipDepth = len(self.path)
+                return
+            self.exporter.fonts.add(fontName)
+        href = attrs.get((NS_XLINK, 'href'))
+        if (name in self.binaryElements) and href and \
+           self.exporter.isStored(href):
+            # Remove the link: the data will be embedded instead
+            attrs = dict([(k, v) for k, v in attrs.items() \
+                          if k[0] != NS_XLINK])
+            OdfCopier.startElementNS(self, name, qname, attrs)
+            if (self.skipDepth is None) and (self.res is not None):
+                self.exporter.dumpBinary(href)
+            return
+        OdfCopier.startElementNS(self, name, qname, attrs)
+
+    def parse(self, f):
+        parser = xml.sax.make_parser()
+        parser.setFeature(feature_namespaces, True)
+        parser.setContentHandler(self)
+        try:
+            parser.parse(f)
+        except StopParsing:
+            pass
+
+class OdtToFlat:
+    '''Exports an ODT document to a flat ODT document (.fodt), being a single
+       XML file: its meta data, settings, styles and content are stitched
+       under a "office:document" root element, and its pictures are embedded
+       as base64-encoded data. The document is streamed: it is never
+       completely held in memory. Embedded objects (charts, formulas...) are
+       not exported.
+
+       The automatic styles of styles.xml and content.xml may have the same
+       names: like LibreOffice does, those from styles.xml are prefixed with
+       "M", and so are the references to them.'''
+    inputType = 'odt'
+    resultTypes = ('fodt',)
+    # The size of the chunks of pictures to encode at once. It is a multiple
+    # of 57, the number of bytes encoded on a line of base64 data.
+    chunkSize = 57 * 1024
+    # The files of the document, and the children of their root elements to
+    # export, in the order they must appear in the result. ~{s_name: b_whole}~
+    # (see FlatCopier).
+    files = (('meta.xml', {'meta': True}), ('settings.xml', {'settings': True}))
+
+    def __init__(self, document):
+        self.document = document
+        self.zipFile = None
+        self.names = None
+        # The namespace prefixes of the result, ~{s_uri: s_prefix}~
+        self.namespaces = {}
+        self.f = None
+        # The names of the font faces already exported
+        self.fonts = set()
+
+    def append(self, text):
+        self.f.write(text)
+
+    def isStored(self, href):
+        if href.startswith('./'): href = href[2:]
+        return href in self.names
+
+    def dumpBinary(self, href):
+        '''Dumps the file at p_href as base64-encoded binary data'''
+        if href.startswith('./'): href = href[2:]
+        office = self.namespaces[NS_OFFICE]
+        self.f.write('<%s:binary-data>' % office)
+        f = self.zipFile.open(href)
+        while True:
+            chunk = f.read(self.chunkSize)
+            if not chunk: break
+            self.f.write(base64.encodebytes(chunk).decode('ascii'))
+        f.close()
+        self.f.write('</%s:binary-data>' % office)
+
+    def getRoot(self, name):
+        '''Gets the attributes of the root element of the file having this
+           p_name.'''
+        res = {}
+        def start(name, attrs):
+            res.update(attrs)
+            raise StopParsing()
+        parser = xml.parsers.expat.ParserCreate()
+        parser.StartElementHandler = start
+        f = self.zipFile.open(name)
+        try:
+            while True:
+                chunk = f.read(4096)
+                if not chunk: break
+                parser.Parse(chunk)
+        except StopParsing:
+            pass
+        finally:
+            f.close()
+        return res
+
+    def getNamespaces(self, names):
+        '''Gets the namespaces declared by the root elements of the files
+           having these p_names. A prefix being used for several URIs is
+           renamed.'''
+        prefixes = set(self.namespaces.values())
+        for name in names:
+            for attr, value in self.getRoot(name).items():
+                if not attr.startswith('xmlns:') or \
+                   (value in self.namespaces): continue
+                prefix = attr[6:]
+                i = 1
+                while prefix in prefixes:
+                    prefix = '%s%d' % (attr[6:], i)
+                    i += 1
+                prefixes.add(prefix)
+                self.namespaces[value] = prefix
+
+    def getStyleNames(self):
+        '''Gets the new names of the automatic styles from styles.xml,
+           ~{s_name: s_newName}~.'''
+        collector = NamesCollector()
+        parser = xml.sax.make_parser()
+        parser.setFeature(feature_namespaces, True)
+        parser.setContentHandler(collector)
+        f = self.zipFile.open('styles.xml')
+        try:
+            parser.parse(f)
+        finally:
+            f.close()
+        return dict([(name, 'M' + name) for name in collector.names])
+
+    def copy(self, name, parts, stopAt=None, styleNames=None):
+        f = self.zipFile.open(name)
+        try:
+            FlatCopier(self, parts, stopAt, styleNames).parse(f)
+        finally:
+            f.close()
+
+    def run(self, f):
+        '''Writes the flat document into p_f, a text file'''
+        self.f = f
+        self.zipFile = zipFile = zipfile.ZipFile(self.document)
+        self.names = set(zipFile.namelist())
+        try:
+            files = [n for n, parts in self.files if n in self.names]
+            self.getNamespaces(['content.xml', 'styles.xml'] + files)
+            # Dump the root element
+            office = self.namespaces[NS_OFFICE]
+            attrs = ''.join([' xmlns:%s="%s"' % (prefix, uri) for uri, prefix \
+                             in sorted(self.namespaces.items(),
+                                       key=lambda i: i[1])])
+            version = self.getRoot('content.xml').get('office:version')
+            if version: attrs += ' %s:version="%s"' % (office, version)
+            mimeType = zipFile.read('mimetype').decode('ascii').strip()
+            f.write('<?xml version="1.0" encoding="UTF-8"?>\n<%s:document%s '
+                    '%s:mimetype="%s">' % (office, attrs, office, mimeType))
+            for name, parts in self.files:
+                if name in self.names: self.copy(name, parts)
+            self.copy('content.xml', {'scripts': True}, stopAt='body')
+            # Font faces and automatic styles come from styles.xml and
+            # content.xml.
+            styleNames = self.getStyleNames()
+            for part in ('font-face-decls', 'styles', 'automatic-styles',
+                         'master-styles'):
+                whole = part in ('styles', 'master-styles')
+                if not whole: f.write('<%s:%s>' % (office, part))
+                # Common styles can't refer to automatic styles
+                renamed = part in ('automatic-styles', 'master-styles')
+                self.copy('styles.xml', {part: whole},
+                          styleNames=renamed and styleNames or None)
+                if not whole:
+                    self.copy('content.xml', {part: False}, stopAt='body')
+                    f.write('</%s:%s>' % (office, part))
+            self.copy('content.xml', {'body': True})
+            f.write('</%s:document>\n' % office)
+        finally:
+            zipFile.close()
+
+class OdsToFlat(OdtToFlat):
+    '''Exports an ODS document to a flat ODS document (.fods)'''
+    inputType = 'ods'
+    resultTypes = ('fods',)
+
+# ------------------------------------------------------------------------------
+exporters = (OdtToText, OdtToHtml, OdsToCsv, OdtToFlat, OdsToFlat)
+
+def getExporter(inputType, resultType):
+    '''Gets the exporter class that can export a document of p_inputType
+       to p_resultType, or None if there is no such exporter.'''
+    for exporter in exporters:
+        if (exporter.inputType == inputType) and \
+           (resultType in exporter.resultTypes):
+            return exporter
+# ------------------------------------------------------------------------------
@@ -0,0 +1,262 @@
+# ------------------------------------------------------------------------------
+# Appy is a framework for building applications in the Python language.
+# Copyright (C) 2007 Gaetan Delannay
+
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,USA.
+
+# ------------------------------------------------------------------------------
+import os, os.path, time, socket, shutil, tempfile, threading, subprocess
+import atexit, pathlib
+
+from appy.pod.converter import Connection, ConverterError, DEFAULT_PORT
+
+# ------------------------------------------------------------------------------
+START_ERROR = 'LibreOffice (%s) could not be started on port %d.'
+TIMEOUT_ERROR = 'LibreOffice on port %d did not answer within %d seconds. It ' \
+                'was killed, and will be restarted.'
+
+# ------------------------------------------------------------------------------
+class LoInstance:
+    '''A headless LibreOffice (soffice) process, launched and supervised by a
+       LoPool. Every instance listens on its own port and uses its own user
+       profile, so that instances do not interfere.'''
+    # Max number of seconds to wait for soffice to listen on its port
+    startTimeout = 60
+
+    def __init__(self, pool, port):
+        self.pool = pool
+        self.port = port
+        self.process = None
+        self.profile = None # The folder containing the user profile
+        # The number of conversions currently running on this instance
+        self.busy = 0
+        # The number of conversions performed since the instance was started
+        self.jobs = 0
+        # Is the instance being checked or restarted ? If so, no conversion
+        # can be dispatched to it.
+        self.restarting = False
+        # Must the instance be restarted as soon as no conversion runs on it
+        # anymore (ie, because one of them timed out) ?
+        self.stale = False
+
+    def start(self):
+        '''Launches soffice and waits until it listens on its port. The
+           process launched by a previous call, if any, is stopped before.'''
+        self.stop()
+        self.profile = tempfile.mkdtemp(prefix='pod.lo.%d.' % self.port)
+        profileUrl = pathlib.Path(self.profile).as_uri()
+        self.process = subprocess.Popen([self.pool.sofficePath, '--headless',
+          '--invisible', '--nologo', '--nodefault', '--norestore',
+          '--nolockcheck', '-env:UserInstallation=%s' % profileUrl,
+          '--accept=socket,host=localhost,port=%d;urp;' % self.port],
+          stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+          stderr=subprocess.DEVNULL)
+        self.jobs = 0
+        end = time.time() + self.startTimeout
+        while time.time() < end:
+            if self.process.poll() is not None: break
+            if self.listens(): return
+            time.sleep(0.2)
+        self.stop()
+        raise ConverterError(START_ERROR % (self.pool.sofficePath, self.port))
+
+    def listens(self):
+        '''Does soffice accept connections on its port ?'''
+        try:
+            s = socket.create_connection(('localhost', self.port), 1)
+            s.close()
+            return True
+        except (OSError, IOError):
+            return False
+
+    def isAlive(self):
+        '''Is soffice running and listening on its port ?'''
+        return self.process and (self.process.poll() is None) and \
+               self.listens()
+
+    def kill(self):
+        '''Kills the soffice process, ie because it is hung.'''
+        if self.process and (self.process.poll() is None):
+            self.process.kill()
+
+    def stop(self):
+        '''Stops the soffice process and removes its profile.'''
+        if self.process:
+            if self.process.poll() is None:
+                self.process.terminate()
+                try:
+                    self.process.wait(10)
+                except subprocess.TimeoutExpired:
+                    self.process.kill()
+                    self.process.wait()
+            self.process = None
+        if self.profile:
+            shutil.rmtree(self.profile, ignore_errors=True)
+            self.profile = None
+        # Forget the UNO connection to this instance, if any
+        Connection.reset(self.port)
+
+    def restart(self):
+        self.stop()
+        self.start()
+
+# ------------------------------------------------------------------------------
+class LoPool:
+    '''Launches and supervises p_size headless LibreOffice instances, listening
+       on ports p_firstPort, p_firstPort+1... Conversions are dispatched to the
+       least busy instance (see m_run).
+
+       A conversion lasting more than p_timeout seconds is considered hung: the
+       instance is killed and restarted. An instance that crashed is restarted
+       before being used. After p_maxJobs conversions, an instance is restarted
+       as well, in order to contain LibreOffice memory leaks.
+
+       A pool can be given to the Renderer (or to function renderAsync), as
+       parameter "ooPort", or to an AsyncConverter, as parameter "ports".'''
+
+    def __init__(self, size=None, sofficePath='soffice', firstPort=DEFAULT_PORT,
+                 timeout=120, maxJobs=200):
+        if size is None: size = os.cpu_count() or 1
+        self.sofficePath = sofficePath
+        self.timeout = timeout
+        self.maxJobs = maxJobs
+        self.instances = [LoInstance(self, firstPort + i) for i in range(size)]
+        # Protects the state of instances, and notifies threads waiting for an
+        # instance to be restarted.
+        self.lock = threading.Condition()
+        self.started = False
+        # Is a thread currently starting the pool ?
+        self.starting = False
+        atexit.register(self.stop)
+
+    def start(self):
+        '''Launches all instances. If one of them can't be started, all are
+           stopped.'''
+        try:
+            for instance in self.instances: instance.start()
+        except Exception:
+            self.stop()
+            raise
+        self.started = True
+
+    def stop(self):
+        '''Stops all instances.'''
+        for instance in self.instances: instance.stop()
+        self.started = False
+
+    def ensureStarted(self):
+        '''Starts the pool if it was not. The pool is started outside the
+           lock, so that other threads may meanwhile use the pool's instances
+           they have acquired. Threads needing the pool while it is being
+           started wait for it.'''
+        with self.lock:
+            while self.starting: self.lock.wait()
+            if self.started: return
+            self.starting = True
+        try:
+            self.start()
+        finally:
+            with self.lock:
+                self.starting = False
+                self.lock.notify_all()
+
+    def acquire(self):
+        '''Chooses the least busy instance and ensures it is alive and not worn
+           out. The pool is started if it was not. Instances being restarted,
+           or waiting to be, are not chosen: if all are, this method waits
+           until one of them is available.'''
+        self.ensureStarted()
+        with self.lock:
+            while True:
+                available = [i for i in self.instances if not i.restarting]
+                if not available:
+                    self.lock.wait()
+                    continue
+                instance = min(available, key=lambda i: (i.busy, i.jobs))
+                if not instance.busy or (instance.jobs < self.maxJobs): break
+                # This instance is worn out but still in use: it will be
+                # restarted when released. Choose another one.
+                instance.restarting = instance.stale = True
+            instance.busy += 1
+            # If nobody else is using it, it is checked and restarted if
+            # needed. Meanwhile, it is not available to other threads.
+            check = instance.busy == 1
+            if check: instance.restarting = True
+        if check:
+            try:
+                if (instance.jobs >= self.maxJobs) or not instance.isAlive():
+                    instance.restart()
+            except Exception:
+                self.release(instance, done=False)
+                raise
+            finally:
+                self.setAvailable(instance)
+        return instance
+
+    def setAvailable(self, instance):
+        '''Makes p_instance available again, once checked or restarted.'''
+        with self.lock:
+            instance.restarting = False
+            self.lock.notify_all()
+
+    def release(self, instance, done=True):
+        '''Releases p_instance, once the conversion it was acquired for is
+           p_done. If it must be restarted, it is restarted by the last thread
+           releasing it.'''
+        with self.lock:
+            instance.busy -= 1
+            if done: instance.jobs += 1
+            restart = instance.stale and not instance.busy
+            if restart: instance.stale = False
+        if restart:
+            try:
+                instance.restart()
+            finally:
+                self.setAvailable(instance)
+
+    def expire(self, instance):
+        '''Called when a conversion on p_instance timed out: p_instance is
+           killed, and restarted once released by all its users.'''
+        with self.lock:
+            # No more conversion can be dispatched to this instance
+            instance.restarting = True
+            instance.stale = True
+        instance.kill()
+
+    def run(self, function):
+        '''Calls p_function with, as unique arg, the port of the least busy
+           instance. p_function must perform the conversion. If it lasts more
+           than self.timeout seconds, the instance is killed and a
+           ConverterError is raised. The instance is restarted once the other
+           conversions running on it, if any, are finished.'''
+        instance = self.acquire()
+        timedOut = threading.Event()
+        def onTimeout():
+            timedOut.set()
+            self.expire(instance)
+        watchdog = threading.Timer(self.timeout, onTimeout)
+        watchdog.start()
+        error = None
+        try:
+            res = function(instance.port)
+        except Exception as e:
+            error = e
+        watchdog.cancel()
+        self.release(instance)
+        if timedOut.is_set():
+            raise ConverterError(TIMEOUT_ERROR % (instance.port, self.timeout))
+        if error: raise error
+        return res
+# ------------------------------------------------------------------------------
@@ -0,0 +1,386 @@
+# ------------------------------------------------------------------------------
+# Appy is a framework for building applications in the Python language.
+# Copyright (C) 2007 Gaetan Delannay
+
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,USA.
+
+# ------------------------------------------------------------------------------
+import os, os.path, re, io, hashlib, zipfile, xml.sax
+from xml.sax.handler import ContentHandler, feature_namespaces
+from xml.sax.saxutils import escape
+
+from appy.pod.odf_parser import OdfEnvironment
+from appy.shared.utils import Rope
+
+# ------------------------------------------------------------------------------
+NS_OFFICE = OdfEnvironment.NS_OFFICE
+NS_STYLE = OdfEnvironment.NS_STYLE
+NS_TEXT = OdfEnvironment.NS_TEXT
+NS_DRAW = OdfEnvironment.NS_DRAW
+NS_XLINK = OdfEnvironment.NS_XLINK
+NS_NUMBER = OdfEnvironment.NS_NUMBER
+NS_TABLE = OdfEnvironment.NS_TABLE
+
+# Elements from the body of an imported document that are not copied: they
+# declare document-wide variables or forms, and may only appear at the start of
+# the result body.
+skippedBodyElements = ('sequence-decls', 'variable-decls', 'user-field-decls',
+                       'dde-connection-decls', 'forms')
+# Elements that can't be inlined natively: the imported document is then
+# linked, and LibreOffice merges it (see OdtInliner.canInline).
+embeddedElements = ('object', 'object-ole')
+# Attributes naming frames, shapes, tables and sections, that must be unique
+# within the result: they are prefixed when a document is inlined.
+# ~{(s_elementUri, s_elementName): (s_attrUri, s_attrName)}~
+namedElements = {(NS_TABLE, 'table'): (NS_TABLE, 'name'),
+                 (NS_TEXT, 'section'): (NS_TEXT, 'name')}
+drawNames = ((NS_DRAW, 'name'), (NS_DRAW, 'chain-next-name'))
+
+# ------------------------------------------------------------------------------
+class OdfCopier(ContentHandler):
+    '''SAX handler that copies the parts of an ODF file that must be inlined
+       into the result, using the namespace prefixes of the result
+       (p_namespaces, ~{s_uri: s_prefix}~). Elements and attributes whose
+       namespace is unknown to the result (ie, LibreOffice extensions) are
+       ignored.
+
+       Style names found in p_styleNames (~{s_name: s_newName}~) are renamed.
+       Relative links to files in the imported document are converted via
+       p_getHref.'''
+
+    def __init__(self, namespaces, styleNames, getHref):
+        self.namespaces = namespaces
+        self.styleNames = styleNames
+        self.getHref = getHref
+        # The path to the current element, as a list of (uri, name) tuples
+        self.path = []
+        # Depth of the element being currently skipped, if any
+        self.skipDepth = None
+        # The current output, if the current element must be copied
+        self.res = None
+
+    def getTarget(self):
+        '''Returns the Rope where to dump the current element, or None if it
+           must not be copied. To be overridden.'''
+
+    def getName(self, uri, name):
+        if not uri: return name
+        prefix = self.namespaces.get(uri)
+        if prefix is None: return None
+        return '%s:%s' % (prefix, name)
+
+    def getAttributes(self, uri, name, attrs):
+        res = ''
+        for (attrUri, attrName), value in attrs.items():
+            qName = self.getName(attrUri, attrName)
+            if not qName: continue
+            if attrName.endswith('style-name') or \
+               (attrName == 'page-layout-name') or \
+               ((attrName == 'name') and (attrUri == NS_STYLE)):
+                value = self.styleNames.get(value, value)
+            elif (attrUri == NS_XLINK) and (attrName == 'href'):
+                value = self.getHref(value)
+            res += ' %s="%s"' % (qName, escape(value, {'"': '&quot;'}))
+        return res
+
+    def startElementNS(self, name, qname, attrs):
+        uri, local = name
+        self.path.append(name)
+        if self.skipDepth is not None: return
+        self.res = self.getTarget()
+        if self.res is None: return
+        qName = self.getName(uri, local)
+        if not qName:
+            self.skipDepth = len(self.path)
+            return
+        self.res.append('<%s%s>' % (qName, self.getAttributes(uri, local,
+                                                              attrs)))
+
+    def endElementNS(self, name, qname):
+        if self.skipDepth is not None:
+            if self.skipDepth == len(self.path): self.skipDepth = None
+        elif self.res is not None:
+            self.res.append('</%s>' % self.getName(*name))
+        self.path.pop()
+        self.res = self.path and self.getTarget() or None
+
+    def characters(self, content):
+        if (self.skipDepth is None) and (self.res is not None):
+            self.res.append(escape(content))
+
+    def parse(self, content):
+        parser = xml.sax.make_parser()
+        parser.setFeature(feature_namespaces, True)
+        parser.setContentHandler(self)
+        parser.parse(io.BytesIO(content))
+
+# ------------------------------------------------------------------------------
+class ContentCopier(OdfCopier):
+    '''Copies the automatic styles and the body of content.xml. Every
+       automatic style is copied apart, in self.styles, as a tuple
+       (s_element, s_family, s_name, Rope). The names of frames, shapes,
+       tables and sections found in the body are prefixed with p_prefix.'''
+    def __init__(self, namespaces, styleNames, getHref, prefix):
+        OdfCopier.__init__(self, namespaces, styleNames, getHref)
+        self.prefix = prefix
+        self.styles = []
+        self.body = Rope()
+
+    def getAttributes(self, uri, name, attrs):
+        if self.path[1] == (NS_OFFICE, 'body'):
+            named = namedElements.get((uri, name))
+            renamed = [k for k in attrs.keys() \
+                       if (k in drawNames) or (k == named)]
+            if renamed:
+                attrs = dict(attrs.items())
+                for k in renamed: attrs[k] = self.prefix + attrs[k]
+        return OdfCopier.getAttributes(self, uri, name, attrs)
+
+    def startElementNS(self, name, qname, attrs):
+        if (len(self.path) == 2) and \
+           (self.path[1] == (NS_OFFICE, 'automatic-styles')):
+            self.styles.append((name[1], attrs.get((NS_STYLE, 'family')),
+                                attrs.get((NS_STYLE, 'name')), Rope()))
+        OdfCopier.startElementNS(self, name, qname, attrs)
+
+    def getTarget(self):
+        path = self.path
+        if len(path) < 2: return
+        if path[1] == (NS_OFFICE, 'automatic-styles'):
+            if len(path) > 2: return self.styles[-1][3]
+        elif path[1] == (NS_OFFICE, 'body'):
+            # Copy the children of office:text, excepted declarations
+            if (len(path) > 3) and (path[2] == (NS_OFFICE, 'text')) and \
+               (path[3][1] not in skippedBodyElements):
+                return self.body
+
+class StylesCopier(OdfCopier):
+    '''Copies, from styles.xml, the common styles (paragraph, text, list and
+       data styles) whose names are not in p_existing.'''
+    def __init__(self, namespaces, existing, getHref):
+        OdfCopier.__init__(self, namespaces, {}, getHref)
+        self.existing = existing
+        self.styles = Rope()
+        # Is the current style (a child of office:styles) to be copied ?
+        self.copying = False
+
+    def startElementNS(self, name, qname, attrs):
+        if (len(self.path) == 2) and (self.path[1] == (NS_OFFICE, 'styles')):
+            styleName = attrs.get((NS_STYLE, 'name'))
+            self.copying = bool(styleName) and \
+                           (styleName not in self.existing) and \
+                           ((name[1] in ('style', 'list-style')) or \
+                            (name[0] == NS_NUMBER))
+            if self.copying: self.existing.add(styleName)
+        OdfCopier.startElementNS(self, name, qname, attrs)
+
+    def getTarget(self):
+        if (len(self.path) > 2) and (self.path[1] == (NS_OFFICE, 'styles')) \
+           and self.copying:
+            return self.styles
+
+# ------------------------------------------------------------------------------
+class NamesCollector(ContentHandler):
+    '''Collects the names of the automatic styles defined in content.xml and
+       checks if the document contains embedded objects.'''
+    def __init__(self):
+        self.names = []
+        self.embedded = False
+        self.depth = 0
+        self.inAutomaticStyles = False
+
+    def startElementNS(self, name, qname, attrs):
+        self.depth += 1
+        if name == (NS_OFFICE, 'automatic-styles'):
+            self.inAutomaticStyles = True
+        elif self.inAutomaticStyles and (self.depth == 3):
+            styleName = attrs.get((NS_STYLE, 'name'))
+            if styleName: self.names.append(styleName)
+        elif (name[0] == NS_DRAW) and (name[1] in embeddedElements):
+            self.embedded = True
+
+    def endElementNS(self, name, qname):
+        self.depth -= 1
+        if name == (NS_OFFICE, 'automatic-styles'):
+            self.inAutomaticStyles = False
+
+# ------------------------------------------------------------------------------
+class OdtInliner:
+    '''Inlines the content of an ODT document (at p_path) into the result of
+       p_renderer, without calling LibreOffice:
+       - the body of its content.xml is inlined, the names of its frames,
+         tables and sections being prefixed, so that they remain unique;
+       - its automatic styles are renamed (so they can't clash with those from
+         the result) and added to the automatic styles of the result;
+       - its common styles that are not defined in the result are added to
+         the result's styles.xml;
+       - its pictures are copied into the result, once (see m_getHref).
+       Documents containing embedded objects (charts, formulas...) can't be
+       inlined (see m_canInline).
+
+       A document identified by a p_key may be inlined several times (ie, a
+       sub-template imported via function "pod" in a loop): it gets the same
+       prefix every time, and its automatic styles are added to the result
+       only once, as long as they do not change.'''
+    stylesNameRex = '%s:name="([^"]*)"'
+
+    def __init__(self, renderer, document, key=None):
+        # p_document is the path to the ODT document or a file-like object
+        self.renderer = renderer
+        zipFile = zipfile.ZipFile(document)
+        self.zipFile = zipFile
+        self.names = set(zipFile.namelist())
+        self.key = key
+        # The new paths of the files copied from the document (see m_getHref)
+        self.hrefs = {}
+        # content.xml is parsed on demand (see m_setContent)
+        self.contentXml = self.collector = None
+        # The prefix for renaming automatic styles
+        self.prefix = None
+
+    def setContent(self, contentXml):
+        '''Sets p_contentXml (bytes) as the content.xml to inline'''
+        self.contentXml = contentXml
+        collector = NamesCollector()
+        parser = xml.sax.make_parser()
+        parser.setFeature(feature_namespaces, True)
+        parser.setContentHandler(collector)
+        parser.parse(io.BytesIO(contentXml))
+        self.collector = collector
+
+    def canInline(self):
+        '''Embedded objects are stored in sub-folders of the document, whose
+           content must be declared in the manifest: such documents can't be
+           inlined natively. Documents can only be inlined into content.xml.'''
+        r = self.renderer
+        if r.currentParser != r.contentParser: return False
+        # Was this document already inlined, or found to be not inlinable ?
+        if self.key in r.inlinedKeys: return bool(r.inlinedKeys[self.key])
+        self.setContent(self.zipFile.read('content.xml'))
+        if self.collector.embedded:
+            if self.key: r.inlinedKeys[self.key] = None
+            return False
+        return True
+
+    def getPrefix(self):
+        '''Gets a new prefix for renaming styles, frames, tables...'''
+        r = self.renderer
+        r.inlinedDocs += 1
+        return 'Pod%d_' % r.inlinedDocs
+
+    def getHref(self, href):
+        '''Copies the file at p_href, if it is a file from the imported
+           document, and returns its new path in the result. Like images
+           imported via m_importDocument, files are stored under a name based
+           on the hash of their content: a file found in several documents, or
+           in a document inlined several times, is stored only once.'''
+        name = href
+        if name.startswith('./'): name = name[2:]
+        if name not in self.names: return href
+        if name in self.hrefs: return self.hrefs[name]
+        r = self.renderer
+        data = self.zipFile.read(name)
+        hash = hashlib.sha1(data).hexdigest()
+        path = r.imageHashes.get(hash)
+        if not path:
+            folder = os.path.join(r.getTempFolder(), 'unzip', 'Pictures')
+            if not os.path.isdir(folder): os.makedirs(folder)
+            path = os.path.join(folder, hash + os.path.splitext(name)[1])
+            f = open(path, 'wb')
+            f.write(data)
+            f.close()
+            r.imageHashes[hash] = path
+        res = self.hrefs[name] = 'Pictures/%s' % os.path.basename(path)
+        r.fileNames[res] = path
+        return res
+
+    def getExistingStyles(self):
+        '''Returns the names of the common styles defined in the result.'''
+        r = self.renderer
+        if r.importedStyleNames is None:
+            # Styles from the template, and styles added by POD
+            from appy.pod.renderer import STYLES_POD_STYLES
+            nsStyle = r.stylesParser.env.namespaces[NS_STYLE]
+            rex = re.compile(self.stylesNameRex % nsStyle)
+            names = set(rex.findall(r.stylesXml))
+            rex = re.compile(self.stylesNameRex % '@style@')
+            names.update(rex.findall(STYLES_POD_STYLES))
+            # Styles from the styles template
+            if r.stylesMerger: names.update(r.stylesMerger.getStyleNames())
+            r.importedStyleNames = names
+        return r.importedStyleNames
+
+    def copyContent(self, prefix):
+        '''Copies the body and automatic styles of self.contentXml. Returns the
+           body, and the list of automatic styles, as tuples (id, xml). The id
+           of a style is None if it is unnamed; else, it is a tuple
+           (s_element, s_family, s_newName) identifying the style within the
+           result. Frames, tables... in the body are renamed with p_prefix.'''
+        r = self.renderer
+        # Styles that were already added to the result, from a previous
+        # inlining of this document, but with another definition, get a prefix
+        # of their own.
+        renamed = {}
+        ownPrefix = None
+        while True:
+            styleNames = {}
+            for name in self.collector.names:
+                styleNames[name] = renamed.get(name) or (self.prefix + name)
+            copier = ContentCopier(r.contentParser.env.namespaces, styleNames,
+                                   self.getHref, prefix)
+            copier.parse(self.contentXml)
+            styles = []
+            clashes = []
+            for element, family, name, xml in copier.styles:
+                id = name and (element, family, styleNames.get(name, name))
+                xml = str(xml)
+                styles.append((id, xml))
+                if id and (r.inlinedStyles.get(id, xml) != xml) and \
+                   (name not in renamed):
+                    clashes.append(name)
+            if not clashes: return str(copier.body), styles
+            # Renaming these styles may change the definition of the styles
+            # referring to them: copy the content again.
+            ownPrefix = ownPrefix or self.getPrefix()
+            for name in clashes: renamed[name] = ownPrefix + name
+
+    def run(self):
+        '''Returns the body of the imported document, as a string. Its styles
+           are added to the renderer, and its pictures to the result.'''
+        r = self.renderer
+        if not self.collector:
+            self.setContent(self.zipFile.read('content.xml'))
+        # Was this document already inlined ?
+        first = not r.inlinedKeys.get(self.key)
+        self.prefix = r.inlinedKeys.get(self.key) or self.getPrefix()
+        if self.key: r.inlinedKeys[self.key] = self.prefix
+        # Frames, tables... get unique names, even if the document was already
+        # inlined.
+        res, styles = self.copyContent(first and self.prefix or \
+                                       self.getPrefix())
+        for id, xml in styles:
+            if id:
+                if id in r.inlinedStyles: continue
+                r.inlinedStyles[id] = xml
+            r.dynamicStyles.append(xml)
+        # Common styles from styles.xml are added to the result only once
+        if first and ('styles.xml' in self.names):
+            copier = StylesCopier(r.stylesParser.env.namespaces,
+                                  self.getExistingStyles(), self.getHref)
+            copier.parse(self.zipFile.read('styles.xml'))
+            r.importedStyles.append(str(copier.styles))
+        self.zipFile.close()
+        return res
+# ------------------------------------------------------------------------------
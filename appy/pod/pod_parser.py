@@ -17,7 +17,7 @@
 # ------------------------------------------------------------------------------
 import re
 from appy.shared.xml_parser import XmlElement
-from appy.pod.buffers import FileBuffer, MemoryBuffer
+from appy.pod.buffers import TemplateBuffer, MemoryBuffer
 from appy.pod.odf_parser import OdfEnvironment, OdfParser
 from appy.pod.elements import *
 
@@ -111,7 +111,7 @@ class PodEnvironment(OdfEnvironment):
         self.tags = None
         # When an error occurs, must we raise it or write it into he current
         # buffer?
-        self.raiseOnError = None # Will be initialized by PodParser.__init__
+        self.raiseOnError = None # Will be initialized by the renderer
 
     def getTable(self):
         '''Gets the currently parsed table.'''
@@ -229,12 +229,8 @@ class PodEnvironment(OdfEnvironment):
 
 # ------------------------------------------------------------------------------
 class PodParser(OdfParser):
-    def __init__(self, env, caller):
-        OdfParser.__init__(self, env, caller)
-        env.raiseOnError = caller.raiseOnError
-
     def endDocument(self):
-        self.env.currentBuffer.content.close()
+        self.env.currentBuffer.close()
 
     def startElement(self, elem, attrs):
         e = OdfParser.startElement(self, elem, attrs)
@@ -339,11 +335,10 @@ class PodParser(OdfParser):
                                 parent.removeLastSubBuffer()
                                 e.currentBuffer = parent
                             else:
-                                if isinstance(parent, FileBuffer):
-                                    # Execute buffer action and delete the
-                                    # buffer.
-                                    e.currentBuffer.action.execute(parent,
-                                                                   e.context)
+                                if isinstance(parent, TemplateBuffer):
+                                    # Record the buffer, whose action will be
+                                    # executed at rendering time.
+                                    parent.addBuffer(e.currentBuffer)
                                     parent.removeLastSubBuffer()
                                 e.currentBuffer = parent
                             e.mode = e.ADD_IN_SUBBUFFER
@@ -17,28 +17,35 @@
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,USA.
 
 # ------------------------------------------------------------------------------
-import zipfile, shutil, xml.sax, os, os.path, re, mimetypes, time
+import zipfile, shutil, xml.sax, os, os.path, re, mimetypes, io, copy
+import tempfile, threading
 from collections import UserDict
 
 import appy.pod
 from appy.pod import PodError
 from appy.shared import mimeTypes, mimeTypesExts
 from appy.shared.xml_parser import XmlElement
-from appy.shared.zip import unzip, zip
-from appy.shared.utils import FolderDeleter, executeCommand, FileWrapper
+from appy.shared.zip import unzip, zip, StreamedEntry, copyRawEntry
+from appy.shared.utils import FolderDeleter, FileWrapper, \
+                              getOsTempFolder
 from appy.pod.pod_parser import PodParser, PodEnvironment, OdInsert
 from appy.pod.converter import FILE_TYPES
-from appy.pod.buffers import FileBuffer
+from appy.pod.lo_pool import LoPool
+from appy.pod.buffers import FileBuffer, TemplateBuffer
 from appy.pod.xhtml2odt import Xhtml2OdtConverter
 from appy.pod.doc_importers import \
      OdtImporter, ImageImporter, PdfImporter, ConvertImporter, PodImporter
 from appy.pod.styles_manager import StylesManager
+from appy.pod.toc import TocRefresher
+from appy.pod.styles_merger import StylesMerger
+from appy.pod.exporters import getExporter, OdtToHtml, OdsToCsv
 
 # ------------------------------------------------------------------------------
 BAD_CONTEXT = 'Context must be either a dict, a UserDict or an instance.'
 RESULT_FILE_EXISTS = 'Result file "%s" exists.'
 CANT_WRITE_RESULT = 'I cannot write result file "%s". %s'
 CANT_WRITE_TEMP_FOLDER = 'I cannot create temp folder "%s". %s'
+FOLDER_NOT_WRITABLE = 'Folder "%s" does not exist or is not writable.'
 NO_PY_PATH = 'Extension of result file is "%s". In order to perform ' \
              'conversion from ODT to this format we need to call LibreOffice. ' \
              'But the Python interpreter which runs the current script does ' \
@@ -51,9 +58,6 @@ NO_PY_PATH = 'Extension of result file is "%s". In order to perform ' \
 PY_PATH_NOT_FILE = '"%s" is not a file. You must here specify the absolute ' \
                    'path of a Python interpreter (.../python, .../python.sh, ' \
                    '.../python.exe, .../python.bat...).'
-BLANKS_IN_PATH = 'Blanks were found in path "%s". Please use the DOS-names ' \
-                 '(ie, "progra~1" instead of "Program files" or "docume~1" ' \
-                 'instead of "Documents and settings".'
 BAD_RESULT_TYPE = 'Result "%s" has a wrong extension. Allowed extensions ' \
                   'are: "%s".'
 CONVERT_ERROR = 'An error occurred during the conversion. %s'
@@ -94,6 +98,99 @@ OBSOLETE_RENDER_TEXT = 'Obsolete function. Use a pod expression instead ' \
                        '(field or track-changed). Now, a pod expression ' \
                        'handles carriage returns and tabs correctly.'
 
+# ------------------------------------------------------------------------------
+class CompiledTemplate:
+    '''A POD template (ODT or ODS) that was unzipped and parsed once for all.
+       Unzipping the template, SAX-parsing content.xml and styles.xml, parsing
+       POD statements and analysing the template styles are done here, when
+       creating the instance. The compiled template can then be rendered as many
+       times as needed, with different contexts, via m_render or by passing it
+       as template to a Renderer.
+
+       While being evaluated, expressions remember their last result, and the
+       parsers hold the context of the current rendering. Several threads may
+       render the same compiled template, but one at a time: a lock
+       serialises its renderings.'''
+    def __init__(self, template):
+        # p_template is the path to an ODT or ODS file, the content of such a
+        # file as bytes, or a file-like object.
+        self.template = template
+        # The whole (zipped) template, as bytes
+        if isinstance(template, str):
+            f = open(template, 'rb')
+            self.data = f.read()
+            f.close()
+        elif isinstance(template, bytes):
+            self.data = template
+        else:
+            if hasattr(template, 'seek'): template.seek(0)
+            self.data = template.read()
+        zipFile = zipfile.ZipFile(io.BytesIO(self.data))
+        names = zipFile.namelist()
+        self.mimetype = None
+        if 'mimetype' in names:
+            self.mimetype = zipFile.read('mimetype').decode('utf-8')
+        self.type = self.getType()
+        self.contentXml = zipFile.read('content.xml').decode('utf-8')
+        self.stylesXml = zipFile.read('styles.xml').decode('utf-8')
+        zipFile.close()
+        # Manages the styles defined into the template
+        self.stylesManager = StylesManager(self.stylesXml)
+        # Parse content.xml
+        pe = PodEnvironment
+        contentInserts = (
+            OdInsert(CONTENT_POD_FONTS,
+                XmlElement('font-face-decls', nsUri=pe.NS_OFFICE),
+                nsUris={'style': pe.NS_STYLE, 'svg': pe.NS_SVG}),
+            OdInsert(CONTENT_POD_STYLES,
+                XmlElement('automatic-styles', nsUri=pe.NS_OFFICE),
+                nsUris={'style': pe.NS_STYLE, 'fo': pe.NS_FO,
+                        'text': pe.NS_TEXT, 'table': pe.NS_TABLE}))
+        self.contentParser = self.createPodParser(contentInserts)
+        self.contentParser.parse(self.contentXml)
+        # Parse styles.xml
+        stylesInserts = (
+            OdInsert(STYLES_POD_FONTS,
+                XmlElement('font-face-decls', nsUri=pe.NS_OFFICE),
+                nsUris={'style': pe.NS_STYLE, 'svg': pe.NS_SVG}),
+            OdInsert(STYLES_POD_STYLES,
+                XmlElement('styles', nsUri=pe.NS_OFFICE),
+                nsUris={'style': pe.NS_STYLE, 'fo': pe.NS_FO,
+                        'text': pe.NS_TEXT}))
+        self.stylesParser = self.createPodParser(stylesInserts)
+        self.stylesParser.parse(self.stylesXml)
+        # Serialises the renderings of this template (see Renderer.zipResult).
+        # A sub-template may be imported, within the same thread, by a
+        # rendering of itself.
+        self.lock = threading.RLock()
+
+    def getType(self):
+        '''Identifies the type of the pod template (ods or odt). If
+           self.template is a string, it is a file name and we simply get its
+           extension. Else, we deduce it from the template mime type.'''
+        if isinstance(self.template, str):
+            res = os.path.splitext(self.template)[1][1:]
+        elif self.mimetype == mimeTypes['ods']:
+            res = 'ods'
+        else:
+            # We suppose this is ODT
+            res = 'odt'
+        return res
+
+    def createPodParser(self, inserts):
+        '''Creates the parser with its environment for parsing content.xml or
+           styles.xml. p_inserts depends on the ODT file we must parse. Once
+           parsed, the root buffer (env.currentBuffer) is a TemplateBuffer
+           containing the compiled file.'''
+        env = PodEnvironment(None, inserts)
+        env.currentBuffer = TemplateBuffer(env)
+        return PodParser(env, self)
+
+    def render(self, context, result, **kwargs):
+        '''Renders this template with this p_context into p_result. p_kwargs
+           are those accepted by the Renderer constructor.'''
+        Renderer(self, context, result, **kwargs).run()
+
 # ------------------------------------------------------------------------------
 class Renderer:
     templateTypes = ('odt', 'ods') # Types of POD templates
@@ -101,7 +198,9 @@ class Renderer:
     def __init__(self, template, context, result, pythonWithUnoPath=None,
                  ooPort=2002, stylesMapping={}, forceOoCall=False,
                  finalizeFunction=None, overwriteExisting=False,
-                 raiseOnError=False, imageResolver=None, stylesTemplate=None):
+                 raiseOnError=False, imageResolver=None, stylesTemplate=None,
+                 maxMemory=16777216, conversionCache=None, refreshToc=False,
+                 nativeExport=True):
         '''This Python Open Document Renderer (PodRenderer) loads a document
            template (p_template) which is an ODT or ODS file with some elements
            written in Python. Based on this template and some Python objects
@@ -109,19 +208,38 @@ class Renderer:
            that instantiates the p_template and fills it with objects from the
            p_context.
 
+         - p_template may be the path to the template, its content as bytes, a
+           file-like object or a CompiledTemplate instance (see function
+           appy.pod.compile). In that case, the template is not parsed again.
+
+         - p_result may be a file name or a writable (binary) stream. When
+           rendering an ODT or ODS from a template given as bytes into a
+           stream, everything happens in memory: the renderer creates a
+           temporary folder only if it needs one (to import documents, call
+           LibreOffice or call p_finalizeFunction).
+
+         - p_result may also be a list of file names and/or streams, ie
+           ['result.pdf', 'result.docx', 'result.odt']: the result is then
+           produced in every format, LibreOffice loading the rendered document
+           only once for performing all the conversions.
+
          - If p_result does not end with .odt or .ods, the Renderer will call
            LibreOffice to perform a conversion. If p_forceOoCall is True, even
            if p_result ends with .odt, LibreOffice will be called, not for
            performing a conversion, but for updating some elements like indexes
            (table of contents, etc) and sections containing links to external
            files (which is the case, for example, if you use the default
-           function "document").
+           function "document" for importing an ODT document containing
+           embedded objects: other ODT documents are inlined without
+           LibreOffice).
 
          - If the Python interpreter which runs the current script is not
            UNO-enabled, this script will run, in another process, a UNO-enabled
            Python interpreter (whose path is p_pythonWithUnoPath) which will
            call LibreOffice. In both cases, we will try to connect to
-           LibreOffice in server mode on port p_ooPort.
+           LibreOffice in server mode on port p_ooPort. p_ooPort may also be a
+           LoPool instance (see appy.pod.lo_pool): LibreOffice will then be
+           called on one of the instances managed by the pool.
 
          - If you plan to make "XHTML to OpenDocument" conversions, you may
            specify a styles mapping in p_stylesMapping.
@@ -147,14 +265,59 @@ class Renderer:
            resolver can only be a Zope application object.
 
          - p_stylesTemplate can be the path to a LibreOffice file (ie, a .ott
-           file) whose styles will be imported within the result.
+           file) whose styles will be imported within the result. If it is an
+           ODF file, its styles are merged into the result by POD itself (see
+           appy.pod.styles_merger): LibreOffice is not called for that. Else,
+           they are loaded by LibreOffice while converting the result.
+
+         - The result is written as it is rendered: content.xml and styles.xml
+           are compressed on the fly. Until it is added into the result, the
+           compressed content of such a file is kept in memory, up to
+           p_maxMemory bytes. Beyond this limit, it is spilled to a temp file.
+           Memory usage does thus not depend on the size of the result, even
+           for huge loops.
+
+         - If p_conversionCache is given (a ConversionCache instance, see
+           appy.pod.conversion_cache), the results of LibreOffice conversions
+           (of the result or of imported documents) are cached: converting
+           again the same content, to the same type, does not call LibreOffice
+           anymore.
+
+         - If p_refreshToc is True, the tables of contents of the result are
+           regenerated from its headings, without calling LibreOffice: every
+           entry links to its heading, and its page number is a field that is
+           computed when the result is displayed or converted. Use
+           p_forceOoCall instead if page numbers must be stored in the result.
+
+         - If p_nativeExport is True, results of type txt, html, htm or fodt
+           (from an ODT template) and csv or fods (from an ODS template) are
+           exported by POD itself, without calling LibreOffice (see
+           appy.pod.exporters). fodt and fods results are flat OpenDocument
+           files: a single XML file, embedding pictures. When exporting an ODS
+           document with several sheets to a CSV file "result.csv", the first
+           sheet is exported to "result.csv" and the other ones to
+           "result.<sheetName>.csv". Set p_nativeExport to False, or
+           p_forceOoCall to True, to let LibreOffice export them.
         '''
-        self.template = template
-        self.result = result
-        self.contentXml = None # Content (string) of content.xml
-        self.stylesXml = None # Content (string) of styles.xml
-        self.stylesManager = None # Manages the styles defined into the ODT
-        # template
+        # Get the compiled template
+        if isinstance(template, CompiledTemplate):
+            compiled = template
+        else:
+            compiled = CompiledTemplate(template)
+        self.compiled = compiled
+        self.template = compiled.template
+        # p_result may be a list of results. self.result is the first one.
+        if isinstance(result, (list, tuple)):
+            self.results = list(result)
+        else:
+            self.results = [result]
+        self.result = self.results[0]
+        self.contentXml = compiled.contentXml # Content (string) of content.xml
+        self.stylesXml = compiled.stylesXml # Content (string) of styles.xml
+        # Manages the styles defined into the ODT template. The compiled
+        # template's styles manager is copied: the styles mapping is specific
+        # to every rendering.
+        self.stylesManager = copy.copy(compiled.stylesManager)
         self.tempFolder = None
         self.env = None
         self.pyPath = pythonWithUnoPath
@@ -165,77 +328,77 @@ class Renderer:
         self.raiseOnError = raiseOnError
         self.imageResolver = imageResolver
         self.stylesTemplate = stylesTemplate
+        self.stylesMerger = None
+        if stylesTemplate and StylesMerger.accepts(stylesTemplate):
+            self.stylesMerger = StylesMerger(self, stylesTemplate)
+        self.maxMemory = maxMemory
+        self.conversionCache = conversionCache
+        self.refreshToc = refreshToc
+        self.nativeExport = nativeExport
         # Remember potential files or images that will be included through
         # "do ... from document" statements: we will need to declare them in
         # META-INF/manifest.xml. Keys are file names as they appear within the
         # ODT file (to dump in manifest.xml); values are original paths of
-        # included images (used for avoiding to create multiple copies of a file
-        # which is imported several times).
+        # included images.
         self.fileNames = {}
-        self.prepareFolders()
-        # Unzip template
-        self.unzipFolder = os.path.join(self.tempFolder, 'unzip')
-        os.mkdir(self.unzipFolder)
-        info = unzip(template, self.unzipFolder, odf=True)
-        self.contentXml = info['content.xml'].decode('utf-8')
-        self.stylesXml = info['styles.xml'].decode('utf-8')
-        self.stylesManager = StylesManager(self.stylesXml)
+        # The parsers of content.xml and styles.xml: they come from the compiled
+        # template and hold the compiled files.
+        self.contentParser = compiled.contentParser
+        self.stylesParser = compiled.stylesParser
+        # The contexts for evaluating content.xml and styles.xml
+        self.contentContext = self.createContext(context)
+        self.stylesContext = self.createContext(context)
+        self.checkResult()
         # From LibreOffice 3.5, it is not possible anymore to dump errors into
         # the resulting ods as annotations. Indeed, annotations can't reside
         # anymore within paragraphs. ODS files generated with pod and containing
         # error messages in annotations cause LibreOffice 3.5 and 4.0 to crash.
         # LibreOffice >= 4.1 simply does not show the annotation.
-        if info['mimetype'] == mimeTypes['ods']: self.raiseOnError = True
-        # Create the content.xml parser
-        pe = PodEnvironment
-        contentInserts = (
-            OdInsert(CONTENT_POD_FONTS,
-                XmlElement('font-face-decls', nsUri=pe.NS_OFFICE),
-                nsUris={'style': pe.NS_STYLE, 'svg': pe.NS_SVG}),
-            OdInsert(CONTENT_POD_STYLES,
-                XmlElement('automatic-styles', nsUri=pe.NS_OFFICE),
-                nsUris={'style': pe.NS_STYLE, 'fo': pe.NS_FO,
-                        'text': pe.NS_TEXT, 'table': pe.NS_TABLE}))
-        self.contentParser = self.createPodParser('content.xml', context,
-                                                  contentInserts)
-        # Create the styles.xml parser
-        stylesInserts = (
-            OdInsert(STYLES_POD_FONTS,
-                XmlElement('font-face-decls', nsUri=pe.NS_OFFICE),
-                nsUris={'style': pe.NS_STYLE, 'svg': pe.NS_SVG}),
-            OdInsert(STYLES_POD_STYLES,
-                XmlElement('styles', nsUri=pe.NS_OFFICE),
-                nsUris={'style': pe.NS_STYLE, 'fo': pe.NS_FO,
-                        'text': pe.NS_TEXT}))
-        self.stylesParser = self.createPodParser('styles.xml', context,
-                                                 stylesInserts)
+        if compiled.mimetype == mimeTypes['ods']: self.raiseOnError = True
         # Store the styles mapping
         self.setStylesMapping(stylesMapping)
         # While working, POD may identify "dynamic styles" to insert into
         # the "automatic styles" section of content.xml, like the column styles
         # of tables generated from XHTML tables via xhtml2odt.py.
         self.dynamicStyles = []
-
-    def createPodParser(self, odtFile, context, inserts):
-        '''Creates the parser with its environment for parsing the given
-           p_odtFile (content.xml or styles.xml). p_context is given by the pod
-           user, while p_inserts depends on the ODT file we must parse.'''
-        evalContext = {'xhtml': self.renderXhtml,
-                       'text':  self.renderText,
-                       'test': self.evalIfExpression,
-                       'document': self.importDocument,
-                       'pod': self.importPod,
-                       'pageBreak': self.insertPageBreak} # Default context
+        # Common styles from ODT documents imported natively (see
+        # appy.pod.odt_inliner), to insert into styles.xml, and the names of
+        # the common styles defined in the result (computed at first import).
+        self.importedStyles = []
+        self.importedStyleNames = None
+        # The number of ODT documents imported natively. Documents that may be
+        # imported several times are identified by a key (see
+        # appy.pod.odt_inliner): self.inlinedKeys stores, for every key, the
+        # prefix of the document's styles, or None if it can't be inlined.
+        # self.inlinedStyles stores the automatic styles added to content.xml
+        # by inlined documents, in order to add them only once.
+        self.inlinedDocs = 0
+        self.inlinedKeys = {}
+        self.inlinedStyles = {}
+        # The sub-templates imported via function "pod", compiled, keyed by
+        # the path, modification time and size of their file.
+        self.compiledImports = {}
+        # The paths of the images imported into the result, keyed by the SHA-1
+        # hash of their content: an image imported several times, from
+        # different paths or as binary content, is stored only once.
+        self.imageHashes = {}
+
+    def createContext(self, context):
+        '''Creates the context for evaluating content.xml or styles.xml,
+           based on the p_context given by the pod user.'''
+        res = {'xhtml': self.renderXhtml,
+               'text':  self.renderText,
+               'test': self.evalIfExpression,
+               'document': self.importDocument,
+               'pod': self.importPod,
+               'pageBreak': self.insertPageBreak} # Default context
         if hasattr(context, '__dict__'):
-            evalContext.update(context.__dict__)
+            res.update(context.__dict__)
         elif isinstance(context, dict) or isinstance(context, UserDict):
-            evalContext.update(context)
+            res.update(context)
         else:
             raise PodError(BAD_CONTEXT)
-        env = PodEnvironment(evalContext, inserts)
-        fileBuffer = FileBuffer(env, os.path.join(self.tempFolder,odtFile))
-        env.currentBuffer = fileBuffer
-        return PodParser(env, self)
+        return res
 
     def renderXhtml(self, xhtmlString, encoding='utf-8', stylesMapping={}):
         '''Method that can be used (under the name 'xhtml') into a pod template
@@ -268,7 +431,8 @@ class Renderer:
     def importDocument(self, content=None, at=None, format=None,
                        anchor='as-char', wrapInPara=True, size=None,
                        sizeUnit='cm', style=None,
-                       pageBreakBefore=False, pageBreakAfter=False):
+                       pageBreakBefore=False, pageBreakAfter=False, dpi=125,
+                       pages=None):
         '''If p_at is not None, it represents a path or url allowing to find
            the document. If p_at is None, the content of the document is
            supposed to be in binary format in p_content. The document
@@ -292,7 +456,17 @@ class Renderer:
 
            p_pageBreakBefore and p_pageBreakAfter are only relevant for import
            of external odt documents, and allows to insert a page break
-           before/after the inserted document.
+           before/after the inserted document. Such documents are inlined
+           into the result, with their styles and pictures (see
+           appy.pod.odt_inliner), excepted if they contain embedded objects:
+           LibreOffice is then called to merge them.
+
+           p_dpi and p_pages are only relevant for PDF files (and documents
+           converted to PDF by LibreOffice): every page is imported as an
+           image, rendered at p_dpi dots per inch. If p_pages is given, it is
+           the list of page numbers (starting at 1) to import, ie
+           pages=range(1, 4) imports the first 3 pages (see
+           appy.pod.doc_importers.PdfImporter).
         '''
         importer = None
         # Is there someting to import?
@@ -314,9 +488,9 @@ class Renderer:
                 format = mimeTypesExts[format]
         isImage = False
         isOdt = False
+        isPdf = False
         if format in self.ooFormats:
             importer = OdtImporter
-            self.forceOoCall = True
             isOdt = True
         elif (format in self.imageFormats) or not format:
             # If the format can't be guessed, we suppose it is an image.
@@ -324,14 +498,17 @@ class Renderer:
             isImage = True
         elif format == 'pdf':
             importer = PdfImporter
+            isPdf = True
         elif format in self.convertibleFormats:
             importer = ConvertImporter
+            isPdf = True
         else:
             raise PodError(DOC_WRONG_FORMAT % format)
         imp = importer(content, at, format, self)
         # Initialise image-specific parameters
         if isImage: imp.init(anchor, wrapInPara, size, sizeUnit, style)
         elif isOdt: imp.init(pageBreakBefore, pageBreakAfter)
+        elif isPdf: imp.init(dpi, pages)
         return imp.run()
 
     def importPod(self, content=None, at=None, format='odt', context=None,
@@ -347,13 +524,12 @@ class Renderer:
         if content.__class__.__name__ == 'File':
             content = FileWrapper(content)
         imp = PodImporter(content, at, format, self)
-        self.forceOoCall = True
         # Define the context to use: either the current context of the current
         # POD renderer, or p_context if given.
         if context:
             ctx = context
         else:
-            ctx = self.contentParser.env.context
+            ctx = self.contentContext
         imp.init(ctx, pageBreakBefore, pageBreakAfter)
         return imp.run()
 
@@ -363,68 +539,106 @@ class Renderer:
         return '<%s:p %s:style-name="podPageBreak"></%s:p>' % \
                (textNs, textNs, textNs)
 
-    def prepareFolders(self):
-        # Check if I can write the result
-        if not self.overwriteExisting and os.path.exists(self.result):
-            raise PodError(RESULT_FILE_EXISTS % self.result)
-        try:
-            f = open(self.result, 'w')
-            f.write('Hello')
-            f.close()
-        except OSError as oe:
-            raise PodError(CANT_WRITE_RESULT % (self.result, oe))
-        except IOError as ie:
-            raise PodError(CANT_WRITE_RESULT % (self.result, ie))
-        self.result = os.path.abspath(self.result)
-        os.remove(self.result)
-        # Create a temp folder for storing temporary files
-        absResult = os.path.abspath(self.result)
-        self.tempFolder = '%s.%f' % (absResult, time.time())
+    def checkResult(self):
+        '''Checks that the results can be written. If a result is a stream,
+           there is nothing to check.'''
+        for i in range(len(self.results)):
+            result = self.results[i]
+            if not isinstance(result, str): continue
+            if not self.overwriteExisting and os.path.exists(result):
+                raise PodError(RESULT_FILE_EXISTS % result)
+            result = self.results[i] = os.path.abspath(result)
+            folder = os.path.dirname(result)
+            if not os.access(folder, os.W_OK):
+                raise PodError(CANT_WRITE_RESULT % (result,
+                                                  FOLDER_NOT_WRITABLE % folder))
+        self.result = self.results[0]
+
+    def getTempFolder(self):
+        '''Returns the folder for storing temporary files. It is created at
+           first use: as long as no temporary file is needed, the rendering
+           occurs in memory.'''
+        if self.tempFolder: return self.tempFolder
+        if isinstance(self.result, str):
+            # Create it besides the result
+            folder = os.path.dirname(self.result)
+            prefix = '%s.' % os.path.basename(self.result)
+        else:
+            folder = getOsTempFolder()
+            prefix = 'pod.'
         try:
-            os.mkdir(self.tempFolder)
+            self.tempFolder = tempfile.mkdtemp(prefix=prefix, dir=folder)
         except OSError as oe:
-            raise PodError(CANT_WRITE_TEMP_FOLDER % (self.result, oe))
-
-    def patchManifest(self):
-        '''Declares, in META-INF/manifest.xml, images or files included via the
-           "do... from document" statements if any.'''
-        if self.fileNames:
-            j = os.path.join
-            toInsert = ''
-            for fileName in self.fileNames.keys():
-                if fileName.endswith('.svg'):
-                    fileName = os.path.splitext(fileName)[0] + '.png'
-                mimeType = mimetypes.guess_type(fileName)[0]
-                toInsert += ' <manifest:file-entry manifest:media-type="%s" ' \
-                            'manifest:full-path="%s"/>\n' % (mimeType, fileName)
-            manifestName = j(self.unzipFolder, j('META-INF', 'manifest.xml'))
-            f = file(manifestName)
-            manifestContent = f.read()
-            hook = '</manifest:manifest>'
-            manifestContent = manifestContent.replace(hook, toInsert+hook)
-            f.close()
-            # Write the new manifest content
-            f = file(manifestName, 'w')
-            f.write(manifestContent)
-            f.close()
+            raise PodError(CANT_WRITE_TEMP_FOLDER % (folder, oe))
+        return self.tempFolder
+
+    def patchManifest(self, manifest):
+        '''Declares, in p_manifest (the content of META-INF/manifest.xml),
+           images or files included via the "do... from document" statements if
+           any. Returns the patched manifest.'''
+        if not self.fileNames: return manifest
+        toInsert = ''
+        for fileName in self.fileNames.keys():
+            mimeType = mimetypes.guess_type(fileName)[0]
+            toInsert += ' <manifest:file-entry manifest:media-type="%s" ' \
+                        'manifest:full-path="%s"/>\n' % (mimeType, fileName)
+        hook = '</manifest:manifest>'
+        return manifest.replace(hook, toInsert+hook)
+
+    def renderFile(self, parser, context, result):
+        '''Evaluates, with this p_context, the compiled version of content.xml
+           or styles.xml held by p_parser, and dumps the result into p_result,
+           a text stream.'''
+        # Remember which parser is running
+        self.currentParser = parser
+        env = parser.env
+        env.context = context
+        env.raiseOnError = self.raiseOnError
+        env.currentBuffer.evaluate(FileBuffer(env, result), context)
 
     # Public interface
     def run(self):
-        '''Renders the result'''
+        '''Renders the result(s)'''
         try:
-            # Remember which parser is running
-            self.currentParser = self.contentParser
-            # Create the resulting content.xml
-            self.currentParser.parse(self.contentXml)
-            self.currentParser = self.stylesParser
-            # Create the resulting styles.xml
-            self.currentParser.parse(self.stylesXml)
-            # Patch META-INF/manifest.xml
-            self.patchManifest()
-            # Re-zip the result
-            self.finalize()
+            resultName, resultTypes, callLo = self.renderResult()
+            if callLo:
+                self.convertResult(resultName, resultTypes)
+            elif resultName != self.result:
+                self.dumpResults(resultName)
         finally:
+            self.deleteTempFolder()
+
+    def renderResult(self):
+        '''Renders the result as an OpenDocument file of the same type as the
+           POD template (odt, ods...), but does not convert it. Returns a tuple
+           (resultName, resultTypes, callLo): the name of the rendered file,
+           the types of the results and a boolean being True if the result
+           must be converted (see m_convertResult).'''
+        resultTypes = [self.getResultType(result) for result in self.results]
+        callLo = bool(self.forceOoCall or \
+                      [t for t in resultTypes if t not in self.templateTypes])
+        if callLo or self.finalizeFunction or (len(self.results) > 1):
+            # Zip the result in the temp folder
+            resultName = os.path.join(self.getTempFolder(),
+                                      'result.%s' % self.getTemplateType())
+        else:
+            # Zip the result directly into self.result
+            resultName = self.result
+        try:
+            self.zipResult(resultName)
+        except Exception as e:
+            # Do not leave an incomplete result
+            if (resultName == self.result) and \
+               isinstance(resultName, str) and os.path.exists(resultName):
+                os.remove(resultName)
+            raise e
+        if self.finalizeFunction: self.finalizeResult(resultName)
+        return resultName, resultTypes, callLo
+
+    def deleteTempFolder(self):
+        if self.tempFolder:
             FolderDeleter.delete(self.tempFolder)
+            self.tempFolder = None
 
     def getStyles(self):
         '''Returns a dict of the styles that are defined into the template.'''
@@ -444,127 +658,317 @@ class Renderer:
                 stylesMapping['span[font-style=italic]'] = 'podItalic'
             self.stylesManager.stylesMapping = stylesMapping
         except PodError as po:
-            self.contentParser.env.currentBuffer.content.close()
-            self.stylesParser.env.currentBuffer.content.close()
-            if os.path.exists(self.tempFolder):
-                FolderDeleter.delete(self.tempFolder)
+            if self.tempFolder: FolderDeleter.delete(self.tempFolder)
             raise po
 
+    def getConvertedName(self, fileName, resultType):
+        '''Returns the name of the file produced by LibreOffice when
+           converting p_fileName to p_resultType.'''
+        prefix = os.path.splitext(fileName)[0]
+        if resultType in self.templateTypes:
+            # converter.py creates a second file suffixed .res.[resultType]
+            return '%s.res.%s' % (prefix, resultType)
+        return '%s.%s' % (prefix, resultType)
+
+    def getLoStylesTemplate(self):
+        '''Gets the styles template whose styles LibreOffice must load while
+           converting the result, if they were not merged by POD.'''
+        if not self.stylesMerger: return self.stylesTemplate
+
+    def getCached(self, resultName, resultTypes):
+        '''Gets, from the conversion cache, the files resulting from the
+           conversion of p_resultName to p_resultTypes. Returns a tuple
+           (missingTypes, keys): the types that are not cached, and the cache
+           keys of all types (see m_setCached).'''
+        cache = self.conversionCache
+        if not cache: return resultTypes, None
+        keys = cache.getKeys(resultName, resultTypes,
+                             self.getLoStylesTemplate())
+        missing = [t for t in resultTypes if not \
+                   cache.get(keys[t], self.getConvertedName(resultName, t))]
+        return missing, keys
+
+    def setCached(self, resultName, resultTypes, keys):
+        '''Puts, in the conversion cache, the files produced by LibreOffice
+           when converting p_resultName to p_resultTypes.'''
+        if not self.conversionCache: return
+        for t in resultTypes:
+            convertedName = self.getConvertedName(resultName, t)
+            if os.path.exists(convertedName):
+                self.conversionCache.put(keys[t], convertedName)
+
+    def manageConvertError(self, error, resultTypes):
+        '''Manages p_error, a PodError raised while converting the result to
+           p_resultTypes.'''
+        # When trying to call LO in server mode for producing ODT or ODS
+        # (=forceOoCall=True), if an error occurs we have nevertheless
+        # an ODT or ODS to return to the user. So we produce a warning
+        # instead of raising an error.
+        if self.forceOoCall and \
+           not [t for t in resultTypes if t not in self.templateTypes]:
+            print((WARNING_INCOMPLETE_OD % str(error)))
+        else:
+            raise error
+
     def callLibreOffice(self, resultName, resultType):
-        '''Call LibreOffice in server mode to convert or update the result.'''
+        '''Call LibreOffice in server mode to convert or update the result.
+           p_resultType may be a list of types: LibreOffice then loads the
+           result once and stores it in every type.'''
         loOutput = ''
+        if isinstance(resultType, str): resultType = [resultType]
+        # Get the converted files from the cache when possible. Only the types
+        # that are not cached will be asked to LibreOffice.
+        resultType, keys = self.getCached(resultName, resultType)
+        if not resultType: return loOutput
         try:
-            if (not isinstance(self.ooPort, int)) and \
-               (not isinstance(self.ooPort, int)):
-                raise PodError(BAD_OO_PORT % str(self.ooPort))
-            try:
-                from appy.pod.converter import Converter, ConverterError
+            if isinstance(self.ooPort, LoPool):
+                # Let the pool choose the LibreOffice instance to use
+                from appy.pod.converter import ConverterError
                 try:
-                    Converter(resultName, resultType, self.ooPort,
-                              self.stylesTemplate).run()
+                    self.ooPort.run(lambda port: \
+                      self.convertOnPort(resultName, resultType, port))
                 except ConverterError as ce:
                     raise PodError(CONVERT_ERROR % str(ce))
-            except ImportError:
-                # I do not have UNO. So try to launch a UNO-enabled Python
-                # interpreter which should be in self.pyPath.
-                if not self.pyPath:
-                    raise PodError(NO_PY_PATH % resultType)
-                if self.pyPath.find(' ') != -1:
-                    raise PodError(BLANKS_IN_PATH % self.pyPath)
-                if not os.path.isfile(self.pyPath):
-                    raise PodError(PY_PATH_NOT_FILE % self.pyPath)
-                if resultName.find(' ') != -1:
-                    qResultName = '"%s"' % resultName
-                else:
-                    qResultName = resultName
-                convScript = '%s/converter.py' % \
-                            os.path.dirname(appy.pod.__file__)
-                if convScript.find(' ') != -1:
-                    convScript = '"%s"' % convScript
-                cmd = '%s %s %s %s -p%d' % \
-                    (self.pyPath, convScript, qResultName, resultType,
-                    self.ooPort)
-                if self.stylesTemplate: cmd += ' -t%s' % self.stylesTemplate
-                loOutput = executeCommand(cmd)
-        except PodError as pe:
-            # When trying to call LO in server mode for producing ODT or ODS
-            # (=forceOoCall=True), if an error occurs we have nevertheless
-            # an ODT or ODS to return to the user. So we produce a warning
-            # instead of raising an error.
-            if (resultType in self.templateTypes) and self.forceOoCall:
-                print((WARNING_INCOMPLETE_OD % str(pe)))
+            elif not isinstance(self.ooPort, int):
+                raise PodError(BAD_OO_PORT % str(self.ooPort))
             else:
-                raise pe
+                self.convertOnPort(resultName, resultType, self.ooPort)
+        except PodError as pe:
+            self.manageConvertError(pe, resultType)
+        self.setCached(resultName, resultType, keys)
         return loOutput
 
+    def convertOnPort(self, resultName, resultType, port):
+        '''Asks LibreOffice, running on this p_port, to convert or update the
+           result, into p_resultType (a list of types).'''
+        try:
+            from appy.pod.converter import Converter, ConverterError
+            try:
+                Converter(resultName, resultType, port,
+                          self.getLoStylesTemplate()).run()
+            except ConverterError as ce:
+                raise PodError(CONVERT_ERROR % str(ce))
+        except ImportError:
+            # I do not have UNO. So ask a worker running a UNO-enabled Python
+            # interpreter (self.pyPath) to do the job.
+            if not self.pyPath:
+                raise PodError(NO_PY_PATH % ', '.join(resultType))
+            if not os.path.isfile(self.pyPath):
+                raise PodError(PY_PATH_NOT_FILE % self.pyPath)
+            from appy.pod.converter import ConverterWorker, ConverterError
+            worker = ConverterWorker.get(self.pyPath, port)
+            try:
+                worker.convert(resultName, resultType,
+                               self.getLoStylesTemplate())
+            except ConverterError as ce:
+                raise PodError(CONVERT_ERROR % str(ce))
+            finally:
+                # A dead worker is not reused
+                if worker.process.returncode is None:
+                    ConverterWorker.release(worker)
+
     def getTemplateType(self):
-        '''Identifies the type of the pod template in self.template
-           (ods or odt). If self.template is a string, it is a file name and we
-           simply get its extension. Else, it is a binary file in a StringIO
-           instance, and we seek the mime type from the first bytes.'''
-        if isinstance(self.template, str):
-            res = os.path.splitext(self.template)[1][1:]
-        else:
-            # A StringIO instance
-            self.template.seek(0)
-            firstBytes = self.template.read(90)
-            firstBytes = firstBytes[firstBytes.index('mimetype')+8:]
-            if firstBytes.startswith(mimeTypes['ods']):
-                res = 'ods'
+        '''Identifies the type of the pod template (ods or odt).'''
+        return self.compiled.type
+
+    def getResultType(self, result):
+        '''Gets the type of p_result: the extension of the result file, or
+           the template type if p_result is a stream.'''
+        if isinstance(result, str):
+            return os.path.splitext(result)[1].strip('.')
+        return self.getTemplateType()
+
+    def zipResult(self, f):
+        '''Renders the result and zips it into p_f, a file name or a writable
+           stream. content.xml and styles.xml are compressed while being
+           rendered. The other files come from the template, excepted the
+           patched manifest and the files that were imported in the temp
+           folder.'''
+        res = zipfile.ZipFile(f, 'w', zipfile.ZIP_DEFLATED)
+        template = zipfile.ZipFile(io.BytesIO(self.compiled.data))
+        # Insert first the file "mimetype", uncompressed (see appy.shared.zip)
+        mimetype = self.compiled.mimetype or mimeTypes[self.compiled.type]
+        res.writestr('mimetype', mimetype, zipfile.ZIP_STORED)
+        # The parsers of a compiled template hold the state of the rendering:
+        # several renderings of the same compiled template can't run at once.
+        with self.compiled.lock:
+            # Render content.xml. Dynamic styles are only known at the end of
+            # the rendering: the placeholder where to insert them is replaced
+            # when closing the entry.
+            marker = '<!DYNAMIC_STYLES!>'
+            entry = StreamedEntry(res, 'content.xml', marker=marker,
+                                  maxMemory=self.maxMemory)
+            if self.refreshToc:
+                # Render content.xml in a spool, from which it is copied into
+                # the entry, with refreshed tables of contents.
+                refresher = TocRefresher(self.contentParser.env.namespaces,
+                                         self.stylesManager, marker,
+                                         self.maxMemory)
+                self.renderFile(self.contentParser, self.contentContext,
+                                refresher)
+                refresher.dump(entry)
             else:
-                # We suppose this is ODT
-                res = 'odt'
-        return res
-
-    def finalize(self):
-        '''Re-zip the result and potentially call LibreOffice if target format
-           is not among self.templateTypes or if forceOoCall is True.'''
-        for innerFile in ('content.xml', 'styles.xml'):
-            shutil.copy(os.path.join(self.tempFolder, innerFile),
-                        os.path.join(self.unzipFolder, innerFile))
-        # Insert dynamic styles
-        contentXml = os.path.join(self.unzipFolder, 'content.xml')
-        f = open(contentXml, 'r+', encoding='utf-8')
-        dynamicStyles = ''.join(self.dynamicStyles)
-        content = f.read().replace('<!DYNAMIC_STYLES!>', dynamicStyles)
-        f.seek(0)
-        f.truncate(0)
-        f.write(content)
-        f.close()
-        # Call the user-defined "finalize" function when present
-        if self.finalizeFunction:
-            try:
-                self.finalizeFunction(self.unzipFolder)
-            except Exception as e:
-                print((WARNING_FINALIZE_ERROR % str(e)))
-        # Re-zip the result, first as an OpenDocument file of the same type as
-        # the POD template (odt, ods...)
-        resultExt = self.getTemplateType()
-        resultName = os.path.join(self.tempFolder, 'result.%s' % resultExt)
-        zip(resultName, self.unzipFolder, odf=True)
-        resultType = os.path.splitext(self.result)[1].strip('.')
-        if (resultType in self.templateTypes) and not self.forceOoCall:
-            # Simply move the ODT result to the result
-            os.rename(resultName, self.result)
+                self.renderFile(self.contentParser, self.contentContext, entry)
+            entry.close(''.join(self.dynamicStyles))
+            # Render styles.xml
+            marker = '<!IMPORTED_STYLES!>'
+            entry = StreamedEntry(res, 'styles.xml', marker=marker,
+                                  maxMemory=self.maxMemory)
+            if self.stylesMerger:
+                # Render styles.xml in memory and merge the styles template into
+                # it.
+                rendered = io.StringIO()
+                self.renderFile(self.stylesParser, self.stylesContext, rendered)
+                entry.write(self.stylesMerger.run(rendered.getvalue(), marker))
+            else:
+                self.renderFile(self.stylesParser, self.stylesContext, entry)
+            entry.close(''.join(self.importedStyles))
+        # Copy the other template files. Excepted the manifest, they are copied
+        # as is, without being decompressed and recompressed.
+        for info in template.infolist():
+            name = info.filename
+            if name in ('mimetype', 'content.xml', 'styles.xml'): continue
+            if name == 'META-INF/manifest.xml':
+                content = template.read(info).decode('utf-8')
+                res.writestr(info, self.patchManifest(content).encode('utf-8'))
+            else:
+                copyRawEntry(res, info, self.compiled.data)
+        template.close()
+        # Add the imported files
+        folder = self.tempFolder and os.path.join(self.tempFolder, 'unzip')
+        if folder and os.path.isdir(folder):
+            for dir, dirnames, filenames in os.walk(folder):
+                for name in filenames:
+                    path = os.path.join(dir, name)
+                    res.write(path, os.path.relpath(path, folder))
+        res.close()
+
+    def finalizeResult(self, fileName):
+        '''Unzips the result (in file p_fileName) in the temp folder, calls the
+           user-defined "finalize" function on it and re-zips it.'''
+        folder = os.path.join(self.getTempFolder(), 'finalize')
+        os.mkdir(folder)
+        unzip(fileName, folder, odf=True)
+        try:
+            self.finalizeFunction(folder)
+        except Exception as e:
+            print((WARNING_FINALIZE_ERROR % str(e)))
+        zip(fileName, folder, odf=True)
+
+    def dumpResult(self, fileName, result, move=True):
+        '''Dumps the result, found in file p_fileName, to p_result, a file name
+           or a stream. If p_move is True, p_fileName is moved if possible, else
+           it is copied.'''
+        if isinstance(result, str):
+            if move:
+                os.rename(fileName, result)
+            else:
+                shutil.copyfile(fileName, result)
         else:
+            f = open(fileName, 'rb')
+            shutil.copyfileobj(f, result)
+            f.close()
+
+    def dumpResults(self, resultName):
+        '''Dumps the result, found in file p_resultName, to all results.'''
+        last = len(self.results) - 1
+        for i in range(len(self.results)):
+            self.dumpResult(resultName, self.results[i], i == last)
+
+    def getConversionTypes(self, resultTypes):
+        '''Checks p_resultTypes (one type per result) and returns the list of
+           types LibreOffice must produce.'''
+        res = []
+        for i in range(len(resultTypes)):
+            resultType = resultTypes[i]
             if resultType not in FILE_TYPES:
-                raise PodError(BAD_RESULT_TYPE % (
-                    self.result, FILE_TYPES.keys()))
-            # Call LibreOffice to perform the conversion or document update.
-            output = self.callLibreOffice(resultName, resultType)
-            # I (should) have the result. Move it to the correct name.
-            resPrefix = os.path.splitext(resultName)[0]
-            if resultType in self.templateTypes:
-                # converter.py has (normally!) created a second file
-                # suffixed .res.[resultType]
-                finalResultName = '%s.res.%s' % (resPrefix, resultType)
-                if not os.path.exists(finalResultName):
-                    finalResultName = resultName
-                    # In this case OO in server mode could not be called to
-                    # update indexes, sections, etc.
-            else:
-                finalResultName = '%s.%s' % (resPrefix, resultType)
-            if not os.path.exists(finalResultName):
+                raise PodError(BAD_RESULT_TYPE % (self.results[i],
+                                                  FILE_TYPES.keys()))
+            # Without p_forceOoCall, an ODT or ODS result is not updated
+            if (resultType in self.templateTypes) and not self.forceOoCall:
+                continue
+            # Some types are exported natively (see m_exportNative)
+            if self.getExporter(resultType): continue
+            if resultType not in res: res.append(resultType)
+        return res
+
+    def dumpConverted(self, resultName, resultTypes, types, output=''):
+        '''Dumps the files produced by LibreOffice when converting
+           p_resultName to p_types, to the results, whose types are
+           p_resultTypes.'''
+        names = []
+        for resultType in resultTypes:
+            name = self.getConvertedName(resultName, resultType)
+            if (resultType in self.templateTypes) and \
+               ((resultType not in types) or not os.path.exists(name)):
+                name = resultName
+                # In this case OO in server mode could not be called to update
+                # indexes, sections, etc.
+            if not os.path.exists(name):
                 raise PodError(CONVERT_ERROR % output)
-            os.rename(finalResultName, self.result)
+            names.append(name)
+        # Dump them. A file can be moved if no other result needs it.
+        for i in range(len(names)):
+            self.dumpResult(names[i], self.results[i],
+                            names[i] not in names[i+1:])
+
+    def getExporter(self, resultType):
+        '''Gets the exporter that can export the result to p_resultType
+           without LibreOffice, if any (see appy.pod.exporters).'''
+        if not self.nativeExport or self.forceOoCall: return
+        return getExporter(self.getTemplateType(), resultType)
+
+    def exportNative(self, resultName, resultTypes):
+        '''Exports the result (in file p_resultName) to those p_resultTypes
+           that can be produced without LibreOffice.'''
+        for resultType in set(resultTypes):
+            exporter = self.getExporter(resultType)
+            if not exporter: continue
+            name = self.getConvertedName(resultName, resultType)
+            f = open(name, 'w', encoding='utf-8', newline='')
+            try:
+                if exporter == OdsToCsv:
+                    self.exportSheets(resultName, name, f)
+                elif exporter == OdtToHtml:
+                    title = isinstance(self.result, str) and \
+                            os.path.splitext(os.path.basename(self.result))[0]
+                    exporter(resultName).run(f, title or '')
+                else:
+                    exporter(resultName).run(f)
+            finally:
+                f.close()
+
+    def exportSheets(self, resultName, name, f):
+        '''Exports the first sheet of the result (in file p_resultName) to
+           p_f, and the other ones besides every CSV result file. Empty sheets,
+           excepted the first one, produce no file.'''
+        # The names of the other sheets, and the files where they are exported
+        others = []
+        files = []
+        def getFile(i, sheetName):
+            if i == 0: return f
+            sheetName = re.sub(r'[^\w.-]', '_', sheetName or str(i+1))
+            path = '%s.%s.csv' % (os.path.splitext(name)[0], sheetName)
+            others.append((sheetName, path))
+            files.append(open(path, 'w', encoding='utf-8', newline=''))
+            return files[-1]
+        try:
+            OdsToCsv(resultName).run(getFile)
+        finally:
+            for sheetFile in files: sheetFile.close()
+        for result in self.results:
+            if not isinstance(result, str) or not result.endswith('.csv'):
+                continue
+            for sheetName, path in others:
+                shutil.copyfile(path, '%s.%s.csv' % (result[:-4], sheetName))
+
+    def convertResult(self, resultName, resultTypes):
+        '''Calls LibreOffice for converting the result (in file p_resultName)
+           to p_resultTypes (one type per result), or for updating it.
+           LibreOffice is called once, whatever the number of types, and only
+           for types that can't be exported natively.'''
+        types = self.getConversionTypes(resultTypes)
+        output = types and self.callLibreOffice(resultName, types) or ''
+        self.exportNative(resultName, resultTypes)
+        self.dumpConverted(resultName, resultTypes, types, output)
 # ------------------------------------------------------------------------------
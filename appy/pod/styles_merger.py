@@ -0,0 +1,344 @@
+# ------------------------------------------------------------------------------
+# Appy is a framework for building applications in the Python language.
+# Copyright (C) 2007 Gaetan Delannay
+
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,USA.
+
+# ------------------------------------------------------------------------------
+import os, os.path, zipfile, xml.parsers.expat
+
+from appy.pod.odf_parser import OdfEnvironment
+from appy.pod.odt_inliner import OdfCopier
+from appy.shared.utils import Rope
+
+# ------------------------------------------------------------------------------
+NS_OFFICE = OdfEnvironment.NS_OFFICE
+NS_STYLE = OdfEnvironment.NS_STYLE
+NS_TEXT = OdfEnvironment.NS_TEXT
+NS_NUMBER = OdfEnvironment.NS_NUMBER
+# The separator between namespace URIs and names, for the expat parser
+SEP = ' '
+
+# The parts of styles.xml that are merged, in the order they must appear
+containers = ('font-face-decls', 'styles', 'automatic-styles', 'master-styles')
+# The children of office:styles that are merged: the ones from the styles
+# template replace those having the same key (see function getKey).
+mergedStyles = ((NS_STYLE, 'style'), (NS_STYLE, 'default-style'),
+                (NS_TEXT, 'list-style'), (NS_TEXT, 'outline-style'))
+
+def isMerged(name):
+    '''Must element p_name, a child of office:styles, be merged ?'''
+    return (name in mergedStyles) or (name[0] == NS_NUMBER)
+
+def getKey(name, attrs):
+    '''Gets the key identifying a style, from the element p_name and its
+       p_attrs, as given by a namespace-aware SAX parser.'''
+    return name + (attrs.get((NS_STYLE, 'family')),
+                   attrs.get((NS_STYLE, 'name')))
+
+# ------------------------------------------------------------------------------
+class TemplateNamesCollector(OdfCopier):
+    '''Collects, from the styles.xml of the styles template, the keys of the
+       styles to merge, the names of the other elements to merge and the names
+       of the styles used by every master page. Nothing is copied.'''
+    def __init__(self):
+        OdfCopier.__init__(self, {}, {}, None)
+        self.keys = set()
+        self.names = {}
+        for container in containers: self.names[container] = []
+        # ~{s_masterPageName: set(s_styleName)}~
+        self.used = {}
+        self.masterPage = None
+
+    def startElementNS(self, name, qname, attrs):
+        self.path.append(name)
+        if (len(self.path) < 3) or (self.path[1][0] != NS_OFFICE): return
+        container = self.path[1][1]
+        if container not in self.names: return
+        if len(self.path) > 3:
+            if container == 'master-styles': self.addUsed(attrs)
+            return
+        if container == 'styles':
+            if isMerged(name): self.keys.add(getKey(name, attrs))
+            return
+        styleName = attrs.get((NS_STYLE, 'name'))
+        if not styleName: return
+        self.names[container].append(styleName)
+        if container == 'master-styles':
+            self.masterPage = styleName
+            self.used[styleName] = set()
+            self.addUsed(attrs)
+
+    def addUsed(self, attrs):
+        '''Adds the styles used in p_attrs to those of the current master
+           page.'''
+        for (uri, name), value in attrs.items():
+            if name.endswith('style-name') or (name == 'page-layout-name'):
+                self.used[self.masterPage].add(value)
+
+    def endElementNS(self, name, qname):
+        self.path.pop()
+
+    def characters(self, content): pass
+
+class TemplateStylesCopier(OdfCopier):
+    '''Copies, from the styles.xml of the styles template, the styles to merge
+       and the font faces, automatic styles and master pages whose names are in
+       p_names. Copied elements are stored per container, in self.parts.'''
+    def __init__(self, namespaces, styleNames, getHref, names):
+        OdfCopier.__init__(self, namespaces, styleNames, getHref)
+        self.names = names
+        self.parts = {}
+        for container in containers: self.parts[container] = Rope()
+        # Is the current child of a container to be copied ?
+        self.copying = False
+
+    def startElementNS(self, name, qname, attrs):
+        path = self.path
+        if (len(path) == 2) and (path[1][0] == NS_OFFICE) and \
+           (path[1][1] in self.parts):
+            container = path[1][1]
+            if container == 'styles':
+                self.copying = isMerged(name)
+            else:
+                self.copying = attrs.get((NS_STYLE, 'name')) in \
+                               self.names[container]
+        OdfCopier.startElementNS(self, name, qname, attrs)
+
+    def getTarget(self):
+        path = self.path
+        if (len(path) > 2) and self.copying and (path[1][0] == NS_OFFICE):
+            return self.parts.get(path[1][1])
+
+# ------------------------------------------------------------------------------
+class Container:
+    '''A container (see global variable "containers") as found in the rendered
+       styles.xml.'''
+    def __init__(self, start):
+        # The byte offset of the start tag
+        self.start = start
+        # The byte offset of the end tag. For a container being an empty
+        # element, it is the offset of the event following it.
+        self.end = None
+        self.empty = False
+
+class Range:
+    '''A range of bytes, from the rendered styles.xml, to remove'''
+    def __init__(self, start):
+        self.start = start
+        self.end = None
+
+class ResultScanner:
+    '''Parses the rendered styles.xml (as bytes) and finds its containers, the
+       ranges of the styles to replace with those having the same key in
+       p_keys, and the names already used in every container.'''
+    def __init__(self, keys):
+        self.keys = keys
+        self.containers = {}
+        self.ranges = []
+        self.used = {}
+        for container in containers: self.used[container] = set()
+        self.depth = 0
+        # The current container, and is the current style being replaced ?
+        self.current = None
+        self.replacing = False
+        # Is an object waiting for the offset of the next event ?
+        self.waiting = None
+
+    def parse(self, data):
+        parser = xml.parsers.expat.ParserCreate(namespace_separator=SEP)
+        parser.StartElementHandler = self.startElement
+        parser.EndElementHandler = self.endElement
+        parser.CharacterDataHandler = self.characters
+        self.parser = parser
+        parser.Parse(data, True)
+
+    def setOffset(self):
+        if not self.waiting: return
+        element, attr = self.waiting
+        setattr(element, attr, self.parser.CurrentByteIndex)
+        self.waiting = None
+
+    def startElement(self, name, attrs):
+        self.setOffset()
+        self.depth += 1
+        uri, sep, local = name.partition(SEP)
+        if self.depth == 2:
+            self.current = None
+            if (uri == NS_OFFICE) and (local in containers):
+                self.current = local
+                self.containers[local] = \
+                    Container(self.parser.CurrentByteIndex)
+        elif (self.depth == 3) and self.current:
+            name = (uri, local)
+            attrs = dict([(tuple(k.split(SEP)), v) for k, v in attrs.items()])
+            if self.current == 'styles':
+                self.replacing = isMerged(name) and \
+                                 (getKey(name, attrs) in self.keys)
+                if self.replacing:
+                    self.ranges.append(Range(self.parser.CurrentByteIndex))
+            styleName = attrs.get((NS_STYLE, 'name'))
+            if styleName: self.used[self.current].add(styleName)
+
+    def endElement(self, name):
+        self.setOffset()
+        if (self.depth == 3) and (self.current == 'styles') and \
+           self.replacing:
+            # The range ends at the next event
+            self.waiting = (self.ranges[-1], 'end')
+        elif (self.depth == 2) and self.current:
+            container = self.containers[self.current]
+            container.end = self.parser.CurrentByteIndex
+            if container.end == container.start:
+                # An empty element: it ends at the next event
+                container.empty = True
+                self.waiting = (container, 'end')
+        self.depth -= 1
+
+    def characters(self, data):
+        self.setOffset()
+
+# ------------------------------------------------------------------------------
+class StylesMerger:
+    '''Merges the styles of a styles template (p_path, a .ott file or any ODF
+       file) into the styles.xml of the result of p_renderer, without
+       LibreOffice:
+       - styles, default styles, list styles and data styles from the
+         template replace the styles of the result having the same name (or
+         are added if the result does not define them);
+       - font faces and master pages from the template that are not defined in
+         the result are added, with the automatic styles (ie, page layouts)
+         they need. Automatic styles whose names are already used in the
+         result are renamed: the name gets a suffix "_<n>", n being the
+         smallest number making it unique.'''
+
+    def __init__(self, renderer, path):
+        self.renderer = renderer
+        self.path = path
+        zipFile = zipfile.ZipFile(path)
+        self.zipNames = set(zipFile.namelist())
+        self.stylesXml = zipFile.read('styles.xml')
+        zipFile.close()
+        collector = TemplateNamesCollector()
+        collector.parse(self.stylesXml)
+        self.keys = collector.keys
+        self.names = collector.names
+        self.used = collector.used
+
+    @classmethod
+    def accepts(cls, path):
+        '''Can the styles from the file at p_path be merged natively ?'''
+        if not isinstance(path, str) or not zipfile.is_zipfile(path):
+            return False
+        zipFile = zipfile.ZipFile(path)
+        res = 'styles.xml' in zipFile.namelist()
+        zipFile.close()
+        return res
+
+    def getStyleNames(self):
+        '''Gets the names of the styles that will be defined in the result'''
+        return set([key[-1] for key in self.keys if key[-1]])
+
+    def getHref(self, href):
+        '''Copies the file at p_href, if it is a file from the styles
+           template, and returns its new path in the result.'''
+        name = href
+        if name.startswith('./'): name = name[2:]
+        if name not in self.zipNames: return href
+        r = self.renderer
+        newName = '%s/PodStyles_%s' % (os.path.dirname(name) or 'Pictures',
+                                       os.path.basename(name))
+        path = os.path.join(r.getTempFolder(), 'unzip', *newName.split('/'))
+        if not os.path.exists(path):
+            folder = os.path.dirname(path)
+            if not os.path.isdir(folder): os.makedirs(folder)
+            zipFile = zipfile.ZipFile(self.path)
+            f = open(path, 'wb')
+            f.write(zipFile.read(name))
+            f.close()
+            zipFile.close()
+            r.fileNames[newName] = path
+        return newName
+
+    def getStyleNamesMap(self, names):
+        '''Gets the new names of the template automatic styles to copy
+           (p_names) whose names are already used in the result.'''
+        res = {}
+        used = self.scanner.used['automatic-styles']
+        for name in names:
+            newName = name
+            i = 0
+            while newName in used:
+                i += 1
+                newName = '%s_%d' % (name, i)
+            used.add(newName)
+            if newName != name: res[name] = newName
+        return res
+
+    def run(self, stylesXml, marker):
+        '''Returns p_stylesXml, the rendered styles.xml (as a string, possibly
+           containing the p_marker, that is not valid XML), merged with the
+           styles from the template.'''
+        data = stylesXml.encode('utf-8')
+        comment = b'<!--' + b'X' * (len(marker) - 7) + b'-->'
+        self.scanner = scanner = ResultScanner(self.keys)
+        scanner.parse(data.replace(marker.encode('utf-8'), comment))
+        # Get the font faces and master pages to add
+        names = {'styles': None}
+        for container in ('font-face-decls', 'master-styles'):
+            used = scanner.used[container]
+            names[container] = [n for n in self.names[container] \
+                                if n not in used]
+        # Add the automatic styles used by these master pages
+        used = set()
+        for name in names['master-styles']: used.update(self.used[name])
+        names['automatic-styles'] = [n for n in self.names['automatic-styles'] \
+                                     if n in used]
+        styleNames = self.getStyleNamesMap(names['automatic-styles'])
+        namespaces = self.renderer.stylesParser.env.namespaces
+        copier = TemplateStylesCopier(namespaces, styleNames, self.getHref,
+                                      names)
+        copier.parse(self.stylesXml)
+        # Compute the splices (start, end, text): bytes from "start" to "end"
+        # are replaced with "text".
+        splices = [(r.start, r.end, '') for r in scanner.ranges]
+        nextStart = None # The start of the next existing container
+        root = data.rindex(b'</')
+        for container in reversed(containers):
+            part = str(copier.parts[container])
+            existing = scanner.containers.get(container)
+            if existing:
+                nextStart = existing.start
+            if not part: continue
+            qName = '%s:%s' % (namespaces[NS_OFFICE], container)
+            if not existing:
+                # Create the container
+                at = (nextStart is None) and root or nextStart
+                splices.append((at, at, '<%s>%s</%s>' % (qName, part, qName)))
+            elif existing.empty:
+                splices.append((existing.start, existing.end,
+                                '<%s>%s</%s>' % (qName, part, qName)))
+            else:
+                splices.append((existing.end, existing.end, part))
+        splices.sort(key=lambda s: s[0])
+        res = []
+        position = 0
+        for start, end, text in splices:
+            res.append(data[position:start].decode('utf-8'))
+            res.append(text)
+            position = end
+        res.append(data[position:].decode('utf-8'))
+        return ''.join(res)
+# ------------------------------------------------------------------------------
@@ -0,0 +1,204 @@
+# ------------------------------------------------------------------------------
+# Appy is a framework for building applications in the Python language.
+# Copyright (C) 2007 Gaetan Delannay
+
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,USA.
+
+# ------------------------------------------------------------------------------
+import os, os.path, sys, re, stat, shutil, socket, zipfile, asyncio, tempfile
+import threading, unittest
+from concurrent.futures import ThreadPoolExecutor
+
+from appy.pod import PodError, renderAsync
+from appy.pod.converter import ConverterError
+from appy.pod.lo_pool import LoPool
+from appy.pod.renderer import CompiledTemplate
+
+# ------------------------------------------------------------------------------
+# A fake soffice, that only listens on the port it is asked to
+FAKE_SOFFICE = '''#!%s
+import sys, re, socket
+port = int(re.search(r'port=(\\d+)', sys.argv[-1]).group(1))
+s = socket.socket()
+s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+s.bind(('localhost', port))
+s.listen(50)
+while True: s.accept()[0].close()
+'''
+
+# A fake UNO-enabled Python, running converter.py in "serve" mode: it
+# "converts" the document by writing the requested files. If the document
+# path contains "hang" (the temp folder being named after the result), it
+# never answers.
+FAKE_WORKER = '''#!%s
+import sys, os.path, json, time
+for line in sys.stdin:
+    request = json.loads(line)
+    doc = request['doc']
+    if 'hang' in doc: time.sleep(60)
+    types = request['type']
+    if isinstance(types, str): types = [types]
+    for type in types:
+        f = open('%%s.%%s' %% (os.path.splitext(doc)[0], type), 'w')
+        f.write('converted ' + os.path.basename(doc))
+        f.close()
+    sys.stdout.write('{}\\n')
+    sys.stdout.flush()
+'''
+
+# ------------------------------------------------------------------------------
+class AsyncTests(unittest.TestCase):
+    '''Tests function renderAsync with a LoPool as parameter "ooPort". Real
+       LibreOffice instances are replaced with fake ones, and converter.py
+       workers with a fake interpreter.'''
+    testFolder = os.path.dirname(os.path.abspath(__file__))
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp(prefix='pod.async.')
+        self.soffice = self.createScript('soffice', FAKE_SOFFICE)
+        self.python = self.createScript('python', FAKE_WORKER)
+        self.pool = LoPool(2, self.soffice, self.getFreePort(), timeout=2)
+
+    def tearDown(self):
+        self.pool.stop()
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def createScript(self, name, content):
+        path = os.path.join(self.folder, name)
+        f = open(path, 'w')
+        f.write(content % sys.executable)
+        f.close()
+        os.chmod(path, os.stat(path).st_mode | stat.S_IEXEC)
+        return path
+
+    def getFreePort(self):
+        '''Gets a port such that this port and the next one are free.'''
+        for port in range(42000, 43000, 2):
+            try:
+                for p in (port, port+1):
+                    s = socket.socket()
+                    s.bind(('localhost', p))
+                    s.close()
+                return port
+            except (OSError, IOError):
+                s.close()
+        self.fail('No free port was found.')
+
+    def render(self, *names, template='NoPython', **kwargs):
+        '''Renders p_template to a PDF file named after each of p_names,
+           concurrently, through renderAsync.'''
+        template = os.path.join(self.testFolder, 'templates', template + '.odt')
+        results = [os.path.join(self.folder, '%s.pdf' % n) for n in names]
+        async def renderAll():
+            await asyncio.gather(*[renderAsync(template, {}, result,
+              pythonWithUnoPath=self.python, ooPort=self.pool, **kwargs) \
+              for result in results])
+        asyncio.run(renderAll())
+        return results
+
+    def testLoPool(self):
+        results = self.render('r1', 'r2', 'r3', 'r4')
+        for result in results:
+            f = open(result)
+            self.assertTrue(f.read().startswith('converted '))
+            f.close()
+        self.assertEqual(sum([i.jobs for i in self.pool.instances]), 4)
+        self.assertEqual([i.busy for i in self.pool.instances], [0, 0])
+
+    def testLoPoolTimeout(self):
+        # The conversion times out: the instance is killed, then restarted
+        self.render('first')
+        processes = [i.process for i in self.pool.instances]
+        with self.assertRaises(PodError) as cm:
+            self.render('hang')
+        self.assertIn('did not answer within 2 seconds', str(cm.exception))
+        self.render('after1', 'after2')
+        # Only the instance whose conversion timed out was restarted
+        instances = self.pool.instances
+        restarted = [i for i in range(len(instances)) \
+                     if instances[i].process is not processes[i]]
+        self.assertEqual(len(restarted), 1)
+        for instance in instances:
+            self.assertFalse(instance.restarting or instance.stale)
+        self.assertEqual(self.getTempFolders(), [])
+
+    def testLoPoolStartError(self):
+        # The second instance can't listen on its port: the first one is
+        # stopped, too.
+        s = socket.socket()
+        s.bind(('localhost', self.pool.instances[1].port))
+        try:
+            with self.assertRaises(ConverterError):
+                self.pool.acquire()
+        finally:
+            s.close()
+        self.assertFalse(self.pool.started)
+        for instance in self.pool.instances:
+            self.assertIsNone(instance.process)
+            self.assertIsNone(instance.profile)
+        # Once the port is free, the pool is started by the next acquisition
+        instance = self.pool.acquire()
+        self.pool.release(instance, done=False)
+        self.assertTrue(self.pool.started)
+
+    def testCompiledTemplate(self):
+        # Renderings of the same compiled template by several threads are
+        # serialised: their contexts are not mixed.
+        compiled = CompiledTemplate(os.path.join(self.testFolder, 'templates',
+                                                 'SimpleForFilledList.odt'))
+        results = [os.path.join(self.folder, 'c%d.odt' % i) for i in range(8)]
+        executor = ThreadPoolExecutor(4)
+        async def renderAll():
+            await asyncio.gather(*[renderAsync(compiled,
+              {'list1': ['c%d.%d' % (i, j) for j in range(300)]}, results[i],
+              executor=executor) for i in range(len(results))])
+        asyncio.run(renderAll())
+        executor.shutdown()
+        for i in range(len(results)):
+            zipFile = zipfile.ZipFile(results[i])
+            content = zipFile.read('content.xml').decode('utf-8')
+            zipFile.close()
+            self.assertEqual(set(re.findall(r'c(\d+)\.\d+', content)),
+                             set([str(i)]))
+
+    def testCompiledTemplateLock(self):
+        # While a compiled template is being rendered, another rendering waits
+        compiled = CompiledTemplate(os.path.join(self.testFolder, 'templates',
+                                                 'SimpleForFilledList.odt'))
+        result = os.path.join(self.folder, 'locked.odt')
+        thread = threading.Thread(target=compiled.render,
+                                  args=({'list1': ['a', 'b']}, result))
+        with compiled.lock:
+            thread.start()
+            thread.join(1)
+            self.assertTrue(thread.is_alive())
+        thread.join()
+        zipFile = zipfile.ZipFile(result)
+        self.assertIn('content.xml', zipFile.namelist())
+        zipFile.close()
+
+    def getTempFolders(self):
+        return [n for n in os.listdir(self.folder) if '.pdf.' in n]
+
+    def testCleanupOnError(self):
+        # The rendering fails in the executor: the temp folder is removed
+        with self.assertRaises(Exception):
+            self.render('error', template='ErrorExpression', raiseOnError=True)
+        self.assertEqual(self.getTempFolders(), [])
+
+# ------------------------------------------------------------------------------
+if __name__ == '__main__':
+    unittest.main()
+# ------------------------------------------------------------------------------
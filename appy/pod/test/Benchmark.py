@@ -0,0 +1,113 @@
+# ------------------------------------------------------------------------------
+# Appy is a framework for building applications in the Python language.
+# Copyright (C) 2007 Gaetan Delannay
+
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,USA.
+
+# ------------------------------------------------------------------------------
+import os.path, sys, time, io, zipfile
+from appy.pod.renderer import CompiledTemplate
+
+# ------------------------------------------------------------------------------
+usage = '''usage: python Benchmark.py [size]
+
+   Measures the time needed by pod to compile and render templates of growing
+   sizes, and to convert XHTML chunks of growing sizes. Sizes are doubled at
+   every step, starting at "size" (defaults to 500): if times are roughly
+   doubled too, pod scales linearly.'''
+
+# ------------------------------------------------------------------------------
+class Benchmark:
+    '''Times pod on inputs of growing sizes'''
+    # The template whose body will be repeated to produce bigger templates
+    bodyTemplate = 'SimpleTest.odt'
+    bodyContext = {'IWillTellYouWhatInAMoment': 'return',
+                   'beingPaidForIt': True}
+    # The template into which XHTML chunks will be rendered
+    xhtmlTemplate = 'Xhtml.odt'
+    xhtmlChunk = '<p>Paragraph <b>%d</b> with <i>some</i> text</p>' \
+                 '<table><tr><td>Cell</td><td>%d</td></tr></table>'
+    steps = 4
+
+    def __init__(self, size):
+        self.size = size
+        self.templatesFolder = os.path.join(os.path.dirname(__file__),
+                                            'templates')
+
+    def getBigTemplate(self, times):
+        '''Returns, as bytes, the template named self.bodyTemplate, whose body
+           paragraphs are repeated p_times times.'''
+        f = open(os.path.join(self.templatesFolder, self.bodyTemplate), 'rb')
+        template = zipfile.ZipFile(f)
+        res = io.BytesIO()
+        zipRes = zipfile.ZipFile(res, 'w', zipfile.ZIP_DEFLATED)
+        for info in template.infolist():
+            content = template.read(info)
+            if info.filename == 'content.xml':
+                content = content.decode('utf-8')
+                start = content.index('<text:p ')
+                end = content.rindex('<text:p ')
+                content = content[:start] + content[start:end]*times + \
+                          content[end:]
+                content = content.encode('utf-8')
+            zipRes.writestr(info, content)
+        zipRes.close()
+        template.close()
+        f.close()
+        return res.getvalue()
+
+    def timeTemplate(self, times):
+        '''Returns the times needed for compiling and rendering a template
+           being p_times bigger than self.bodyTemplate.'''
+        data = self.getBigTemplate(times)
+        start = time.time()
+        compiled = CompiledTemplate(data)
+        compileTime = time.time() - start
+        start = time.time()
+        compiled.render(self.bodyContext, io.BytesIO())
+        return compileTime, time.time() - start
+
+    def timeXhtml(self, times):
+        '''Returns the time needed for rendering a XHTML chunk made of p_times
+           paragraphs and tables.'''
+        compiled = CompiledTemplate(os.path.join(self.templatesFolder,
+                                                 self.xhtmlTemplate))
+        xhtml = ''.join([self.xhtmlChunk % (i, i) for i in range(times)])
+        class Dummy:
+            def getAt1(self): return xhtml
+        start = time.time()
+        compiled.render({'dummy': Dummy()}, io.BytesIO())
+        return time.time() - start
+
+    def run(self):
+        print('%10s %12s %12s %12s' % ('size', 'compile (s)', 'render (s)',
+                                       'xhtml (s)'))
+        size = self.size
+        for i in range(self.steps):
+            compileTime, renderTime = self.timeTemplate(size)
+            xhtmlTime = self.timeXhtml(size)
+            print('%10d %12.2f %12.2f %12.2f' % (size, compileTime, renderTime,
+                                                 xhtmlTime))
+            size *= 2
+
+# ------------------------------------------------------------------------------
+if __name__ == '__main__':
+    if len(sys.argv) > 2:
+        print(usage)
+        sys.exit(1)
+    size = 500
+    if len(sys.argv) == 2: size = int(sys.argv[1])
+    Benchmark(size).run()
+# ------------------------------------------------------------------------------
@@ -0,0 +1,140 @@
+# ------------------------------------------------------------------------------
+# Appy is a framework for building applications in the Python language.
+# Copyright (C) 2007 Gaetan Delannay
+
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,USA.
+
+# ------------------------------------------------------------------------------
+import os, os.path, shutil, zipfile, tempfile, unittest
+
+from appy.pod.conversion_cache import ConversionCache
+
+# ------------------------------------------------------------------------------
+class CacheTests(unittest.TestCase):
+    '''Tests the cache of LibreOffice conversions, without LibreOffice: cached
+       files are simply put in it.'''
+    # Entries of the documents to convert
+    entries = (('mimetype', b'application/vnd.oasis.opendocument.text'),
+               ('content.xml', b'<content>%s</content>' % (b'x' * 5000)),
+               ('styles.xml', b'<styles/>'))
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp(prefix='pod.cache.')
+        self.cache = ConversionCache(os.path.join(self.folder, 'cache'))
+
+    def tearDown(self):
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def createFile(self, name, content):
+        path = os.path.join(self.folder, name)
+        f = open(path, 'wb')
+        f.write(content)
+        f.close()
+        return path
+
+    def createDocument(self, name, entries, date=(2020, 1, 1, 0, 0, 0),
+                       compressType=zipfile.ZIP_DEFLATED):
+        '''Creates, in the test folder, a zip file named p_name containing
+           p_entries, all with this p_date and p_compressType.'''
+        path = os.path.join(self.folder, name)
+        zipFile = zipfile.ZipFile(path, 'w')
+        for entryName, content in entries:
+            info = zipfile.ZipInfo(entryName, date)
+            zipFile.writestr(info, content, compressType)
+        zipFile.close()
+        return path
+
+    def read(self, path):
+        f = open(path, 'rb')
+        res = f.read()
+        f.close()
+        return res
+
+    def getCached(self):
+        '''Returns the sorted names of the cached files.'''
+        return sorted([name for name in os.listdir(self.cache.folder) \
+                       if not name.startswith('.')])
+
+    def testGetPut(self):
+        doc = self.createDocument('doc.odt', self.entries)
+        key = self.cache.getKey(doc, 'pdf')
+        target = os.path.join(self.folder, 'doc.pdf')
+        # Miss
+        self.assertFalse(self.cache.get(key, target))
+        self.assertFalse(os.path.exists(target))
+        # Hit
+        self.cache.put(key, self.createFile('result.pdf', b'%PDF-1.4 doc'))
+        self.assertTrue(self.cache.get(key, target))
+        self.assertEqual(self.read(target), b'%PDF-1.4 doc')
+        # Temp files are not left in the cache folder
+        self.assertEqual(os.listdir(self.cache.folder), [key])
+
+    def testKeys(self):
+        doc = self.createDocument('doc.odt', self.entries)
+        key = self.cache.getKey(doc, 'pdf')
+        self.assertTrue(key.endswith('.pdf'))
+        self.assertEqual(self.cache.getKey(doc, 'pdf'), key)
+        # Every result type has its own key
+        self.assertNotEqual(self.cache.getKey(doc, 'docx'), key)
+        # The styles template is part of the key
+        styles = self.createDocument('styles.ott', self.entries[:1])
+        self.assertNotEqual(self.cache.getKey(doc, 'pdf', styles), key)
+        # So is the content of the document
+        other = self.createDocument('other.odt', self.entries[:2])
+        self.assertNotEqual(self.cache.getKey(other, 'pdf'), key)
+
+    def testGetKeys(self):
+        doc = self.createDocument('doc.odt', self.entries)
+        styles = self.createDocument('styles.ott', self.entries[:1])
+        keys = self.cache.getKeys(doc, ('pdf', 'docx'), styles)
+        self.assertEqual(sorted(keys), ['docx', 'pdf'])
+        for resultType in ('pdf', 'docx'):
+            self.assertEqual(keys[resultType],
+                             self.cache.getKey(doc, resultType, styles))
+
+    def testRezippedDocument(self):
+        # The same entries, zipped at another date with another compression,
+        # produce the same key: uncompressed entries are hashed.
+        doc = self.createDocument('doc.odt', self.entries)
+        rezipped = self.createDocument('rezipped.odt', self.entries,
+                   (2021, 6, 15, 12, 30, 0), zipfile.ZIP_STORED)
+        self.assertNotEqual(self.read(doc), self.read(rezipped))
+        self.assertEqual(self.cache.getKey(doc, 'pdf'),
+                         self.cache.getKey(rezipped, 'pdf'))
+        key = self.cache.getKey(doc, 'pdf')
+        self.cache.put(key, self.createFile('result.pdf', b'%PDF-1.4 doc'))
+        target = os.path.join(self.folder, 'rezipped.pdf')
+        self.assertTrue(self.cache.get(self.cache.getKey(rezipped, 'pdf'),
+                                       target))
+
+    def testEviction(self):
+        cache = ConversionCache(self.cache.folder, maxSize=1000)
+        source = self.createFile('result.pdf', b'x' * 300)
+        for i, name in enumerate(('a', 'b', 'c')):
+            cache.put(name, source)
+            os.utime(os.path.join(cache.folder, name), (i + 1, i + 1))
+        self.assertEqual(self.getCached(), ['a', 'b', 'c'])
+        # Getting "a" marks it as recently used
+        self.assertTrue(cache.get('a', os.path.join(self.folder, 'a.pdf')))
+        # Exceeding the maximum size evicts the least recently used files,
+        # until the size is below maxSize * evictRatio.
+        cache.put('d', source)
+        self.assertEqual(self.getCached(), ['a', 'c', 'd'])
+        self.assertEqual(cache.size, 900)
+
+# ------------------------------------------------------------------------------
+if __name__ == '__main__':
+    unittest.main()
+# ------------------------------------------------------------------------------
@@ -0,0 +1,420 @@
+# ------------------------------------------------------------------------------
+# Appy is a framework for building applications in the Python language.
+# Copyright (C) 2007 Gaetan Delannay
+
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,USA.
+
+# ------------------------------------------------------------------------------
+import io, os, os.path, sys, stat, types, shutil, tempfile, unittest
+from unittest import mock
+
+from appy.pod.renderer import Renderer
+from appy.pod.converter import Connection, Converter, ConverterWorker, \
+                               ConverterError, ConverterScript, BatchConverter
+
+# Fake UNO ---------------------------------------------------------------------
+class DisposedException(Exception): pass
+class IllegalArgumentException(Exception): pass
+class IndexOutOfBoundsException(Exception): pass
+class PropertyValue: pass
+
+def getUnoModules():
+    '''Returns fake versions of the UNO modules imported by the converter, as
+       a dict ~{s_name: module}~ to be patched into sys.modules.'''
+    lang = types.ModuleType('com.sun.star.lang')
+    lang.DisposedException = DisposedException
+    lang.IllegalArgumentException = IllegalArgumentException
+    lang.IndexOutOfBoundsException = IndexOutOfBoundsException
+    beans = types.ModuleType('com.sun.star.beans')
+    beans.PropertyValue = PropertyValue
+    unohelper = types.ModuleType('unohelper')
+    unohelper.systemPathToFileUrl = lambda path: 'file://%s' % path
+    res = {'unohelper': unohelper, 'com.sun.star.lang': lang,
+           'com.sun.star.beans': beans}
+    for name in ('com', 'com.sun', 'com.sun.star'):
+        res[name] = types.ModuleType(name)
+    return res
+
+# A fake UNO-enabled interpreter, run as "<python> converter.py --serve -p
+# <port>". It answers conversion requests like converter.py in "serve" mode,
+# depending on the start of the document to convert: "hang" makes it hang,
+# "stray" makes it write a stray line before its answer and "error" makes the
+# conversion fail. Else, it writes its pid in every result file.
+FAKE_PYTHON = '''#!%s
+import sys, os, os.path, time, json
+while True:
+    line = sys.stdin.readline()
+    if not line: break
+    request = json.loads(line)
+    f = open(request['doc'], 'rb')
+    content = f.read()
+    f.close()
+    if content.startswith(b'hang'): time.sleep(60)
+    if content.startswith(b'stray'): sys.stdout.write('Converting...\\n')
+    if content.startswith(b'error'):
+        response = {'error': 'Conversion failed'}
+    else:
+        resultTypes = request['type']
+        if isinstance(resultTypes, str): resultTypes = [resultTypes]
+        base = os.path.splitext(request['doc'])[0]
+        for resultType in resultTypes:
+            f = open('%%s.%%s' %% (base, resultType), 'w')
+            f.write(str(os.getpid()))
+            f.close()
+        response = {}
+    sys.stdout.write(json.dumps(response) + '\\n')
+    sys.stdout.flush()
+'''
+
+class FakeDesktop:
+    '''A fake LibreOffice desktop, recording, in the p_test, the documents it
+       loads and stores. If p_disposed is True, it behaves like a desktop
+       whose UNO bridge died.'''
+    def __init__(self, test, disposed=False):
+        self.test = test
+        self.disposed = disposed
+
+    def loadComponentFromURL(self, url, frame, flags, props):
+        if self.disposed: raise DisposedException()
+        self.test.loads.append(url)
+        return FakeDocument(self.test)
+
+class FakeDocument:
+    def __init__(self, test):
+        self.test = test
+
+    def refresh(self): pass
+
+    def storeToURL(self, url, props):
+        props = dict([(prop.Name, prop.Value) for prop in props])
+        self.test.stores.append((url, props['FilterName']))
+
+    def close(self, deliverOwnership):
+        self.test.closed += 1
+
+# ------------------------------------------------------------------------------
+class ConnectionTests(unittest.TestCase):
+    '''Tests the reuse of the connection to LibreOffice, faked, as well as
+       UNO, by the classes above.'''
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp(prefix='pod.converter.')
+        self.doc = os.path.join(self.folder, 'doc.txt')
+        f = open(self.doc, 'w')
+        f.write('Hello')
+        f.close()
+        # The desktops returned by the successive connections
+        self.desktops = []
+        self.connects = []
+        self.loads = []
+        self.stores = []
+        self.closed = 0
+        test = self
+        def connect(connection):
+            test.connects.append(connection.port)
+            connection.oo = test.desktops.pop(0)
+        self.patches = [mock.patch.dict(sys.modules, getUnoModules()),
+                        mock.patch.dict(Connection.connections, clear=True),
+                        mock.patch.object(Connection, 'connect', connect)]
+        for patch in self.patches: patch.start()
+
+    def tearDown(self):
+        for patch in self.patches: patch.stop()
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def testReuse(self):
+        self.desktops = [FakeDesktop(self), FakeDesktop(self)]
+        Converter(self.doc, 'pdf', 2002).run()
+        Converter(self.doc, 'pdf', 2002).run()
+        # A single connection was established for both conversions
+        self.assertEqual(self.connects, [2002])
+        self.assertEqual(len(self.loads), 2)
+        pdf = 'file://%s' % os.path.join(self.folder, 'doc.pdf')
+        self.assertEqual(self.stores, [(pdf, 'writer_pdf_Export')] * 2)
+        self.assertEqual(self.closed, 2)
+        # Another port gets its own connection
+        Converter(self.doc, 'pdf', 2003).run()
+        self.assertEqual(self.connects, [2002, 2003])
+
+    def testReconnect(self):
+        # The UNO bridge of the first connection died: the converter
+        # reconnects and converts the document anyway.
+        self.desktops = [FakeDesktop(self, disposed=True), FakeDesktop(self)]
+        Converter(self.doc, 'pdf', 2002).run()
+        self.assertEqual(self.connects, [2002, 2002])
+        self.assertEqual(len(self.stores), 1)
+        # The new connection is reused
+        Converter(self.doc, 'pdf', 2002).run()
+        self.assertEqual(self.connects, [2002, 2002])
+        self.assertEqual(len(self.stores), 2)
+
+    def testResultTypes(self):
+        self.desktops = [FakeDesktop(self)]
+        Converter(self.doc, ['pdf', 'odt'], 2002).run()
+        # The document is loaded once and stored in every type
+        self.assertEqual(len(self.loads), 1)
+        base = 'file://%s' % os.path.join(self.folder, 'doc')
+        self.assertEqual(self.stores, [(base + '.pdf', 'writer_pdf_Export'),
+                                       (base + '.odt', 'writer8')])
+        self.assertRaises(ConverterError, Converter, self.doc, ['pdf', 'abc'])
+
+    def testScriptResultTypes(self):
+        # The command line accepts comma-separated result types
+        self.desktops = [FakeDesktop(self)]
+        with mock.patch.object(sys, 'argv', ['converter.py', self.doc,
+                                             'pdf,odt']):
+            ConverterScript().run()
+        self.assertEqual(len(self.loads), 1)
+        self.assertEqual([filter for url, filter in self.stores],
+                         ['writer_pdf_Export', 'writer8'])
+
+    def testScriptBatch(self):
+        # Given a folder, the command line converts all the files it contains
+        docs = os.path.join(self.folder, 'docs')
+        os.mkdir(docs)
+        for name in ('a.txt', 'b.txt'):
+            shutil.copy(self.doc, os.path.join(docs, name))
+        self.desktops = [FakeDesktop(self)]
+        out = io.StringIO()
+        with mock.patch.object(sys, 'argv', ['converter.py', docs, 'pdf']), \
+             mock.patch.object(sys, 'stdout', out):
+            ConverterScript().run()
+        self.assertEqual(out.getvalue().strip(),
+                         '2/2 file(s) converted, 0 error(s).')
+        # A single connection was used
+        self.assertEqual(self.connects, [2002])
+        self.assertEqual([os.path.basename(url) for url, f in self.stores],
+                         ['a.pdf', 'b.pdf'])
+
+    def testReset(self):
+        self.desktops = [FakeDesktop(self), FakeDesktop(self)]
+        first = Connection.get(2002)
+        self.assertIs(Connection.get(2002), first)
+        Connection.reset(2002)
+        self.assertIsNot(Connection.get(2002), first)
+        self.assertEqual(self.connects, [2002, 2002])
+
+# ------------------------------------------------------------------------------
+class WorkerTests(unittest.TestCase):
+    '''Tests the protocol between a converter worker and the process it
+       runs, that is a fake UNO-enabled interpreter.'''
+    testFolder = os.path.dirname(os.path.abspath(__file__))
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp(prefix='pod.worker.')
+        self.python = os.path.join(self.folder, 'python')
+        f = open(self.python, 'w')
+        f.write(FAKE_PYTHON % sys.executable)
+        f.close()
+        os.chmod(self.python, os.stat(self.python).st_mode | stat.S_IEXEC)
+        # The workers taken from the pool by the test
+        self.workers = []
+
+    def tearDown(self):
+        for worker in self.workers: worker.kill()
+        ConverterWorker.stopAll()
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def createDoc(self, name, content):
+        path = os.path.join(self.folder, name)
+        f = open(path, 'w')
+        f.write(content)
+        f.close()
+        return path
+
+    def getWorker(self):
+        res = ConverterWorker.get(self.python, 2002)
+        self.workers.append(res)
+        return res
+
+    def getPid(self, doc, resultType='pdf'):
+        '''Gets the pid of the worker process having converted p_doc.'''
+        f = open('%s.%s' % (os.path.splitext(doc)[0], resultType))
+        res = int(f.read())
+        f.close()
+        return res
+
+    def testReuse(self):
+        doc1 = self.createDoc('doc1.odt', 'Hello')
+        doc2 = self.createDoc('doc2.odt', 'Hello')
+        worker = self.getWorker()
+        worker.convert(doc1, 'pdf')
+        ConverterWorker.release(worker)
+        # The idle worker is reused, with its process
+        self.assertIs(self.getWorker(), worker)
+        worker.convert(doc2, 'pdf')
+        self.assertEqual(self.getPid(doc1), worker.process.pid)
+        self.assertEqual(self.getPid(doc2), worker.process.pid)
+        # While it is busy, another worker is started
+        other = self.getWorker()
+        self.assertIsNot(other, worker)
+        other.convert(doc1, 'pdf')
+        self.assertEqual(self.getPid(doc1), other.process.pid)
+
+    def testError(self):
+        worker = self.getWorker()
+        with self.assertRaises(ConverterError) as cm:
+            worker.convert(self.createDoc('error.odt', 'error'), 'pdf')
+        self.assertEqual(str(cm.exception), 'Conversion failed')
+        # The worker is still usable
+        self.assertIsNone(worker.process.poll())
+        doc = self.createDoc('doc.odt', 'Hello')
+        worker.convert(doc, 'pdf')
+        self.assertEqual(self.getPid(doc), worker.process.pid)
+
+    def testTimeout(self):
+        worker = self.getWorker()
+        with mock.patch.object(ConverterWorker, 'timeout', 1):
+            with self.assertRaises(ConverterError) as cm:
+                worker.convert(self.createDoc('hang.odt', 'hang'), 'pdf')
+        self.assertIn('did not answer within 1 seconds', str(cm.exception))
+        # The hung process was killed
+        self.assertIsNotNone(worker.process.returncode)
+
+    def testDesync(self):
+        worker = self.getWorker()
+        with self.assertRaises(ConverterError) as cm:
+            worker.convert(self.createDoc('stray.odt', 'stray'), 'pdf')
+        self.assertIn('"Converting..."', str(cm.exception))
+        # The worker, whose next answer would be the answer to this request,
+        # was killed.
+        self.assertIsNotNone(worker.process.returncode)
+
+    def testDied(self):
+        worker = self.getWorker()
+        worker.process.kill()
+        worker.process.wait()
+        with self.assertRaises(ConverterError) as cm:
+            worker.convert(self.createDoc('doc.odt', 'Hello'), 'pdf')
+        self.assertIn('died', str(cm.exception))
+
+    def testResultTypes(self):
+        doc = self.createDoc('doc.odt', 'Hello')
+        worker = self.getWorker()
+        worker.convert(doc, ['pdf', 'docx'])
+        self.assertEqual(self.getPid(doc, 'pdf'), worker.process.pid)
+        self.assertEqual(self.getPid(doc, 'docx'), worker.process.pid)
+
+    def testBatch(self):
+        docs = [self.createDoc('doc%d.odt' % i, 'Hello') for i in range(4)]
+        docs.insert(2, self.createDoc('error.odt', 'error'))
+        # Documents are converted sequentially, by the same worker
+        converter = BatchConverter(docs, 'pdf', pythonWithUnoPath=self.python)
+        results = list(converter.run())
+        self.assertEqual(results, [(doc, None) for doc in docs[:2]] + \
+            [(docs[2], 'Conversion failed')] + \
+            [(doc, None) for doc in docs[3:]])
+        pids = set([self.getPid(doc) for doc in docs if doc != docs[2]])
+        self.assertEqual(len(pids), 1)
+        # With several ports, documents are converted in parallel, by one
+        # worker per port.
+        converter = BatchConverter(docs, 'pdf', [2002, 2003],
+                                   pythonWithUnoPath=self.python)
+        results = dict(converter.run())
+        self.assertEqual(sorted(results), sorted(docs))
+        self.assertEqual(results[docs[2]], 'Conversion failed')
+        self.assertEqual(len([e for e in results.values() if e]), 1)
+        workers = ConverterWorker.workers
+        self.assertEqual(len(workers[(self.python, 2002)]), 1)
+        self.assertEqual(len(workers[(self.python, 2003)]), 1)
+
+    def testRenderer(self):
+        # Without UNO, the renderer converts its result via a worker
+        template = os.path.join(self.testFolder, 'templates', 'NoPython.odt')
+        result = os.path.join(self.folder, 'result.pdf')
+        for i in range(2):
+            Renderer(template, {}, result, pythonWithUnoPath=self.python,
+                     overwriteExisting=True).run()
+            f = open(result)
+            pid = int(f.read())
+            f.close()
+            if i: self.assertEqual(pid, first)
+            first = pid
+        # The worker was put back into the pool
+        workers = ConverterWorker.workers[(self.python, 2002)]
+        self.assertEqual([w.process.pid for w in workers], [pid])
+
+    def testRendererResults(self):
+        # The result is rendered once, then converted into every type
+        template = os.path.join(self.testFolder, 'templates', 'NoPython.odt')
+        results = [os.path.join(self.folder, 'result.%s' % resultType) \
+                   for resultType in ('pdf', 'docx')]
+        Renderer(template, {}, results, pythonWithUnoPath=self.python,
+                 overwriteExisting=True).run()
+        pids = []
+        for result in results:
+            f = open(result)
+            pids.append(int(f.read()))
+            f.close()
+        self.assertEqual(pids[0], pids[1])
+
+# ------------------------------------------------------------------------------
+class BatchTests(unittest.TestCase):
+    '''Tests the expansion of the inputs of a batch conversion.'''
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp(prefix='pod.batch.')
+        for name in ('a.odt', 'b.txt', '.hidden.odt', 'a.pdf',
+                     os.path.join('sub', 'c.odt')):
+            path = os.path.join(self.folder, 'docs', name)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            f = open(path, 'w')
+            f.write('Hello')
+            f.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def getPaths(self, inputs, resultType='pdf'):
+        return list(BatchConverter(inputs, resultType).getPaths())
+
+    def testFolder(self):
+        # Hidden files and results of a previous run are ignored
+        docs = os.path.join(self.folder, 'docs')
+        self.assertEqual(self.getPaths(docs),
+            [os.path.join(docs, name) for name in \
+             ('a.odt', 'b.txt', os.path.join('sub', 'c.odt'))])
+        self.assertEqual(self.getPaths(docs, ['pdf', 'txt']),
+            [os.path.join(docs, name) for name in \
+             ('a.odt', os.path.join('sub', 'c.odt'))])
+
+    def testManifest(self):
+        docs = os.path.join(self.folder, 'docs')
+        manifest = os.path.join(docs, 'sub', 'manifest')
+        f = open(manifest, 'w')
+        f.write('# Documents to convert\n\n../a.odt\n  c.odt  \n%s\n' % \
+                os.path.join(docs, 'b.txt'))
+        f.close()
+        sub = os.path.join(docs, 'sub')
+        # Paths are relative to the manifest folder
+        self.assertEqual(self.getPaths('@%s' % manifest),
+                         [os.path.join(sub, '../a.odt'),
+                          os.path.join(sub, 'c.odt'),
+                          os.path.join(docs, 'b.txt')])
+        # Manifests, folders and files can be mixed, in this order
+        self.assertEqual(self.getPaths([os.path.join(docs, 'b.txt'),
+                                        '@%s' % manifest, sub]),
+                         [os.path.join(docs, 'b.txt'),
+                          os.path.join(sub, '../a.odt'),
+                          os.path.join(sub, 'c.odt'),
+                          os.path.join(docs, 'b.txt'),
+                          os.path.join(sub, 'c.odt'),
+                          manifest])
+
+# ------------------------------------------------------------------------------
+if __name__ == '__main__':
+    unittest.main()
+# ------------------------------------------------------------------------------
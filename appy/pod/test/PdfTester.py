@@ -0,0 +1,154 @@
+# ------------------------------------------------------------------------------
+# Appy is a framework for building applications in the Python language.
+# Copyright (C) 2007 Gaetan Delannay
+
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,USA.
+
+# ------------------------------------------------------------------------------
+import os, os.path, sys, stat, json, shutil, zipfile, tempfile, unittest
+
+from appy.pod.renderer import Renderer
+from appy.pod.doc_importers import PdfImporter
+from appy.pod.conversion_cache import ConversionCache
+
+# ------------------------------------------------------------------------------
+# A fake gs, that logs its arguments in file "gs.log". The fake PDF file
+# contains its number of pages, as "pages=<n>". Asked for this number, it
+# only answers in safe mode, and if the PDF file does not contain "nocount".
+# Asked to rasterise pages, it writes, for each one, a copy of "page.jpg".
+FAKE_GS = '''#!%s
+import sys, os.path, re, json, shutil
+folder = os.path.dirname(os.path.abspath(__file__))
+args = sys.argv[1:]
+f = open(os.path.join(folder, 'gs.log'), 'a')
+f.write(json.dumps(args) + '\\n')
+f.close()
+if '-dNODISPLAY' in args:
+    pdf = [a for a in args if a.startswith('--permit-file-read=')][0]
+    content = open(pdf.split('=', 1)[1]).read()
+    if ('-dSAFER' not in args) or ('nocount' in content): sys.exit(1)
+    print(re.search(r'pages=(\\d+)', content).group(1))
+    sys.exit(0)
+content = open(args[-1]).read()
+options = dict([a[2:].split('=', 1) for a in args \\
+                if a.startswith(('-d', '-s')) and ('=' in a)])
+first = int(options['FirstPage'])
+last = int(options.get('LastPage') or \\
+           re.search(r'pages=(\\d+)', content).group(1))
+for i in range(1, last - first + 2):
+    shutil.copy(os.path.join(folder, 'page.jpg'), options['OutputFile'] %% i)
+'''
+
+# ------------------------------------------------------------------------------
+class PdfTests(unittest.TestCase):
+    '''Tests the import of PDF files, rasterised by a fake gs found in the
+       PATH.'''
+    testFolder = os.path.dirname(os.path.abspath(__file__))
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp(prefix='pod.pdf.')
+        path = os.path.join(self.folder, 'gs')
+        f = open(path, 'w')
+        f.write(FAKE_GS % sys.executable)
+        f.close()
+        os.chmod(path, os.stat(path).st_mode | stat.S_IEXEC)
+        shutil.copy(os.path.join(self.testFolder, 'images', 'linux.jpg'),
+                    os.path.join(self.folder, 'page.jpg'))
+        self.path = os.environ['PATH']
+        os.environ['PATH'] = self.folder + os.pathsep + self.path
+        self.maxWorkers = PdfImporter.maxWorkers
+        PdfImporter.maxWorkers = 2
+
+    def tearDown(self):
+        os.environ['PATH'] = self.path
+        PdfImporter.maxWorkers = self.maxWorkers
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def createPdf(self, content):
+        path = os.path.join(self.folder, 'doc.pdf')
+        f = open(path, 'w')
+        f.write('%%PDF-1.4 %s' % content)
+        f.close()
+        return path
+
+    def render(self, pdf, pages=None, **kwargs):
+        '''Renders template PdfImport, importing p_pdf. Returns the number of
+           images in the result and the calls to gs, as lists of arguments.'''
+        log = os.path.join(self.folder, 'gs.log')
+        if os.path.exists(log): os.remove(log)
+        template = os.path.join(self.testFolder, 'templates', 'PdfImport.odt')
+        result = os.path.join(self.folder, 'result.odt')
+        Renderer(template, {'pdf': pdf, 'pages': pages}, result,
+                 overwriteExisting=True, **kwargs).run()
+        zipFile = zipfile.ZipFile(result)
+        images = zipFile.read('content.xml').decode().count('<draw:image ')
+        zipFile.close()
+        calls = []
+        if os.path.exists(log):
+            f = open(log)
+            calls = [json.loads(line) for line in f]
+            f.close()
+        return images, calls
+
+    def getRange(self, args):
+        '''Gets the pages rasterised by the gs call having these p_args.'''
+        res = [None, None]
+        for arg in args:
+            if arg.startswith('-dFirstPage='): res[0] = int(arg[12:])
+            elif arg.startswith('-dLastPage='): res[1] = int(arg[11:])
+        return tuple(res)
+
+    def testAllPages(self):
+        pdf = self.createPdf('pages=6')
+        images, calls = self.render(pdf)
+        self.assertEqual(images, 6)
+        # The number of pages is asked to gs in safe mode
+        count = calls[0]
+        self.assertIn('-dSAFER', count)
+        self.assertIn('--permit-file-read=%s' % os.path.abspath(pdf), count)
+        # Pages are rasterised by 2 gs processes
+        self.assertEqual(sorted([self.getRange(c) for c in calls[1:]]),
+                         [(1, 3), (4, 6)])
+
+    def testSparsePages(self):
+        images, calls = self.render(self.createPdf('pages=6'), [5, 1, 3])
+        self.assertEqual(images, 3)
+        # The number of pages is not asked: every page is rasterised by its
+        # own gs process.
+        self.assertEqual(sorted([self.getRange(c) for c in calls]),
+                         [(1, 1), (3, 3), (5, 5)])
+
+    def testUnknownPageCount(self):
+        images, calls = self.render(self.createPdf('pages=2 nocount'))
+        self.assertEqual(images, 2)
+        # All pages are rasterised by a single gs process
+        self.assertEqual([self.getRange(c) for c in calls[1:]], [(1, None)])
+
+    def testCache(self):
+        cache = ConversionCache(os.path.join(self.folder, 'cache'))
+        pdf = self.createPdf('pages=6')
+        images, calls = self.render(pdf, [1, 2], conversionCache=cache)
+        self.assertEqual(images, 2)
+        self.assertEqual(sorted([self.getRange(c) for c in calls]),
+                         [(1, 1), (2, 2)])
+        # Cached pages are not rasterised again
+        images, calls = self.render(pdf, [1, 2, 3], conversionCache=cache)
+        self.assertEqual(images, 3)
+        self.assertEqual([self.getRange(c) for c in calls], [(3, 3)])
+
+# ------------------------------------------------------------------------------
+if __name__ == '__main__':
+    unittest.main()
+# ------------------------------------------------------------------------------
@@ -0,0 +1,109 @@
+# ------------------------------------------------------------------------------
+# Appy is a framework for building applications in the Python language.
+# Copyright (C) 2007 Gaetan Delannay
+
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,USA.
+
+# ------------------------------------------------------------------------------
+import io, os, os.path, shutil, zipfile, tempfile, unittest
+from unittest import mock
+
+from appy.pod import PodError
+from appy.pod.buffers import MemoryBuffer
+from appy.pod.renderer import Renderer, CompiledTemplate
+
+# ------------------------------------------------------------------------------
+class RendererTests(unittest.TestCase):
+    '''Tests the renderer on aspects that the test plan in Tests.rtf, that
+       compares results, can't check.'''
+    testFolder = os.path.dirname(os.path.abspath(__file__))
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp(prefix='pod.renderer.')
+
+    def tearDown(self):
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def getTemplate(self, name):
+        f = open(os.path.join(self.testFolder, 'templates', name), 'rb')
+        res = f.read()
+        f.close()
+        return res
+
+    def testInMemory(self):
+        # Rendering from bytes into a stream requires no temp folder
+        result = io.BytesIO()
+        with mock.patch.object(tempfile, 'mkdtemp', side_effect=OSError):
+            Renderer(self.getTemplate('SimpleForFilledList.odt'),
+                     {'list1': ['a', 'b']}, result).run()
+        zipFile = zipfile.ZipFile(result)
+        content = zipFile.read('content.xml').decode('utf-8')
+        zipFile.close()
+        self.assertIn('>Standard a<', content)
+        self.assertIn('>Standard b<', content)
+
+    def testMissingFolder(self):
+        result = os.path.join(self.folder, 'missing', 'result.odt')
+        with self.assertRaises(PodError) as cm:
+            Renderer(self.getTemplate('NoPython.odt'), {}, result)
+        self.assertIn('does not exist or is not writable', str(cm.exception))
+
+    def testUnwritableFolder(self):
+        # os.access is faked: tests may run as root, that can write anywhere
+        result = os.path.join(self.folder, 'result.odt')
+        access = lambda path, mode: path != self.folder
+        with mock.patch.object(os, 'access', access):
+            with self.assertRaises(PodError) as cm:
+                Renderer(self.getTemplate('NoPython.odt'), {}, result)
+        self.assertIn(self.folder, str(cm.exception))
+        self.assertFalse(os.path.exists(result))
+
+    def getBuffers(self, buffers):
+        '''Gets the memory buffers among p_buffers, and their sub-buffers.'''
+        res = []
+        for buffer in buffers:
+            if not isinstance(buffer, MemoryBuffer): continue
+            res.append(buffer)
+            res += self.getBuffers(buffer.subBuffers.values())
+        return res
+
+    def testOperations(self):
+        # The operations of a memory buffer are computed at its first
+        # evaluation, then reused by the next renderings.
+        compiled = CompiledTemplate(self.getTemplate('SimpleForFilledList.odt'))
+        root = compiled.contentParser.env.currentBuffer
+        buffers = self.getBuffers(root.parts)
+        self.assertTrue(buffers)
+        for i in range(3):
+            result = io.BytesIO()
+            compiled.render({'list1': ['a%d' % i, 'b%d' % i]}, result)
+            if not i:
+                operations = [dict(buffer.operations) for buffer in buffers]
+                self.assertTrue([ops for ops in operations if ops])
+            else:
+                for buffer, ops in zip(buffers, operations):
+                    self.assertEqual(sorted(buffer.operations), sorted(ops))
+                    for key, value in ops.items():
+                        self.assertIs(buffer.operations[key], value)
+            zipFile = zipfile.ZipFile(result)
+            content = zipFile.read('content.xml').decode('utf-8')
+            zipFile.close()
+            self.assertIn('>Standard a%d<' % i, content)
+            self.assertIn('>Standard b%d<' % i, content)
+
+# ------------------------------------------------------------------------------
+if __name__ == '__main__':
+    unittest.main()
+# ------------------------------------------------------------------------------
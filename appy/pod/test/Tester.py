@@ -17,18 +17,20 @@
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,USA.
 
 # ------------------------------------------------------------------------------
-import os, os.path, sys, zipfile, re, shutil
+import os, os.path, sys, io, zipfile, re, shutil
 import appy.shared.test
 from appy.shared.test import TesterError
 from appy.shared.utils import FolderDeleter
 from appy.shared.xml_parser import escapeXml
+from appy.pod import renderMany
 from appy.pod.odf_parser import OdfEnvironment, OdfParser
-from appy.pod.renderer import Renderer
+from appy.pod.renderer import Renderer, CompiledTemplate
 
 # TesterError-related constants ------------------------------------------------
 TEMPLATE_NOT_FOUND = 'Template file "%s" was not found.'
 CONTEXT_NOT_FOUND = 'Context file "%s" was not found.'
 EXPECTED_RESULT_NOT_FOUND = 'Expected result "%s" was not found.'
+PICTURES_DIFFER = 'Pictures differ: %s (expected: %s).'
 
 # ------------------------------------------------------------------------------
 class AnnotationsRemover(OdfParser):
@@ -78,6 +80,18 @@ class AnnotationsRemover(OdfParser):
 class Test(appy.shared.test.Test):
     '''Abstract test class.'''
     interestingOdtContent = ('content.xml', 'styles.xml')
+    # Error messages may contain absolute paths to Appy files. In results,
+    # the folder where Appy is installed is replaced with "APPY".
+    appyFolder = os.path.dirname(os.path.abspath(appy.__file__))
+    # Results that are not zipped ODF files, but text files compared as is
+    textResults = ('txt', 'csv', 'html')
+    # Results that are flat ODF files, compared as XML files
+    flatResults = ('fodt', 'fods')
+    # XML tags and attributes whose differences are ignored
+    xmlTagsToIgnore = ((OdfEnvironment.NS_DC, 'date'),
+                       (OdfEnvironment.NS_STYLE, 'style'))
+    xmlAttrsToIgnore = ('draw:name', 'text:name', 'text:bullet-char',
+                        'table:name', 'table:style-name')
 
     def __init__(self, testData, testDescription, testFolder, config, flavour):
         appy.shared.test.Test.__init__(self, testData, testDescription,
@@ -101,11 +115,8 @@ class Test(appy.shared.test.Test):
                 exec('res[elem] = %s.%s' % (contextPkg, elem))
         return res
 
-    def do(self):
-        self.result = os.path.join(
-            self.tempFolder, '%s.%s' % (
-                self.data['Name'], self.data['Result']))
-        # Get the path to the template to use for this test
+    def getTemplate(self):
+        '''Gets the path to the template to use for this test.'''
         if self.data['Template'].endswith('.ods'):
             suffix = ''
         else:
@@ -116,18 +127,37 @@ class Test(appy.shared.test.Test):
                                 self.data['Template'] + suffix)
         if not os.path.exists(template):
             raise TesterError(TEMPLATE_NOT_FOUND % template)
-        # Get the context
-        context = self.getContext(self.data['Context'])
+        return template
+
+    def getRendererParams(self):
+        '''Gets the parameters to give to the renderer, apart from the
+           template, context and result.'''
         # Get the OpenOffice port
         ooPort = self.data['OpenOfficePort']
         pythonWithUno = self.config['pythonWithUnoPath']
         # Get the styles mapping
         stylesMapping = eval('{' + self.data['StylesMapping'] + '}')
         # Mmh, dicts are not yet managed by RtfTablesParser
+        res = {'ooPort': ooPort, 'pythonWithUnoPath': pythonWithUno,
+               'stylesMapping': stylesMapping}
+        # Get the other parameters, written like the styles mapping
+        res.update(eval('{' + self.data['RendererParams'] + '}'))
+        # A styles template is given by its name in the templates folder
+        if 'stylesTemplate' in res:
+            res['stylesTemplate'] = os.path.join(self.templatesFolder,
+                                                 res['stylesTemplate'])
+        return res
+
+    def do(self):
+        self.result = os.path.join(
+            self.tempFolder, '%s.%s' % (
+                self.data['Name'], self.data['Result']))
+        template = self.getTemplate()
+        # Get the context
+        context = self.getContext(self.data['Context'])
         # Call the renderer.
-        Renderer(template, context, self.result, ooPort=ooPort,
-                 pythonWithUnoPath=pythonWithUno,
-                 stylesMapping=stylesMapping).run()
+        Renderer(template, context, self.result,
+                 **self.getRendererParams()).run()
         # Store all result files
         # I should allow to do this from an option given to Tester.py: this code
         # keeps in a separate folder the odt results of all ran tests.
@@ -137,15 +167,9 @@ class Test(appy.shared.test.Test):
         #print('Result is %s, temp folder 2 is %s.' % (self.result,tempFolder2))
         #shutil.copy(self.result, tempFolder2)
 
-    def getOdtContent(self, odtFile):
+    def getOdtContent(self, odtFile, filePrefix):
         '''Creates in the temp folder content.xml and styles.xml extracted
-           from p_odtFile.'''
-        contentXml = None
-        stylesXml = None
-        if odtFile == self.result:
-            filePrefix = 'actual'
-        else:
-            filePrefix = 'expected'
+           from p_odtFile, prefixed with p_filePrefix.'''
         zipFile = zipfile.ZipFile(odtFile)
         for zippedFile in zipFile.namelist():
             if zippedFile in self.interestingOdtContent:
@@ -160,38 +184,63 @@ class Test(appy.shared.test.Test):
                     annotationsRemover = AnnotationsRemover(
                        OdfEnvironment(), self)
                     annotationsRemover.parse(fileContent.decode('utf-8'))
-                    fileContent = annotationsRemover.getResult().encode('utf-8')
+                    fileContent = annotationsRemover.getResult().replace(
+                        self.appyFolder, 'APPY').encode('utf-8')
                
                 f.write(fileContent)
                 f.close()
         zipFile.close()
 
-    def checkResult(self):
-        '''r_ is False if the test succeeded.'''
-        # Get styles.xml and content.xml from the actual result
+    def getPictures(self, odtFile):
+        '''Gets the sorted names of the pictures stored in p_odtFile.'''
+        zipFile = zipfile.ZipFile(odtFile)
+        res = sorted([n for n in zipFile.namelist() \
+                      if n.startswith('Pictures/')])
+        zipFile.close()
+        return res
+
+    def getExpectedResult(self, name):
+        '''Gets the path to the expected result of the test named p_name.'''
+        res = os.path.join(self.resultsFolder,
+                           '%s.%s' % (name, self.data['Result']))
+        if not os.path.exists(res):
+            raise TesterError(EXPECTED_RESULT_NOT_FOUND % res)
+        return res
+
+    def compareResults(self, result, expectedResult):
+        '''r_ is True if p_result differs from p_expectedResult.'''
+        if self.data['Result'] in self.textResults:
+            return self.compareFiles(result, expectedResult, encoding='utf-8')
+        if self.data['Result'] in self.flatResults:
+            return self.compareFiles(result, expectedResult, areXml=True,
+                xmlTagsToIgnore=self.xmlTagsToIgnore,
+                xmlAttrsToIgnore=self.xmlAttrsToIgnore, encoding='utf-8')
         res = False
-        self.getOdtContent(self.result)
-        # Get styles.xml and content.xml from the expected result
-        expectedResult = os.path.join(self.resultsFolder,
-                                  self.data['Name'] + '.' + self.data['Result'])
-        if not os.path.exists(expectedResult):
-            raise TesterError(EXPECTED_RESULT_NOT_FOUND % expectedResult)
-        self.getOdtContent(expectedResult)
+        # Get styles.xml and content.xml from the actual and expected results
+        self.getOdtContent(result, 'actual')
+        self.getOdtContent(expectedResult, 'expected')
         for fileName in self.interestingOdtContent:
             diffOccurred = self.compareFiles(
                 os.path.join(self.tempFolder, 'actual.%s' % fileName),
                 os.path.join(self.tempFolder, 'expected.%s' % fileName),
-                areXml=True, xmlTagsToIgnore=(
-                   (OdfEnvironment.NS_DC, 'date'),
-                   (OdfEnvironment.NS_STYLE, 'style')),
-                xmlAttrsToIgnore=('draw:name','text:name','text:bullet-char',
-                                  'table:name', 'table:style-name'),
-                encoding='utf-8')
+                areXml=True, xmlTagsToIgnore=self.xmlTagsToIgnore,
+                xmlAttrsToIgnore=self.xmlAttrsToIgnore, encoding='utf-8')
             if diffOccurred:
                 res = True
                 break
+        # Every picture must be stored once (and only once) in the result
+        pictures = self.getPictures(result)
+        expectedPictures = self.getPictures(expectedResult)
+        if pictures != expectedPictures:
+            self.report.say(PICTURES_DIFFER % (pictures, expectedPictures))
+            res = True
         return res
 
+    def checkResult(self):
+        '''r_ is False if the test succeeded.'''
+        return self.compareResults(self.result,
+                                   self.getExpectedResult(self.data['Name']))
+
 # Concrete test classes --------------------------------------------------------
 class NominalTest(Test):
     '''Tests an application model.'''
@@ -209,12 +258,77 @@ class ErrorTest(Test):
         Test.onError(self)
         return not self.isExpectedError(self.data['Message'])
 
+class CompiledTest(Test):
+    '''Compiles a template once, then renders it with several contexts.'''
+    def do(self):
+        compiled = CompiledTemplate(self.getTemplate())
+        self.results = self.getResults()
+        for contextName, result in zip(self.data['Contexts'], self.results):
+            compiled.render(self.getContext(contextName), result,
+                            **self.getRendererParams())
+
+    def getResults(self):
+        '''Gets the paths to the results, one per context.'''
+        return [os.path.join(self.tempFolder, '%s%d.%s' % (self.data['Name'],
+                i+1, self.data['Result'])) \
+                for i in range(len(self.data['Contexts']))]
+
+    def checkResult(self):
+        '''Every result must be the expected result of the test whose name is
+           at the same rank in column "Expected".'''
+        for result, name in zip(self.results, self.data['Expected']):
+            if self.compareResults(result, self.getExpectedResult(name)):
+                return True
+        return False
+
+class BatchTest(CompiledTest):
+    '''Renders a template with several contexts, via appy.pod.renderMany.'''
+    def do(self):
+        contexts = [self.getContext(name) for name in self.data['Contexts']]
+        self.results = self.getResults()
+        for result, error in renderMany(self.getTemplate(), contexts,
+                                        self.results, self.data['Workers'],
+                                        **self.getRendererParams()):
+            if error: raise TesterError(error)
+
+class StreamTest(Test):
+    '''Renders a template, given as bytes or as a stream (see column Input),
+       into a stream. The result is compared to the expected result of the
+       test whose name is in column Expected.'''
+    def do(self):
+        f = open(self.getTemplate(), 'rb')
+        template = f.read()
+        f.close()
+        if self.data['Input'] == 'stream': template = io.BytesIO(template)
+        result = io.BytesIO()
+        Renderer(template, self.getContext(self.data['Context']), result,
+                 **self.getRendererParams()).run()
+        # Write the result in a file, in order to compare it
+        self.result = os.path.join(self.tempFolder, '%s.%s' % (
+            self.data['Name'], self.data['Result']))
+        f = open(self.result, 'wb')
+        f.write(result.getvalue())
+        f.close()
+
+    def checkResult(self):
+        expected = self.getExpectedResult(self.data['Expected'])
+        return self.compareResults(self.result, expected)
+
 # ------------------------------------------------------------------------------
 class PodTestFactory(appy.shared.test.TestFactory):
     def createTest(testData, testDescription, testFolder, config, flavour):
         if testData.table.instanceOf('ErrorTest'):
             test = ErrorTest(testData, testDescription, testFolder, config,
                               flavour)
+        elif testData.table.instanceOf('BatchTest'):
+            test = BatchTest(testData, testDescription, testFolder, config,
+                             flavour)
+        elif testData.table.instanceOf('StreamTest'):
+            test = StreamTest(testData, testDescription, testFolder, config,
+                              flavour)
+        elif testData.table.instanceOf('CompiledTest'):
+            test = CompiledTest(testData, testDescription, testFolder, config,
+                                flavour)
         else:
             test = NominalTest(testData, testDescription, testFolder, config,
                                flavour)
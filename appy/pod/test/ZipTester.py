@@ -0,0 +1,162 @@
+# ------------------------------------------------------------------------------
+# Appy is a framework for building applications in the Python language.
+# Copyright (C) 2007 Gaetan Delannay
+
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,USA.
+
+# ------------------------------------------------------------------------------
+import io, struct, zipfile, unittest
+from unittest import mock
+
+import appy.shared.zip
+from appy.shared.zip import StreamedEntry, copyRawEntry, addRawEntry
+
+# ------------------------------------------------------------------------------
+class ZipTests(unittest.TestCase):
+    '''Round-trip tests for the functions of appy.shared.zip that write zip
+       entries without going through ZipFile.writestr. pod uses them for every
+       result it produces: POD templates can't exercise the fallback used when
+       the required ZipFile internals are missing.'''
+    # Entries of the source archive, with their compression type
+    entries = (('mimetype', b'application/vnd.oasis.opendocument.text',
+                zipfile.ZIP_STORED),
+               ('Pictures/image.png', bytes(range(256)) * 40,
+                zipfile.ZIP_STORED),
+               ('settings.xml', b'<settings>%s</settings>' % (b'x' * 5000),
+                zipfile.ZIP_DEFLATED),
+               ('Thumbnails/thumbnail.png', bytes(range(256)) * 20,
+                zipfile.ZIP_BZIP2))
+    # A text bigger than StreamedEntry.chunkSize, with a marker inside
+    marker = '<!MARKER!>'
+    text = '<root>%s%s%s</root>' % ('aé' * 20000, marker, 'b' * 70000)
+
+    def getArchive(self):
+        '''Returns the content of a zip file containing self.entries.'''
+        res = io.BytesIO()
+        zipFile = zipfile.ZipFile(res, 'w')
+        for name, content, compressType in self.entries:
+            zipFile.writestr(name, content, compressType)
+        zipFile.close()
+        return res.getvalue()
+
+    def check(self, data, expected):
+        '''Checks that zip file p_data is valid and contains p_expected, a dict
+           of contents keyed by entry name.'''
+        zipFile = zipfile.ZipFile(io.BytesIO(data))
+        self.assertIsNone(zipFile.testzip())
+        self.assertEqual(sorted(zipFile.namelist()), sorted(expected))
+        for name, content in expected.items():
+            self.assertEqual(zipFile.read(name), content)
+        zipFile.close()
+
+    def copyEntries(self):
+        archive = self.getArchive()
+        source = zipfile.ZipFile(io.BytesIO(archive))
+        res = io.BytesIO()
+        zipFile = zipfile.ZipFile(res, 'w')
+        for info in source.infolist(): copyRawEntry(zipFile, info, archive)
+        zipFile.close()
+        source.close()
+        self.check(res.getvalue(), dict([(n, c) for n, c, t in self.entries]))
+
+    def streamEntry(self, replacement, writes):
+        res = io.BytesIO()
+        zipFile = zipfile.ZipFile(res, 'w')
+        entry = StreamedEntry(zipFile, 'content.xml', marker=self.marker)
+        for chunk in writes: entry.write(chunk)
+        entry.close(replacement)
+        zipFile.close()
+        expected = self.text.replace(self.marker, replacement)
+        self.check(res.getvalue(), {'content.xml': expected.encode('utf-8')})
+
+    def getWrites(self, size):
+        '''Splits self.text into chunks of p_size chars.'''
+        return [self.text[i:i+size] for i in range(0, len(self.text), size)]
+
+    def testCopyRawEntry(self):
+        self.copyEntries()
+
+    def getRawData(self, data, info):
+        '''Gets the compressed bytes of the entry described by p_info in zip
+           file p_data.'''
+        offset = info.header_offset
+        nameLength, extraLength = struct.unpack('<HH',
+                                                data[offset+26:offset+30])
+        start = offset + 30 + nameLength + extraLength
+        return data[start:start+info.compress_size]
+
+    def testCopyRawEntryUnchanged(self):
+        # Entries are copied with their CRC and compressed bytes, without
+        # being decompressed and compressed again.
+        archive = self.getArchive()
+        source = zipfile.ZipFile(io.BytesIO(archive))
+        res = io.BytesIO()
+        zipFile = zipfile.ZipFile(res, 'w')
+        with mock.patch.object(zipfile, '_get_compressor',
+                               side_effect=AssertionError), \
+             mock.patch.object(zipfile, '_get_decompressor',
+                               side_effect=AssertionError):
+            for info in source.infolist():
+                copyRawEntry(zipFile, info, archive)
+        zipFile.close()
+        data = res.getvalue()
+        copy = zipfile.ZipFile(io.BytesIO(data))
+        for info in source.infolist():
+            copied = copy.getinfo(info.filename)
+            self.assertEqual((copied.CRC, copied.compress_type,
+                              copied.compress_size, copied.file_size),
+                             (info.CRC, info.compress_type,
+                              info.compress_size, info.file_size))
+            self.assertEqual(self.getRawData(data, copied),
+                             self.getRawData(archive, info))
+        copy.close()
+        source.close()
+
+    def testCopyRawEntryFallback(self):
+        with mock.patch.object(appy.shared.zip, 'canAddRaw', lambda z: False):
+            self.copyEntries()
+
+    def testAddRawEntryUnsupportedFallback(self):
+        # Without the ZipFile internals, a bzip2-compressed entry can't be
+        # added from its compressed data.
+        archive = zipfile.ZipFile(io.BytesIO(self.getArchive()))
+        info = archive.getinfo('Thumbnails/thumbnail.png')
+        archive.close()
+        zipFile = zipfile.ZipFile(io.BytesIO(), 'w')
+        with mock.patch.object(appy.shared.zip, 'canAddRaw', lambda z: False):
+            with self.assertRaises(ValueError):
+                addRawEntry(zipFile, info, (b'data',))
+        zipFile.close()
+
+    def testStreamedEntry(self):
+        self.streamEntry('<styles/>', self.getWrites(1000))
+
+    def testStreamedEntryFallback(self):
+        with mock.patch.object(appy.shared.zip, 'canAddRaw', lambda z: False):
+            self.streamEntry('<styles/>', self.getWrites(1000))
+
+    def testStreamedEntrySplitMarker(self):
+        # The marker is split over more than 2 writes
+        self.streamEntry('<styles/>', self.getWrites(3))
+
+    def testStreamedEntryNoMarker(self):
+        # The marker is not found: the text is dumped as is
+        self.marker = '<!OTHER!>'
+        self.streamEntry('<styles/>', [self.text])
+
+# ------------------------------------------------------------------------------
+if __name__ == '__main__':
+    unittest.main()
+# ------------------------------------------------------------------------------
@@ -2,5 +2,4 @@ import os.path
 import appy
 
 def getFileHandler():
-    return file('%s/pod/test/templates/NoPython.odt' % os.path.dirname(appy.__file__))
-
+    return open('%s/pod/test/templates/NoPython.odt' % os.path.dirname(appy.__file__), 'rb')
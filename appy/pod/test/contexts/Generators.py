@@ -0,0 +1,11 @@
+from appy.pod.test.contexts import Person
+
+# Generators have no length, and can be walked only once: they are created by
+# functions, in order to get new ones at every rendering.
+def getElems():
+    for elem in ['Hello', 'World', 45, True]:
+        yield elem
+
+def getPersons(count=4):
+    for i in range(count):
+        yield Person('P%d' % (i+1))
@@ -0,0 +1,8 @@
+import os.path
+from appy.pod.test.contexts import Person
+
+persons = [Person('P1'), Person('P2'), Person('P3')]
+
+def getSubTemplate():
+    return os.path.join(os.path.dirname(os.path.dirname(__file__)),
+                        'templates', 'SubPerson.odt')
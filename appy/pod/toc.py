@@ -0,0 +1,281 @@
+# ------------------------------------------------------------------------------
+# Appy is a framework for building applications in the Python language.
+# Copyright (C) 2007 Gaetan Delannay
+
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,USA.
+
+# ------------------------------------------------------------------------------
+import codecs, tempfile, xml.parsers.expat
+from xml.sax.saxutils import escape
+
+from appy.pod.odf_parser import OdfEnvironment
+
+# ------------------------------------------------------------------------------
+NS_TEXT = OdfEnvironment.NS_TEXT
+NS_XLINK = OdfEnvironment.NS_XLINK
+# The separator between namespace URIs and names, for the expat parser
+SEP = ' '
+
+# ------------------------------------------------------------------------------
+class Heading:
+    '''A heading found in the rendered content.xml'''
+    def __init__(self, level, bookmark):
+        self.level = level
+        self.bookmark = bookmark
+        # The byte offset where to insert the bookmark (just after the start
+        # tag of the heading)
+        self.offset = None
+        self.text = []
+
+class Toc:
+    '''A table of contents found in the rendered content.xml'''
+    def __init__(self):
+        # The maximum outline level of the headings to include
+        self.maxLevel = 10
+        # The paragraph styles to use per outline level, and the levels whose
+        # entries contain the page number.
+        self.styles = {}
+        self.pageNumbers = set()
+        # The byte offsets of the part of the index body to replace
+        self.start = self.end = None
+
+# ------------------------------------------------------------------------------
+class TocRefresher:
+    '''Regenerates, without LibreOffice, the tables of contents found in the
+       rendered content.xml, from the headings found in it.
+
+       A bookmark is inserted into every heading. In the table of contents,
+       every entry links to its bookmark and its page number is a field
+       referring to it: it is computed by the application displaying the
+       document (or by LibreOffice when converting it), like any other field.
+
+       The rendered content.xml is written into this object (see m_write) and
+       spooled in memory, or in a temp file beyond p_maxMemory bytes. It is
+       then parsed once, for finding the headings and tables of contents, and
+       copied into a StreamedEntry (see m_dump): tables of contents are
+       replaced and bookmarks are inserted without parsing it again.'''
+    # The size of the chunks of data spooled or read from the spool
+    chunkSize = 65536
+    bookmarkPrefix = '__PodToc'
+
+    def __init__(self, namespaces, stylesManager, marker, maxMemory=16777216):
+        # The namespace prefixes of the result
+        self.namespaces = namespaces
+        self.stylesManager = stylesManager
+        # The marker of dynamic styles, that is not valid XML (see m_read)
+        self.marker = marker.encode('utf-8')
+        self.content = tempfile.SpooledTemporaryFile(maxMemory)
+        # Text written but not spooled yet, and its length
+        self.pending = []
+        self.pendingSize = 0
+        self.headings = []
+        self.tocs = []
+        # The heading and table of contents currently parsed
+        self.heading = None
+        self.toc = None
+        # The outline level of the TOC entry template currently parsed
+        self.level = None
+        # The number of elements, within the current heading, whose content
+        # must not be part of its text (notes).
+        self.ignoring = 0
+        # Is an object waiting for the offset of the next event (see
+        # m_setOffset) ?
+        self.waiting = None
+
+    def write(self, text):
+        self.pending.append(text)
+        self.pendingSize += len(text)
+        if self.pendingSize >= self.chunkSize: self.flush()
+
+    def flush(self):
+        self.content.write(''.join(self.pending).encode('utf-8'))
+        self.pending = []
+        self.pendingSize = 0
+
+    def ns(self, uri):
+        return self.namespaces[uri]
+
+    def read(self):
+        '''Yields the content, chunk by chunk. The marker of dynamic styles is
+           replaced with a comment of the same length: offsets found while
+           parsing are offsets in the spool.'''
+        marker = self.marker
+        comment = b'<!--' + b'X' * (len(marker) - 7) + b'-->'
+        keep = len(marker) - 1
+        self.content.seek(0)
+        rest = b''
+        while True:
+            chunk = self.content.read(self.chunkSize)
+            data = (rest + chunk).replace(marker, comment)
+            if not chunk:
+                yield data
+                break
+            # Keep the end of the data, that may contain the start of a marker
+            rest = data[-keep:]
+            yield data[:-keep]
+
+    def parse(self):
+        '''Finds the headings and the tables of contents'''
+        parser = xml.parsers.expat.ParserCreate(namespace_separator=SEP)
+        parser.StartElementHandler = self.startElement
+        parser.EndElementHandler = self.endElement
+        parser.CharacterDataHandler = self.characters
+        self.parser = parser
+        for chunk in self.read(): parser.Parse(chunk)
+        parser.Parse(b'', True)
+        # A table of contents whose body is empty ("<text:index-body/>") has
+        # no room for entries: it is not refreshed.
+        for toc in self.tocs[:]:
+            self.content.seek(toc.end)
+            if self.content.read(2) != b'</': self.tocs.remove(toc)
+
+    def setOffset(self):
+        '''Sets the offset of the current event on the object waiting for
+           it.'''
+        if not self.waiting: return
+        element, attr = self.waiting
+        setattr(element, attr, self.parser.CurrentByteIndex)
+        self.waiting = None
+
+    def startElement(self, name, attrs):
+        self.setOffset()
+        uri, sep, name = name.partition(SEP)
+        if uri != NS_TEXT: return
+        if self.heading:
+            if name == 'note':
+                self.ignoring += 1
+            elif (name in ('s', 'tab', 'line-break')) and not self.ignoring:
+                count = int(attrs.get('%s%sc' % (NS_TEXT, SEP), 1))
+                self.heading.text.append(' ' * count)
+        elif (name == 'h') and not self.toc:
+            self.startHeading(attrs)
+        elif name == 'table-of-content':
+            self.toc = Toc()
+        elif self.toc:
+            self.startTocElement(name, attrs)
+
+    def startHeading(self, attrs):
+        level = attrs.get('%s%soutline-level' % (NS_TEXT, SEP))
+        if level:
+            level = int(level)
+        else:
+            # Get the outline level from the heading style
+            style = attrs.get('%s%sstyle-name' % (NS_TEXT, SEP))
+            style = self.stylesManager.styles.get(style)
+            level = (style and style.outlineLevel) or 1
+        bookmark = '%s%d' % (self.bookmarkPrefix, len(self.headings) + 1)
+        self.heading = Heading(level, bookmark)
+        self.waiting = (self.heading, 'offset')
+
+    def startTocElement(self, name, attrs):
+        toc = self.toc
+        if name == 'table-of-content-source':
+            level = attrs.get('%s%soutline-level' % (NS_TEXT, SEP))
+            if level: toc.maxLevel = int(level)
+        elif name == 'table-of-content-entry-template':
+            self.level = int(attrs['%s%soutline-level' % (NS_TEXT, SEP)])
+            toc.styles[self.level] = attrs.get('%s%sstyle-name' % (NS_TEXT,SEP))
+        elif name == 'index-entry-page-number':
+            toc.pageNumbers.add(self.level)
+        elif name == 'index-body':
+            # The content of the body will be replaced
+            self.waiting = (toc, 'start')
+
+    def endElement(self, name):
+        self.setOffset()
+        uri, sep, name = name.partition(SEP)
+        if uri != NS_TEXT: return
+        if self.heading:
+            if name == 'note':
+                self.ignoring -= 1
+            elif name == 'h':
+                # Empty headings are ignored
+                if ''.join(self.heading.text).strip():
+                    self.headings.append(self.heading)
+                self.heading = None
+        elif self.toc:
+            if name == 'index-title':
+                # Keep the title: replace the body after it
+                self.waiting = (self.toc, 'start')
+            elif name == 'index-body':
+                self.toc.end = self.parser.CurrentByteIndex
+            elif name == 'table-of-content':
+                if (self.toc.start is not None) and (self.toc.end is not None):
+                    self.tocs.append(self.toc)
+                self.toc = None
+
+    def characters(self, data):
+        self.setOffset()
+        if self.heading and not self.ignoring: self.heading.text.append(data)
+
+    def getEntries(self, toc):
+        '''Returns the content of the body of p_toc'''
+        t = self.ns(NS_TEXT)
+        x = self.ns(NS_XLINK)
+        res = []
+        for heading in self.headings:
+            if heading.level > toc.maxLevel: continue
+            text = escape(' '.join(''.join(heading.text).split()))
+            style = toc.styles.get(heading.level)
+            style = style and (' %s:style-name="%s"' % (t, style)) or ''
+            entry = '<%s:a %s:type="simple" %s:href="#%s">%s</%s:a>' % \
+                    (t, x, x, heading.bookmark, text, t)
+            if heading.level in toc.pageNumbers:
+                entry += '<%s:tab/><%s:bookmark-ref %s:reference-format=' \
+                         '"page" %s:ref-name="%s">?</%s:bookmark-ref>' % \
+                         (t, t, t, t, heading.bookmark, t)
+            res.append('<%s:p%s>%s</%s:p>' % (t, style, entry, t))
+        return ''.join(res)
+
+    def getBookmark(self, heading):
+        t = self.ns(NS_TEXT)
+        return '<%s:bookmark %s:name="%s"/>' % (t, t, heading.bookmark)
+
+    def dump(self, entry):
+        '''Writes the content into p_entry (a StreamedEntry), with refreshed
+           tables of contents and bookmarked headings.'''
+        self.flush()
+        self.parse()
+        # Get the list of splices (start, end, text): bytes from "start" to
+        # "end" are replaced with "text".
+        splices = [(h.offset, h.offset, self.getBookmark(h)) \
+                   for h in self.headings]
+        for toc in self.tocs:
+            splices.append((toc.start, toc.end, self.getEntries(toc)))
+        splices.sort(key=lambda s: s[0])
+        decoder = codecs.getincrementaldecoder('utf-8')()
+        self.content.seek(0)
+        position = 0
+        for start, end, text in splices:
+            self.copy(entry, decoder, start - position)
+            entry.write(text)
+            # Skip the replaced bytes
+            self.content.seek(end)
+            position = end
+        self.copy(entry, decoder, None)
+        self.content.close()
+
+    def copy(self, entry, decoder, size):
+        '''Copies p_size bytes (or all remaining bytes if p_size is None) from
+           the spool to p_entry.'''
+        while (size is None) or (size > 0):
+            chunkSize = self.chunkSize
+            if size is not None: chunkSize = min(chunkSize, size)
+            chunk = self.content.read(chunkSize)
+            if not chunk: break
+            if size is not None: size -= len(chunk)
+            entry.write(decoder.decode(chunk))
+        entry.write(decoder.decode(b'', size is None))
+# ------------------------------------------------------------------------------
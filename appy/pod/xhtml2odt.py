@@ -11,7 +11,7 @@ from appy.pod import *
 from appy.pod.odf_parser import OdfEnvironment
 from appy.pod.styles_manager import Style
 from appy.shared.xml_parser import XmlEnvironment, XmlParser, escapeXml
-from appy.shared.utils import WhitespaceCruncher
+from appy.shared.utils import WhitespaceCruncher, Rope
 from appy.shared.css import CssStyles
 
 # To which ODT tags do HTML tags correspond ?
@@ -216,8 +216,8 @@ class HtmlTable:
         elems = str(time.time()).split('.')
         self.name= 'AppyTable%s%s%d' % (elems[0],elems[1],random.randint(1,100))
         self.styleNs = env.ns[OdfEnvironment.NS_STYLE]
-        self.res = '' # The sub-buffer
-        self.tempRes = '' # The temporary sub-buffer, into which we will
+        self.res = Rope() # The sub-buffer
+        self.tempRes = Rope() # The temporary sub-buffer, into which we will
         # dump all table sub-elements, until we encounter the end of the first
         # row. Then, we will know how much columns are defined in the table;
         # we will dump columns declarations into self.res and dump self.tempRes
@@ -294,7 +294,7 @@ class XhtmlEnvironment(XmlEnvironment):
         XmlEnvironment.__init__(self)
         self.renderer = renderer
         self.ns = renderer.currentParser.env.namespaces
-        self.res = ''
+        self.res = Rope()
         self.currentContent = ''
         self.currentElements = [] # Stack of currently walked elements
         self.currentLists = [] # Stack of currently walked lists (ul or ol)
@@ -399,7 +399,7 @@ class XhtmlEnvironment(XmlEnvironment):
         if self.res.endswith(startTags):
             # In this case I would dump an empty (series of) tag(s). Instead, I
             # will remove those tags.
-            self.res = self.res[:-len(startTags)]
+            self.res.truncate(len(self.res) - len(startTags))
         else:
             self.dumpString(self.getTags(conflictElems, start=False))
 
@@ -484,7 +484,7 @@ class XhtmlEnvironment(XmlEnvironment):
             # Computes the column styles required by the table
             table.computeColumnStyles(self.parser.caller.renderer)
             # Dumps the content of the last parsed table into the parent buffer
-            self.dumpString(table.res)
+            self.dumpString(str(table.res))
             # Remove cell-paragraph from local styles mapping if it was added
             map = self.parser.caller.localStylesMapping
             if not self.currentTables and ('p' in map):
@@ -503,7 +503,7 @@ class XhtmlEnvironment(XmlEnvironment):
                     table.res+= '<%s:table-column %s:style-name="%s.%d"/>' % \
                                 (self.tableNs, self.tableNs, table.name, i)
                 table.res += table.tempRes
-                table.tempRes = ''
+                table.tempRes = Rope()
         elif elem in TABLE_CELL_TAGS:
             # Update attr "columnContentSizes" of the currently parsed table,
             # excepted if the cell spans several columns.
@@ -601,7 +601,7 @@ class XhtmlParser(XmlParser):
             startTag = e.getTags((currentElem,), start=True)
         if currentElem.isConflictual and e.res.endswith(startTag):
             # We will not dump it, it would constitute a silly empty tag.
-            e.res = e.res[:-len(startTag)]
+            e.res.truncate(len(e.res) - len(startTag))
         else:
             # Dump the end tag. But dump some additional stuff if required.
             if elem in XHTML_LISTS:
@@ -636,7 +636,7 @@ class Xhtml2OdtConverter:
 
     def run(self):
         self.xhtmlParser.parse(self.xhtmlString)
-        return self.xhtmlParser.env.res
+        return str(self.xhtmlParser.env.res)
 
     def findStyle(self, elem, attrs=None, classValue=None):
         return self.stylesManager.findStyle(elem, attrs, classValue,
@@ -700,4 +700,72 @@ class WhitespaceCruncher:
         # "res" can be a single whitespace. It is up to the caller method to
         # identify when this single whitespace must be kept or crunched.
         return res
+
+# ------------------------------------------------------------------------------
+class Rope:
+    '''A string built by appending chunks of text. Appending a chunk (via
+       m_append or "+=") is done in constant time, while appending to a str
+       copies the whole string every time. The chunks are joined when the
+       string is needed (see m___str__), and the joined string is kept.'''
+    def __init__(self, s=''):
+        self.chunks = s and [s] or []
+        self.length = len(s)
+
+    def append(self, s):
+        '''Appends string p_s to this rope.'''
+        if not s: return
+        self.chunks.append(s)
+        self.length += len(s)
+
+    def __iadd__(self, s):
+        self.append(str(s))
+        return self
+
+    def __len__(self): return self.length
+
+    def __str__(self):
+        chunks = self.chunks
+        if not chunks: return ''
+        if len(chunks) > 1:
+            self.chunks = chunks = [''.join(chunks)]
+        return chunks[0]
+
+    def endswith(self, suffix):
+        '''Does this rope end with p_suffix ? Only the last chunks, that may
+           contain it, are joined.'''
+        size = len(suffix)
+        i = len(self.chunks)
+        length = 0
+        while (i > 0) and (length < size):
+            i -= 1
+            length += len(self.chunks[i])
+        return ''.join(self.chunks[i:]).endswith(suffix)
+
+    def truncate(self, length):
+        '''Keeps only the p_length first chars of this rope.'''
+        chunks = self.chunks
+        while chunks and ((self.length - len(chunks[-1])) >= length):
+            self.length -= len(chunks.pop())
+        if self.length > length:
+            chunks[-1] = chunks[-1][:length - self.length]
+            self.length = length
+
+    def split(self, index):
+        '''Returns a tuple of 2 ropes: the first one contains the chars of this
+           rope before p_index, the second one contains the remaining chars.
+           Only the chunk containing p_index is cut.'''
+        first = Rope()
+        second = Rope()
+        start = 0
+        for chunk in self.chunks:
+            end = start + len(chunk)
+            if end <= index:
+                first.append(chunk)
+            elif start >= index:
+                second.append(chunk)
+            else:
+                first.append(chunk[:index-start])
+                second.append(chunk[index-start:])
+            start = end
+        return first, second
 # ------------------------------------------------------------------------------
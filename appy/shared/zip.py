@@ -1,9 +1,12 @@
 '''Functions for (un)zipping files'''
 
 # ------------------------------------------------------------------------------
-import os, os.path, zipfile, time
+import os, os.path, io, zipfile, time, zlib, shutil, tempfile, struct
 from appy.shared import mimeTypes
 
+# ------------------------------------------------------------------------------
+RAW_COMPRESSION = 'Compression type %d is not supported.'
+
 # ------------------------------------------------------------------------------
 def unzip(f, folder, odf=False):
     '''Unzips file p_f into p_folder. p_f can be any anything accepted by the
@@ -91,4 +94,229 @@ def zip(f, folder, odf=False):
             zInfo.external_attr = 48
             zipFile.writestr(zInfo, '')
     zipFile.close()
+
+# ------------------------------------------------------------------------------
+def _gf2Times(matrix, vector):
+    res = 0
+    i = 0
+    while vector:
+        if vector & 1: res ^= matrix[i]
+        vector >>= 1
+        i += 1
+    return res
+
+def _gf2Square(matrix):
+    return [_gf2Times(matrix, matrix[i]) for i in range(32)]
+
+def crc32Combine(crc1, crc2, length2):
+    '''Returns the CRC-32 of the concatenation of 2 byte strings, given the
+       CRC-32 of the first one (p_crc1), and the CRC-32 (p_crc2) and length
+       (p_length2) of the second one. This is the algorithm of zlib's
+       crc32_combine, that is not available in module zlib.'''
+    if length2 <= 0: return crc1
+    # The operator for one zero bit, then for 2 and 4 zero bits
+    odd = [0xedb88320] + [1 << i for i in range(31)]
+    even = _gf2Square(odd)
+    odd = _gf2Square(even)
+    # Apply p_length2 zero bytes to p_crc1
+    while True:
+        even = _gf2Square(odd)
+        if length2 & 1: crc1 = _gf2Times(even, crc1)
+        length2 >>= 1
+        if not length2: break
+        odd = _gf2Square(even)
+        if length2 & 1: crc1 = _gf2Times(odd, crc1)
+        length2 >>= 1
+        if not length2: break
+    return crc1 ^ crc2
+
+# The ZipFile internals used by m_addRawEntry
+RAW_INTERNALS = ('_lock', '_seekable', '_writecheck', '_didModify',
+                 'start_dir', 'fp', 'filelist', 'NameToInfo')
+
+def canAddRaw(zipFile):
+    '''Can raw entries be added to p_zipFile, opened for writing ? Adding a raw
+       entry relies on ZipFile internals that may change from one Python
+       version to the other.'''
+    for name in RAW_INTERNALS:
+        if not hasattr(zipFile, name): return False
+    return True
+
+def addRawEntry(zipFile, info, data):
+    '''Adds to p_zipFile, opened for writing, an entry whose already
+       compressed content is in p_data, a sequence of bytes-like and/or file
+       objects whose content is copied as is. ZipInfo p_info must define the
+       CRC, compression type and sizes of the entry. This function uses the
+       same ZipFile internals as ZipFile.open when writing an entry. If they
+       are not available, the content is decompressed and added via
+       ZipFile.writestr.'''
+    if not canAddRaw(zipFile):
+        addDecompressedEntry(zipFile, info, data)
+        return
+    zip64 = max(info.file_size, info.compress_size) > zipfile.ZIP64_LIMIT
+    with zipFile._lock:
+        if zipFile._seekable: zipFile.fp.seek(zipFile.start_dir)
+        info.header_offset = zipFile.fp.tell()
+        zipFile._writecheck(info)
+        zipFile._didModify = True
+        zipFile.fp.write(info.FileHeader(zip64))
+        for chunk in data:
+            if hasattr(chunk, 'read'):
+                shutil.copyfileobj(chunk, zipFile.fp)
+            else:
+                zipFile.fp.write(chunk)
+        zipFile.filelist.append(info)
+        zipFile.NameToInfo[info.filename] = info
+        zipFile.start_dir = zipFile.fp.tell()
+
+def addDecompressedEntry(zipFile, info, data):
+    '''Fallback for m_addRawEntry: decompresses p_data and adds it to
+       p_zipFile via ZipFile.writestr, that compresses it again. Only stored
+       and deflated entries can be decompressed.'''
+    decompressor = None
+    if info.compress_type == zipfile.ZIP_DEFLATED:
+        decompressor = zlib.decompressobj(-15)
+    elif info.compress_type != zipfile.ZIP_STORED:
+        raise ValueError(RAW_COMPRESSION % info.compress_type)
+    content = []
+    for chunk in data:
+        if hasattr(chunk, 'read'):
+            chunk = chunk.read()
+        else:
+            chunk = bytes(chunk)
+        if decompressor: chunk = decompressor.decompress(chunk)
+        content.append(chunk)
+    if decompressor: content.append(decompressor.flush())
+    zipFile.writestr(info, b''.join(content), info.compress_type)
+
+def copyRawEntry(zipFile, info, archive):
+    '''Copies into p_zipFile, opened for writing, the entry described by
+       ZipInfo p_info, from p_archive, the content (as bytes) of the zip file
+       p_info comes from. The entry is not decompressed and recompressed: its
+       compressed data, CRC and sizes are reused.'''
+    res = zipfile.ZipInfo(info.filename, info.date_time)
+    res.compress_type = info.compress_type
+    res.CRC = info.CRC
+    res.file_size = info.file_size
+    res.compress_size = info.compress_size
+    res.external_attr = info.external_attr
+    res.create_system = info.create_system
+    res.comment = info.comment
+    # Keep the "encrypted" flag only: sizes and CRC will be in the header
+    res.flag_bits = info.flag_bits & 0x1
+    if not canAddRaw(zipFile):
+        # Let module zipfile decompress the entry, whatever its compression
+        # type, and compress it again.
+        source = zipfile.ZipFile(io.BytesIO(archive))
+        zipFile.writestr(res, source.read(info), info.compress_type)
+        source.close()
+        return
+    archive = memoryview(archive)
+    # Skip the local file header, whose variable-length fields may differ from
+    # those of the central directory.
+    offset = info.header_offset
+    nameLength, extraLength = struct.unpack('<HH', archive[offset+26:offset+30])
+    start = offset + 30 + nameLength + extraLength
+    addRawEntry(zipFile, res, (archive[start:start+info.compress_size],))
+
+# ------------------------------------------------------------------------------
+class StreamedEntry:
+    '''A deflated entry, into which text is written sequentially and
+       compressed on the fly, of a zip file opened for writing.
+
+       The text may contain a p_marker whose replacement is only known once
+       all the text has been written (see m_close). The text preceding the
+       marker is kept in memory; the text following it is compressed while
+       being written. When closing the entry, the text preceding the marker and
+       its replacement are compressed and inserted before the rest: the
+       concatenation of 2 deflate streams is a valid deflate stream if the
+       first one ends with a "sync" flush.
+
+       Because the start of the entry is only known at the end, compressed data
+       is spooled in memory, or in a temp file beyond p_maxMemory bytes.'''
+    # The size of text chunks to compress at once
+    chunkSize = 65536
+
+    def __init__(self, zipFile, name, marker=None, maxMemory=16777216,
+                 encoding='utf-8', level=zlib.Z_DEFAULT_COMPRESSION):
+        self.zipFile = zipFile
+        self.name = name
+        self.marker = marker
+        self.encoding = encoding
+        self.level = level
+        # The text preceding the marker, as long as the marker was not found
+        self.head = None
+        if marker: self.head = []
+        # The text preceding the marker, once found
+        self.before = ''
+        # The end of the last text written in self.head, for finding markers
+        # being split over several writes.
+        self.tail = ''
+        # Text not compressed yet, and its length
+        self.pending = []
+        self.pendingSize = 0
+        # The compressor, the spool for compressed data, the CRC and the size
+        # of the uncompressed data.
+        self.compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+        self.spool = tempfile.SpooledTemporaryFile(maxMemory)
+        self.crc = 0
+        self.size = 0
+
+    def write(self, text):
+        if self.head is not None:
+            # We are still looking for the marker
+            if self.marker not in (self.tail + text):
+                self.head.append(text)
+                self.tail = (self.tail + text)[-len(self.marker):]
+                return
+            self.head.append(text)
+            head = ''.join(self.head)
+            i = head.find(self.marker)
+            self.head = None
+            self.before = head[:i]
+            text = head[i+len(self.marker):]
+        self.pending.append(text)
+        self.pendingSize += len(text)
+        if self.pendingSize >= self.chunkSize: self.compress()
+
+    def compress(self):
+        '''Compresses the pending text.'''
+        data = ''.join(self.pending).encode(self.encoding)
+        self.pending = []
+        self.pendingSize = 0
+        self.crc = zlib.crc32(data, self.crc)
+        self.size += len(data)
+        self.spool.write(self.compressor.compress(data))
+
+    def close(self, replacement=''):
+        '''Replaces the marker with p_replacement and adds the entry into the
+           zip file.'''
+        if self.head is not None:
+            # The marker was not found: everything is in self.head
+            self.pending.insert(0, ''.join(self.head))
+            self.head = None
+            replacement = ''
+        self.compress()
+        self.spool.write(self.compressor.flush())
+        compressedSize = self.spool.tell()
+        self.spool.seek(0)
+        # Compress the start of the entry
+        data = [self.spool]
+        startData = (self.before + replacement).encode(self.encoding)
+        crc = self.crc
+        if startData:
+            compressor = zlib.compressobj(self.level, zlib.DEFLATED, -15)
+            start = compressor.compress(startData) + \
+                    compressor.flush(zlib.Z_SYNC_FLUSH)
+            data.insert(0, start)
+            compressedSize += len(start)
+            crc = crc32Combine(zlib.crc32(startData), crc, self.size)
+        info = zipfile.ZipInfo(self.name, time.localtime()[:6])
+        info.external_attr = 0o600 << 16
+        info.compress_type = zipfile.ZIP_DEFLATED
+        info.CRC = crc
+        info.file_size = len(startData) + self.size
+        info.compress_size = compressedSize
+        addRawEntry(self.zipFile, info, data)
+        self.spool.close()
 # ------------------------------------------------------------------------------